@@ -0,0 +1,200 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import scipy.sparse as sp
+
+# Alternating least squares on the sparse rating matrix
+# - explicit: minimizes sum (r_ui - x_u.y_i)^2 over the known ratings, weighted lambda regularization ( ALS-WR )
+# - implicit: every rating is a positive preference with confidence 1 + alpha * r_ui,
+#   unrated movies are negatives with confidence 1 ( Hu, Koren, Volinsky )
+# One half sweep solves all users ( or movies ) against the fixed other side. Rows are solved in chunks:
+# short rows are padded into buckets of equal length and their normal equations built with one batched
+# matmul per bucket, long rows use a matmul each, then np.linalg.solve solves the whole chunk at once.
+# Chunks are spread over a thread pool, numpy releases the GIL in the heavy parts.
+
+ARTIFACT_DIR = os.path.join('artifacts', 'als')
+CHUNK_ELEMENTS = 2 ** 24  # floats of the temporary arrays of a chunk (64MB)
+
+
+class ALSModel:
+    def __init__(self, user_factors, item_factors, user_ids, movie_ids, params=None, history=None, version=None):
+        self.user_factors = user_factors
+        self.item_factors = item_factors
+        self.user_ids = user_ids
+        self.movie_ids = movie_ids
+        self.params = params or {}
+        self.history = history or []
+        self.version = version
+
+    def save(self, artifact_dir=ARTIFACT_DIR, version=None, **meta):
+        # writes a new version directory and points 'latest' at it, returns the version
+        # the name is unique per process and microsecond, a version is never written over ( its files may be
+        # mapped by the web workers serving it )
+        self.version = version or f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{os.getpid()}"
+        path = os.path.join(artifact_dir, self.version)
+        os.makedirs(artifact_dir, exist_ok=True)
+        os.makedirs(path)
+        np.save(os.path.join(path, 'user_factors.npy'), self.user_factors)
+        np.save(os.path.join(path, 'item_factors.npy'), self.item_factors)
+        np.save(os.path.join(path, 'user_ids.npy'), self.user_ids)
+        np.save(os.path.join(path, 'movie_ids.npy'), self.movie_ids)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'version': self.version, 'params': self.params, 'history': self.history, **meta}, f, indent=2)
+        write_atomic(os.path.join(artifact_dir, 'latest'), self.version)
+        return self.version
+
+    @classmethod
+    def load(cls, artifact_dir=ARTIFACT_DIR, version=None, mmap_mode='r'):
+        version = version or latest_version(artifact_dir)
+        if version is None:
+            raise FileNotFoundError(f'No trained model in {artifact_dir}')
+        path = os.path.join(artifact_dir, version)
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        return cls(np.load(os.path.join(path, 'user_factors.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(path, 'item_factors.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(path, 'user_ids.npy')),
+                   np.load(os.path.join(path, 'movie_ids.npy')),
+                   meta.get('params'), meta.get('history'), version)
+
+
+def latest_version(artifact_dir=ARTIFACT_DIR):
+    try:
+        with open(os.path.join(artifact_dir, 'latest')) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def write_atomic(filename, text):
+    tmp = f'{filename}.tmp{os.getpid()}'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, filename)
+
+
+def solve_rows(R, Y, regularization, implicit=False, alpha=1.0, YtY=None, rows=None):
+    # least squares solution for the rows start:end of R against the fixed factors Y
+    start, end = rows if rows is not None else (0, R.shape[0])
+    k = Y.shape[1]
+    indptr = R.indptr
+    counts = np.diff(indptr[start:end + 1])
+    A = np.zeros((end - start, k, k), dtype=Y.dtype)
+    b = np.zeros((end - start, k), dtype=Y.dtype)
+
+    # rows with few ratings: padded to the next power of two and solved with one batched matmul per length
+    heavy = max(2 * k, 1)
+    length = 1
+    while length // 2 < heavy:
+        batch = np.flatnonzero((counts > length // 2) & (counts <= min(length, heavy)))
+        if len(batch):
+            lengths = counts[batch]
+            offsets = np.arange(length)
+            valid = offsets[None, :] < lengths[:, None]
+            positions = np.where(valid, indptr[start + batch][:, None] + offsets[None, :], 0)
+            Yi = Y[R.indices[positions]] * valid[:, :, None]
+            weights, targets = _weights(R.data[positions] * valid, implicit, alpha)
+            A[batch] = np.matmul((Yi * weights[:, :, None]).transpose(0, 2, 1), Yi)
+            b[batch] = np.matmul(targets[:, None, :], Yi)[:, 0, :]
+        length *= 2
+
+    # rows with many ratings: a matmul each
+    for row in np.flatnonzero(counts > heavy):
+        lo, hi = indptr[start + row], indptr[start + row + 1]
+        Yi = Y[R.indices[lo:hi]]
+        weights, targets = _weights(R.data[lo:hi], implicit, alpha)
+        A[row] = (Yi * weights[:, None]).T @ Yi
+        b[row] = targets @ Yi
+
+    identity = np.eye(k, dtype=Y.dtype)
+    if implicit:
+        A += YtY + regularization * identity
+    else:
+        A += regularization * np.maximum(counts, 1)[:, None, None] * identity
+    X = np.linalg.solve(A, b[:, :, None])[:, :, 0]
+    X[counts == 0] = 0
+    return X
+
+def _weights(values, implicit, alpha):
+    # weight of the outer product and target weight of each rating
+    if implicit:
+        confidence = alpha * values
+        return confidence, confidence + 1
+    return np.ones_like(values), values
+
+
+def chunk_bounds(R, k):
+    # split the rows so that the temporary arrays of one chunk stay below CHUNK_ELEMENTS floats
+    counts = np.diff(R.indptr)
+    cost = np.cumsum(np.where(counts <= 2 * k, 2 * counts // k, 0) + 1)  # padded factors + normal equations, in k*k floats
+    budget = max(CHUNK_ELEMENTS // (k * k), 1)
+    bounds = np.searchsorted(cost, np.arange(budget, cost[-1] if len(cost) else 0, budget))
+    bounds = np.unique(np.concatenate(([0], bounds, [R.shape[0]])))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def solve_side(R, Y, regularization, implicit, alpha, executor, bounds):
+    X = np.empty((R.shape[0], Y.shape[1]), dtype=Y.dtype)
+    YtY = Y.T @ Y if implicit else None
+
+    def solve(rows):
+        X[rows[0]:rows[1]] = solve_rows(R, Y, regularization, implicit, alpha, YtY, rows)
+
+    list(executor.map(solve, bounds))
+    return X
+
+
+def loss(R, X, Y, regularization, implicit=False, alpha=1.0, chunk=1000000):
+    # (objective, rmse over the known ratings)
+    coo = R.tocoo()
+    squared_error = 0.0
+    implicit_correction = 0.0
+    for lo in range(0, coo.nnz, chunk):
+        rows, cols, values = coo.row[lo:lo + chunk], coo.col[lo:lo + chunk], coo.data[lo:lo + chunk]
+        scores = np.einsum('nk,nk->n', X[rows], Y[cols]).astype(np.float64)
+        if implicit:
+            confidence = 1 + alpha * values
+            implicit_correction += np.sum(confidence * (1 - scores) ** 2 - scores ** 2)
+            squared_error += np.sum((1 - scores) ** 2)
+        else:
+            squared_error += np.sum((values - scores) ** 2)
+    rmse = np.sqrt(squared_error / max(coo.nnz, 1))
+    if implicit:
+        # sum over all pairs of score^2, without building the dense score matrix
+        everything = np.sum((X @ (Y.T @ Y)) * X, dtype=np.float64)
+        objective = everything + implicit_correction + regularization * (np.sum(X ** 2) + np.sum(Y ** 2))
+    else:
+        user_counts = np.diff(R.indptr)
+        item_counts = np.bincount(coo.col, minlength=R.shape[1])
+        objective = squared_error + regularization * (np.sum(user_counts * np.sum(X ** 2, axis=1)) +
+                                                      np.sum(item_counts * np.sum(Y ** 2, axis=1)))
+    return float(objective), float(rmse)
+
+
+def train_als(ratings, factors=64, regularization=0.05, iterations=10, implicit=True, alpha=10.0,
+              workers=None, seed=42, callback=None):
+    # trains on a RatingMatrix, callback(iteration, seconds, objective, rmse) after every iteration
+    R = sp.csr_matrix(ratings.matrix, dtype=np.float32)
+    Rt = R.T.tocsr()
+    rng = np.random.default_rng(seed)
+    X = (rng.standard_normal((R.shape[0], factors)) * 0.01).astype(np.float32)
+    Y = (rng.standard_normal((R.shape[1], factors)) * 0.01).astype(np.float32)
+    user_bounds = chunk_bounds(R, factors)
+    item_bounds = chunk_bounds(Rt, factors)
+    history = []
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        for iteration in range(1, iterations + 1):
+            started = time.perf_counter()
+            X = solve_side(R, Y, regularization, implicit, alpha, executor, user_bounds)
+            Y = solve_side(Rt, X, regularization, implicit, alpha, executor, item_bounds)
+            seconds = time.perf_counter() - started
+            objective, rmse = loss(R, X, Y, regularization, implicit, alpha)
+            history.append({'iteration': iteration, 'seconds': seconds, 'loss': objective, 'rmse': rmse})
+            if callback:
+                callback(iteration, seconds, objective, rmse)
+
+    params = {'factors': factors, 'regularization': regularization, 'iterations': iterations,
+              'implicit': implicit, 'alpha': alpha, 'seed': seed}
+    return ALSModel(X, Y, ratings.user_ids, ratings.movie_ids, params, history)
@@ -0,0 +1,160 @@
+import os
+import time
+
+import numpy as np
+
+from als import ALSModel, ARTIFACT_DIR, latest_version
+from rating_matrix import indices_of
+
+# Approximate top-k inner product search over the movie factors ( IVF, inverted file index )
+# - the movie vectors get one extra component so that all of them have the same norm, then the
+#   largest inner product is also the smallest distance ( Bachrach et al. 2014 ) and plain k-means works
+# - k-means splits the movies into lists, a query scores the centroids and only searches the nprobe
+#   best lists exactly. nprobe is the recall / latency knob.
+# - the vectors are stored reordered by list, so every probed list is one contiguous slice of a
+#   memory-mapped array shared by all processes
+
+ANN_FILES = ('ann_centroids.npy', 'ann_offsets.npy', 'ann_items.npy', 'ann_vectors.npy')
+
+
+def augment(vectors):
+    # append sqrt(max_norm^2 - norm^2) so that every row has the same norm, rows are then normalized
+    norms = np.sum(vectors.astype(np.float64) ** 2, axis=1)
+    extra = np.sqrt(np.maximum(norms.max(initial=0) - norms, 0))
+    augmented = np.hstack([vectors, extra[:, None]]).astype(np.float32)
+    length = np.sqrt(norms.max(initial=0)) or 1.0
+    return augmented / np.float32(length)
+
+
+def kmeans(vectors, n_clusters, iterations=15, seed=42, block_size=8192):
+    # spherical k-means, returns (centroids, assignment)
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    assignment = np.zeros(len(vectors), dtype=np.int32)
+    for _ in range(iterations):
+        for lo in range(0, len(vectors), block_size):
+            assignment[lo:lo + block_size] = np.argmax(vectors[lo:lo + block_size] @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        # restart empty clusters at random vectors
+        sums[empty] = vectors[rng.choice(len(vectors), np.count_nonzero(empty))]
+        norms[empty] = 1
+        centroids = (sums / norms).astype(np.float32)
+    return centroids, assignment
+
+
+def build_ann_index(item_factors, n_lists=None, iterations=15, seed=42):
+    # (centroids, offsets, items, vectors) arrays of the index
+    item_factors = np.asarray(item_factors, dtype=np.float32)
+    n_lists = n_lists or max(int(np.sqrt(len(item_factors))), 1)
+    centroids, assignment = kmeans(augment(item_factors), n_lists, iterations, seed)
+    items = np.argsort(assignment, kind='stable').astype(np.int32)
+    offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignment, minlength=len(centroids)), out=offsets[1:])
+    return centroids, offsets, items, item_factors[items]
+
+
+class ANNIndex:
+    def __init__(self, centroids, offsets, items, vectors, movie_ids, nprobe=16):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.items = items  # movie column of every stored vector
+        self.vectors = vectors
+        self.movie_ids = movie_ids
+        self.nprobe = nprobe
+
+    @classmethod
+    def load(cls, version=None, artifact_dir=ARTIFACT_DIR, nprobe=16):
+        version = version or latest_version(artifact_dir)
+        path = os.path.join(artifact_dir, version)
+        centroids, offsets, items, vectors = (np.load(os.path.join(path, name), mmap_mode='r') for name in ANN_FILES)
+        return cls(np.asarray(centroids), np.asarray(offsets), items, vectors,
+                   np.load(os.path.join(path, 'movie_ids.npy')), nprobe)
+
+    def save(self, version, artifact_dir=ARTIFACT_DIR):
+        path = os.path.join(artifact_dir, version)
+        for name, array in zip(ANN_FILES, (self.centroids, self.offsets, self.items, self.vectors)):
+            tmp = os.path.join(path, f'tmp-{name}')
+            np.save(tmp, array)
+            os.replace(tmp, os.path.join(path, name))
+
+    def search(self, query, k=10, nprobe=None, exclude=None):
+        # (movie columns, scores) of the approximately k highest inner products, best first
+        # exclude: movie columns that must not be returned ( e.g. already rated )
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        query = np.asarray(query, dtype=np.float32)
+        centroid_scores = self.centroids[:, :-1] @ query
+        probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        slices = [slice(self.offsets[p], self.offsets[p + 1]) for p in probe]
+        candidates = np.concatenate([self.items[s] for s in slices])
+        scores = np.concatenate([self.vectors[s] @ query for s in slices])
+        if exclude is not None and len(exclude):
+            keep = ~np.isin(candidates, exclude)
+            candidates, scores = candidates[keep], scores[keep]
+        k = min(k, len(scores))
+        if k == 0:
+            return candidates[:0], scores[:0]
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return candidates[best], scores[best]
+
+    def search_movies(self, query, k=10, nprobe=None, exclude_movie_ids=None):
+        # like search, with movie ids instead of columns
+        exclude = None
+        if exclude_movie_ids is not None and len(exclude_movie_ids):
+            exclude = indices_of(self.movie_ids, np.asarray(exclude_movie_ids))
+        columns, scores = self.search(query, k, nprobe, exclude)
+        return self.movie_ids[columns], scores
+
+
+def exact_search(item_factors, query, k=10):
+    scores = np.asarray(item_factors) @ query
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best])]
+
+
+def recall_report(index, item_factors, queries, k=10, nprobes=(1, 2, 4, 8, 16, 32)):
+    # [{'nprobe', 'recall', 'ms_per_query'}] against the exact search, plus the exact timing
+    item_factors = np.asarray(item_factors)
+    started = time.perf_counter()
+    exact = [set(exact_search(item_factors, q, k)) for q in queries]
+    exact_ms = (time.perf_counter() - started) * 1000 / max(len(queries), 1)
+    report = []
+    for nprobe in nprobes:
+        if nprobe > len(index.centroids):
+            break
+        started = time.perf_counter()
+        found = [index.search(q, k, nprobe)[0] for q in queries]
+        ms = (time.perf_counter() - started) * 1000 / max(len(queries), 1)
+        recall = np.mean([len(truth.intersection(f)) / len(truth) for truth, f in zip(exact, found)])
+        report.append({'nprobe': nprobe, 'recall': float(recall), 'ms_per_query': ms})
+    return report, exact_ms
+
+
+def build(version=None, n_lists=None, sample=1000, k=10, artifact_dir=ARTIFACT_DIR):
+    # batch job behind `flask ann`: builds the index of a model version and prints the recall report
+    # a published version gets its index once, the files in its manifest never change
+    import model_registry
+    model = ALSModel.load(artifact_dir, version)
+    if model_registry.is_published(model.version, artifact_dir) and \
+            os.path.exists(os.path.join(artifact_dir, model.version, ANN_FILES[0])):
+        raise ValueError(f'model {model.version} is published with an ANN index, train a new version first')
+    started = time.perf_counter()
+    index = ANNIndex(*build_ann_index(model.item_factors, n_lists), model.movie_ids)
+    index.save(model.version, artifact_dir)
+    print(f"Built ANN index with {len(index.centroids)} lists over {len(index.items)} movies for model "
+          f"{model.version} in {time.perf_counter() - started:.2f}s")
+    if model_registry.current_version(artifact_dir) == model.version:
+        model_registry.publish(model.version, artifact_dir)  # the workers reload the served model with the index
+
+    rng = np.random.default_rng(0)
+    users = np.asarray(model.user_factors)
+    queries = users[rng.choice(len(users), min(sample, len(users)), replace=False)]
+    report, exact_ms = recall_report(index, model.item_factors, queries, k)
+    print(f"exact search: {exact_ms:.3f} ms/query")
+    for row in report:
+        print(f"nprobe {row['nprobe']:>3}: recall@{k} {row['recall']:.3f}, {row['ms_per_query']:.3f} ms/query")
+    return index, report
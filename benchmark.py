@@ -0,0 +1,250 @@
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from urllib.parse import quote
+
+import numpy as np
+from sqlalchemy import event, func, select
+
+from models import db, Movie, Ratings, User
+
+# End to end benchmark on a data directory ( data/ or one written by synthetic_data.py )
+# every run loads the data into fresh databases in a temporary directory, so it never touches the
+# database of the app. The results are written as JSON, `--compare` prints the change against an
+# older result file.
+
+PASSWORD = 'User123'  # of the users created by the data loaders
+
+
+def create_benchmark_app(work_dir, name):
+    from recommender import create_app
+    return create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(work_dir, name + '.sqlite')}",
+        'GENRE_INDEX_SNAPSHOT': os.path.join(work_dir, name + '-genre_index.npz'),
+        'WTF_CSRF_ENABLED': False,
+        'TESTING': True,
+    })
+
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def latency_stats(seconds):
+    ms = np.array(seconds) * 1000
+    return {'requests': len(ms), 'mean_ms': float(ms.mean()), 'p50_ms': float(np.percentile(ms, 50)),
+            'p95_ms': float(np.percentile(ms, 95)), 'p99_ms': float(np.percentile(ms, 99)),
+            'requests_per_sec': float(len(ms) / (ms.sum() / 1000))}
+
+
+class QueryCounter:
+    # counts the SQL statements of the app's engine
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.increment)
+
+    def increment(self, *args):
+        self.count += 1
+
+
+def table_counts():
+    return {name: db.session.execute(select(func.count()).select_from(model)).scalar()
+            for name, model in (('movies', Movie), ('ratings', Ratings), ('users', User))}
+
+
+def bench_load(app, loader, data_dir):
+    with app.app_context():
+        _, seconds = timed(loader, db, data_dir)
+        counts = table_counts()
+    return {'seconds': seconds, 'rows_per_sec': (counts['ratings'] + counts['movies']) / seconds, **counts}
+
+
+def bench_rating_matrix(app, work_dir):
+    from rating_matrix import get_rating_matrix
+    with app.app_context():
+        ratings, build = timed(get_rating_matrix, db, cache_dir=work_dir, rebuild=True)
+        _, load = timed(get_rating_matrix, db, cache_dir=work_dir)
+    return {'build_seconds': build, 'cached_load_seconds': load, 'users': ratings.matrix.shape[0],
+            'movies': ratings.matrix.shape[1], 'ratings': int(ratings.matrix.nnz)}
+
+
+def login(app, user_id):
+    client = app.test_client()
+    response = client.post('/user/sign-in', data={'username': f'user_{user_id}', 'password': PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError(f'could not sign in as user_{user_id}')
+    return client
+
+
+def bench_requests(client, counter, urls):
+    # latency stats of GET requests to the urls, plus the SQL statements per request
+    seconds = []
+    before = counter.count
+    for url in urls:
+        response, elapsed = timed(client.get, url)
+        if response.status_code != 200:
+            raise RuntimeError(f'{url}: {response.status_code}')
+        seconds.append(elapsed)
+    return {**latency_stats(seconds), 'queries_per_request': (counter.count - before) / len(urls)}
+
+
+def listing_urls(app, n, rng):
+    # n /movies urls at random cursors and n /movies/genres urls with one or two random genres
+    with app.app_context():
+        movie_ids = db.session.execute(select(Movie.id)).scalars().all()
+        from recommender import current_genre_index
+        with app.test_request_context():
+            genres = current_genre_index().genres
+    movies = [f'/movies?after={rng.choice(movie_ids)}' for _ in range(n)]
+    by_genres = [f"/movies/genres?genres={','.join(rng.sample(genres, rng.randint(1, 2)))}"
+                 f"{'&mode=all' if rng.random() < 0.3 else ''}" for _ in range(n)]
+    return movies, by_genres
+
+
+def bench_routes(app, n, rng):
+    client = login(app, 1)
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+    movies, by_genres = listing_urls(app, n, rng)
+    client.get('/movies')  # loads the genre index
+    app.extensions['page_cache'].clear()
+    return {
+        'movies_cold': bench_requests(client, counter, movies),
+        'movies_warm': bench_requests(client, counter, movies),
+        'genres_cold': bench_requests(client, counter, by_genres),
+        'genres_warm': bench_requests(client, counter, by_genres),
+        # first pages of the sort modes, served from the movie_stats indexes
+        'genres_sorted': bench_requests(client, counter, [
+            f"{url}&sort={rng.choice(['popular', 'top-rated', 'newest'])}" for url in by_genres]),
+    }
+
+
+def bench_search(app, n, rng):
+    # autocomplete on prefixes of random titles ( as typed ) and the search page for the whole titles
+    client = login(app, 1)
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+        titles = db.session.execute(select(Movie.title_stripped)).scalars().all()
+    chosen = [rng.choice(titles) for _ in range(n)]
+    client.get('/movies/autocomplete?q=a')  # loads the title index
+    return {
+        'autocomplete': bench_requests(client, counter, [
+            f'/movies/autocomplete?q={quote(title[:rng.randint(1, max(len(title), 1))])}' for title in chosen]),
+        'search': bench_requests(client, counter, [f'/movies/search?q={quote(title)}' for title in chosen]),
+    }
+
+
+def bench_rate(app, n, rng, batch_size=50):
+    # throughput of single ratings ( /rate_movie ) and of batches ( /rate_movies )
+    client = login(app, 2)
+    with app.app_context():
+        movie_ids = db.session.execute(select(Movie.id)).scalars().all()
+    ratings = [(rng.choice(movie_ids), rng.randint(1, 10) / 2) for _ in range(n)]
+    seconds = []
+    for movie_id, rating in ratings:
+        response, elapsed = timed(client.post, '/rate_movie', json={'movie_id': movie_id, 'rating': rating})
+        if not response.get_json()['success']:
+            raise RuntimeError(response.get_json())
+        seconds.append(elapsed)
+    single = latency_stats(seconds)
+    single['ratings_per_sec'] = single['requests_per_sec']
+
+    seconds = []
+    for lo in range(0, n, batch_size):
+        batch = [{'movie_id': movie_id, 'rating': rating} for movie_id, rating in ratings[lo:lo + batch_size]]
+        response, elapsed = timed(client.post, '/rate_movies', json={'ratings': batch})
+        if not response.get_json()['success']:
+            raise RuntimeError(response.get_json())
+        seconds.append(elapsed)
+    batched = latency_stats(seconds)
+    batched['ratings_per_sec'] = n / sum(seconds)
+    return {'rate_movie': single, f'rate_movies_batch_{batch_size}': batched}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(data_dir='data', out=None, legacy=True, requests=200, ratings=500, seed=0, work_dir=None):
+    # runs every benchmark, writes and returns the results
+    import read_data
+    rng = random.Random(seed)
+    work_dir = work_dir or tempfile.mkdtemp(prefix='benchmark-')
+    os.makedirs(work_dir, exist_ok=True)
+    results = {}
+    try:
+        if legacy:
+            print('check_and_read_data ...')
+            results['load_check_and_read_data'] = bench_load(
+                create_benchmark_app(work_dir, 'legacy'), read_data.check_and_read_data, data_dir)
+        print('bulk_read_data ...')
+        app = create_benchmark_app(work_dir, 'bulk')
+        results['load_bulk_read_data'] = bench_load(app, read_data.bulk_read_data, data_dir)
+        print('rating matrix ...')
+        results['rating_matrix'] = bench_rating_matrix(app, work_dir)
+        print('routes ...')
+        results['routes'] = bench_routes(app, requests, rng)
+        print('search ...')
+        results['search'] = bench_search(app, requests, rng)
+        print('rating writes ...')
+        results['rate'] = bench_rate(app, ratings, rng)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'commit': git_commit(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'data_dir': data_dir,
+        'results': results,
+    }
+    out = out or os.path.join('benchmarks', f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{report['commit']}.json")
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {out}")
+    return report
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{name}.'))
+        elif isinstance(value, (int, float)):
+            flat[f'{prefix}{name}'] = value
+    return flat
+
+
+def compare(old, new, threshold=0.1):
+    # prints every metric that changed by more than threshold, returns the number of regressions
+    # ( more seconds / ms / queries, or fewer per second )
+    old_results, new_results = flatten(old['results']), flatten(new['results'])
+    regressions = 0
+    print(f"{old.get('commit')} -> {new.get('commit')}")
+    for name in sorted(old_results.keys() & new_results.keys()):
+        before, after = old_results[name], new_results[name]
+        if not before or abs(after - before) / abs(before) < threshold:
+            continue
+        higher_is_better = name.endswith('per_sec')
+        worse = after < before if higher_is_better else after > before
+        timing = name.endswith(('seconds', '_ms', 'per_sec', 'queries_per_request'))
+        regressions += worse and timing
+        flag = ' REGRESSION' if worse and timing else ''
+        print(f"{name}: {before:.4g} -> {after:.4g} ({(after - before) / before:+.0%}){flag}")
+    return regressions
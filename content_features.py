@@ -0,0 +1,241 @@
+import json
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+import scipy.sparse as sp
+from sqlalchemy import func, select
+
+from als import latest_version, write_atomic
+from models import Movie, MovieGenre, Tags
+from rating_matrix import indices_of
+from ratings_snapshot import extend_ids
+from recommendations import top_n
+
+# Content features of the movies: a sparse TF-IDF matrix movies x (genres + tags)
+# - a genre counts once, a tag as often as users applied it to the movie ( sublinear, 1 + log ), the idf
+#   is the smoothed log((1 + movies) / (1 + movies with the feature)) + 1, rows have unit length, so a
+#   dot product is the cosine similarity
+# - built from two grouped queries in one vectorized pass and saved with its raw counts under
+#   artifacts/content/<version>, 'latest' points at the current version like the models
+# - when only tags were added since, `build` fetches the new movie_tags rows ( by id ), adds their counts
+#   to the saved ones and recomputes the weights, the idf of every column changes with them. New movies,
+#   changed genres or deleted tags rebuild everything.
+# - similar movies by content are one sparse matrix-vector product over all movies, the hybrid scorer
+#   blends the collaborative scores with the content scores, the less a movie was rated the more its
+#   content counts ( see hybrid_weights )
+
+ARTIFACT_DIR = os.path.join('artifacts', 'content')
+COLD_RATINGS = 10  # ratings at which a movie's content weight is halfway down from twice content_weight
+ARRAYS = ('movie_ids', 'genres', 'tag_ids', 'indptr', 'indices', 'counts', 'weights')
+
+
+class ContentFeatures:
+    # movies x features, columns: the genres ( sorted ) followed by the tags ( tag_ids, in the order they came )
+    def __init__(self, movie_ids, genres, tag_ids, counts, weights=None, meta=None, version=None):
+        self.movie_ids = movie_ids  # sorted
+        self.genres = genres
+        self.tag_ids = tag_ids
+        self.counts = counts  # raw counts, kept for the incremental rebuild
+        self.matrix = weights if weights is not None else tfidf(counts)
+        self.meta = meta or {}
+        self.version = version
+
+    def save(self, artifact_dir=ARTIFACT_DIR, **meta):
+        self.version = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        path = os.path.join(artifact_dir, self.version)
+        os.makedirs(path, exist_ok=True)
+        arrays = {'movie_ids': self.movie_ids, 'genres': self.genres, 'tag_ids': self.tag_ids,
+                  'indptr': self.matrix.indptr, 'indices': self.matrix.indices, 'counts': self.counts.data,
+                  'weights': self.matrix.data}
+        for name, array in arrays.items():
+            np.save(os.path.join(path, f'{name}.npy'), array)
+        self.meta = {'version': self.version, 'shape': list(self.matrix.shape), 'nnz': int(self.matrix.nnz), **meta}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=2)
+        write_atomic(os.path.join(artifact_dir, 'latest'), self.version)
+        return self.version
+
+    @classmethod
+    def load(cls, artifact_dir=ARTIFACT_DIR, version=None, mmap_mode='r'):
+        version = version or latest_version(artifact_dir)
+        if version is None:
+            return None
+        path = os.path.join(artifact_dir, version)
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode) for name in ARRAYS}
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        shape = tuple(meta['shape'])
+        counts = sp.csr_matrix((arrays['counts'], arrays['indices'], arrays['indptr']), shape=shape)
+        weights = sp.csr_matrix((arrays['weights'], arrays['indices'], arrays['indptr']), shape=shape)
+        return cls(np.asarray(arrays['movie_ids']), np.asarray(arrays['genres']), np.asarray(arrays['tag_ids']),
+                   counts, weights, meta, version)
+
+    def rows(self, movie_ids):
+        # feature rows of the movies in the given order, empty rows for movies without features
+        positions = indices_of(self.movie_ids, np.asarray(movie_ids, dtype=np.int64))
+        known = positions >= 0
+        selected = self.matrix[positions[known]].tocoo()
+        return sp.csr_matrix((selected.data, (np.flatnonzero(known)[selected.row], selected.col)),
+                             shape=(len(positions), self.matrix.shape[1]))
+
+    def similar(self, movie_id, n=10):
+        # [(movie id, cosine similarity)] of the n movies closest in content, one matrix-vector product
+        i = np.searchsorted(self.movie_ids, movie_id)
+        if i >= len(self.movie_ids) or self.movie_ids[i] != movie_id:
+            return []
+        vector = np.zeros(self.matrix.shape[1], dtype=np.float32)
+        lo, hi = self.matrix.indptr[i], self.matrix.indptr[i + 1]
+        vector[self.matrix.indices[lo:hi]] = self.matrix.data[lo:hi]
+        scores = self.matrix @ vector
+        scores[i] = -np.inf
+        best, best_scores = top_n(scores[None, :], n)
+        return [(int(self.movie_ids[j]), float(s)) for j, s in zip(best[0], best_scores[0]) if s > 0]
+
+    def neighbours(self, movie_ids, k=50, block_size=256):
+        # movies x movies CSR of the k highest content similarities of every movie, rows and columns in the
+        # order of movie_ids ( e.g. the movies of a model ), built a block of rows at a time
+        M = self.rows(movie_ids)
+        M_t = M.T.tocsr()
+        n = M.shape[0]
+        k = min(k, max(n - 1, 1))
+        columns = np.zeros((n, k), dtype=np.int64)
+        scores = np.zeros((n, k), dtype=np.float32)
+        for lo in range(0, n, block_size):
+            hi = min(lo + block_size, n)
+            block = (M[lo:hi] @ M_t).toarray()
+            block[np.arange(hi - lo), np.arange(lo, hi)] = 0  # a movie is not its own neighbour
+            columns[lo:hi], scores[lo:hi] = top_n(block, k)
+        indptr = np.arange(0, n * k + 1, k, dtype=np.int64)
+        S = sp.csr_matrix((scores.ravel(), columns.ravel(), indptr), shape=(n, n))
+        S.eliminate_zeros()
+        return S
+
+
+def tfidf(counts):
+    # unit length TF-IDF rows with the sparsity of the counts
+    n_movies = counts.shape[0]
+    df = np.bincount(counts.indices, minlength=counts.shape[1])
+    idf = np.log((1 + n_movies) / (1 + df)) + 1
+    weights = ((1 + np.log(np.maximum(counts.data, 1))) * idf[counts.indices]).astype(np.float32)
+    rows = np.repeat(np.arange(n_movies), np.diff(counts.indptr))
+    norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=n_movies)).astype(np.float32)
+    weights /= np.where(norms > 0, norms, 1)[rows]
+    return sp.csr_matrix((weights, counts.indices, counts.indptr), shape=counts.shape)
+
+
+def catalogue_state(db):
+    # what decides between up to date, an incremental and a full build
+    movies = db.session.execute(select(func.count(), func.max(Movie.id))).one()
+    genres = db.session.execute(select(func.count(), func.max(MovieGenre.id))).one()
+    tag_count, max_tag_id = db.session.execute(select(func.count(), func.max(Tags.id))).one()
+    return {'movies': f'{movies[0]}|{movies[1]}', 'genres': f'{genres[0]}|{genres[1]}', 'tag_count': tag_count,
+            'max_tag_id': max_tag_id or 0}
+
+
+def tag_counts(db, after_id=0, until_id=None):
+    # (movie ids, tag ids, times applied) of the movie_tags rows after_id < id <= until_id
+    query = select(Tags.movie_id, Tags.tag_name_id, func.count()).where(Tags.id > after_id)
+    if until_id is not None:
+        query = query.where(Tags.id <= until_id)
+    rows = db.session.execute(query.group_by(Tags.movie_id, Tags.tag_name_id)).all()
+    if not rows:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float32)
+    movie_ids, tag_ids, counts = np.array(rows, dtype=np.int64).T
+    return movie_ids, tag_ids, counts.astype(np.float32)
+
+
+def build_full(db, state):
+    movie_ids = np.array(db.session.execute(select(Movie.id).order_by(Movie.id)).scalars().all(), dtype=np.int64)
+    genre_rows = db.session.execute(select(MovieGenre.movie_id, MovieGenre.genre).distinct()).all()
+    genres = np.array(sorted({genre for _, genre in genre_rows}), dtype=str)
+    genre_movies = np.array([movie_id for movie_id, _ in genre_rows], dtype=np.int64)
+    genre_columns = np.searchsorted(genres, np.array([genre for _, genre in genre_rows], dtype=str))
+    tag_movies, tags, tag_times = tag_counts(db, until_id=state['max_tag_id'])
+    tag_ids, tag_columns = extend_ids(np.empty(0, np.int64), tags)
+
+    rows = indices_of(movie_ids, np.concatenate([genre_movies, tag_movies]))
+    columns = np.concatenate([genre_columns, len(genres) + tag_columns.astype(np.int64)])
+    values = np.concatenate([np.ones(len(genre_movies), dtype=np.float32), tag_times])
+    known = rows >= 0
+    counts = sp.csr_matrix((values[known], (rows[known], columns[known])),
+                           shape=(len(movie_ids), len(genres) + len(tag_ids)), dtype=np.float32)
+    counts.sum_duplicates()
+    return ContentFeatures(movie_ids, genres, tag_ids, counts)
+
+
+def build_incremental(db, features, state):
+    # adds the counts of the tags added since the last build
+    tag_movies, tags, tag_times = tag_counts(db, features.meta['max_tag_id'], state['max_tag_id'])
+    tag_ids, tag_columns = extend_ids(features.tag_ids, tags)
+    shape = (len(features.movie_ids), len(features.genres) + len(tag_ids))
+    rows = indices_of(features.movie_ids, tag_movies)
+    known = rows >= 0
+    added = sp.csr_matrix((tag_times[known], (rows[known], len(features.genres) + tag_columns[known].astype(np.int64))),
+                          shape=shape, dtype=np.float32)
+    old = features.counts
+    counts = sp.csr_matrix((np.asarray(old.data), np.asarray(old.indices), np.asarray(old.indptr)), shape=shape) + added
+    counts.sort_indices()
+    return ContentFeatures(features.movie_ids, features.genres, tag_ids, counts.astype(np.float32))
+
+
+def build(db, artifact_dir=ARTIFACT_DIR, full=False):
+    # brings the content features up to date, returns (features, how: 'unchanged', 'incremental' or 'full')
+    started = time.perf_counter()
+    state = catalogue_state(db)
+    features = None if full else ContentFeatures.load(artifact_dir)
+    meta = features.meta if features is not None else {}
+    if features is not None and all(meta.get(name) == value for name, value in state.items()):
+        return features, 'unchanged'
+    incremental = features is not None and meta['movies'] == state['movies'] and \
+        meta['genres'] == state['genres'] and meta['max_tag_id'] <= state['max_tag_id'] and \
+        meta['tag_count'] + db.session.execute(select(func.count()).where(
+            Tags.id > meta['max_tag_id'], Tags.id <= state['max_tag_id'])).scalar() == state['tag_count']
+    how = 'incremental' if incremental else 'full'
+    features = build_incremental(db, features, state) if incremental else build_full(db, state)
+    features.save(artifact_dir, **state, build=how, seconds=time.perf_counter() - started)
+    remove_old_versions(artifact_dir, keep=2)
+    return features, how
+
+
+def remove_old_versions(artifact_dir, keep=2):
+    # readers that still map an old version keep its files until they let go of them
+    versions = sorted(name for name in os.listdir(artifact_dir) if os.path.isdir(os.path.join(artifact_dir, name)))
+    for version in versions[:-keep]:
+        path = os.path.join(artifact_dir, version)
+        for filename in os.listdir(path):
+            os.remove(os.path.join(path, filename))
+        os.rmdir(path)
+
+
+_features = None
+_features_mtime = None
+
+def get_content_features(artifact_dir=ARTIFACT_DIR):
+    # features of the latest version, reloaded when a new version is published
+    global _features, _features_mtime
+    try:
+        mtime = os.stat(os.path.join(artifact_dir, 'latest')).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if _features is None or mtime != _features_mtime:
+        _features = ContentFeatures.load(artifact_dir)
+        _features_mtime = mtime
+    return _features
+
+
+def hybrid_weights(rating_counts, content_weight, cold_ratings=COLD_RATINGS):
+    # share of the content score per movie: content_weight for well rated movies, up to twice that for
+    # unrated ones. All of it for the unrated ones would fill every list with them, most movies of a
+    # catalogue have hardly any ratings.
+    cold = cold_ratings / (cold_ratings + np.asarray(rating_counts, dtype=np.float32))
+    return np.minimum(content_weight * (1 + cold), 1).astype(np.float32)
+
+
+def hybrid_scores(collaborative, content, weights):
+    # users x movies blend of both scores, each scaled by its largest absolute value per user first
+    def scaled(scores):
+        top = np.abs(scores).max(axis=1, keepdims=True)
+        return scores / np.where(top > 0, top, 1)
+    return (1 - weights) * scaled(collaborative) + weights * scaled(content)
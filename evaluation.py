@@ -0,0 +1,259 @@
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import product
+
+import numpy as np
+import scipy.sparse as sp
+
+from als import train_als
+from rating_matrix import RatingMatrix
+from recommendations import top_n
+
+# Offline evaluation of the recommenders on a temporal split of the ratings
+# - global: every rating after the (1 - test_fraction) quantile of the timestamps is a test rating
+# - leave-last-out: the last rating of every user with at least two ratings is a test rating
+# A run trains on the train part and is measured on the test part:
+# - RMSE / MAE of the predicted ratings ( explicit models only, implicit scores are no ratings )
+# - precision@k, recall@k and NDCG@k of the top-k unrated movies against the test ratings >= RELEVANT_RATING,
+#   coverage: share of the catalogue that shows up in anybody's top-k
+# - training seconds, users ranked per second and the peak memory of the run
+# The runs of a grid are spread over a process pool. The split is written once as .npy files and every
+# worker maps them read only, so the matrices are shared through the page cache instead of being copied
+# into every process.
+
+REPORT_DIR = 'evaluations'
+RELEVANT_RATING = 4.0
+BLOCK_SIZE = 512  # users ranked per matrix multiplication
+SPLIT_ARRAYS = ('train_data', 'train_indices', 'train_indptr', 'test_data', 'test_indices', 'test_indptr',
+                'user_ids', 'movie_ids')
+
+
+class Split:
+    # train and test ratings as CSR matrices with the rows and columns of the full rating matrix
+    def __init__(self, train, test, user_ids, movie_ids, meta=None):
+        self.train = train
+        self.test = test
+        self.user_ids = user_ids
+        self.movie_ids = movie_ids
+        self.meta = meta or {}
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        arrays = {'train_data': self.train.data, 'train_indices': self.train.indices, 'train_indptr': self.train.indptr,
+                  'test_data': self.test.data, 'test_indices': self.test.indices, 'test_indptr': self.test.indptr,
+                  'user_ids': self.user_ids, 'movie_ids': self.movie_ids}
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, f'{name}.npy'), array)
+        with open(os.path.join(directory, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode) for name in SPLIT_ARRAYS}
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        shape = (len(arrays['user_ids']), len(arrays['movie_ids']))
+        train = sp.csr_matrix((arrays['train_data'], arrays['train_indices'], arrays['train_indptr']), shape=shape)
+        test = sp.csr_matrix((arrays['test_data'], arrays['test_indices'], arrays['test_indptr']), shape=shape)
+        return cls(train, test, arrays['user_ids'], arrays['movie_ids'], meta)
+
+
+def select_entries(R, mask):
+    # CSR matrix of the entries of R where mask ( aligned with R.data ) is set, same shape
+    rows = np.repeat(np.arange(R.shape[0]), np.diff(R.indptr))
+    indptr = np.zeros(R.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows[mask], minlength=R.shape[0]), out=indptr[1:])
+    return sp.csr_matrix((R.data[mask], R.indices[mask], indptr), shape=R.shape)
+
+
+def split_global(ratings, test_fraction=0.2):
+    cutoff = int(np.quantile(ratings.timestamps, 1 - test_fraction)) if ratings.nnz else 0
+    test = ratings.timestamps >= cutoff
+    return make_split(ratings, test, {'split': 'global', 'test_fraction': test_fraction, 'cutoff': cutoff})
+
+
+def split_leave_last_out(ratings):
+    R = ratings.matrix
+    counts = np.diff(R.indptr)
+    rows = np.repeat(np.arange(R.shape[0]), counts)
+    # by user and time, the last entry of every user is its newest rating
+    order = np.lexsort((ratings.timestamps, rows))
+    last = order[R.indptr[1:][counts > 1] - 1]
+    test = np.zeros(R.nnz, dtype=bool)
+    test[last] = True
+    return make_split(ratings, test, {'split': 'leave-last-out'})
+
+
+def make_split(ratings, test, meta):
+    train = select_entries(ratings.matrix, ~test)
+    test = select_entries(ratings.matrix, test)
+    meta = {**meta, 'users': ratings.shape[0], 'movies': ratings.shape[1], 'train_ratings': int(train.nnz),
+            'test_ratings': int(test.nnz)}
+    return Split(train, test, ratings.user_ids, ratings.movie_ids, meta)
+
+
+def rating_metrics(X, Y, split, chunk=1000000):
+    # RMSE / MAE over the test ratings of users and movies that have train ratings
+    test = split.test.tocoo()
+    known = (np.diff(split.train.indptr)[test.row] > 0) & \
+            (np.bincount(split.train.indices, minlength=split.train.shape[1])[test.col] > 0)
+    rows, cols, values = test.row[known], test.col[known], test.data[known]
+    squared, absolute = 0.0, 0.0
+    for lo in range(0, len(rows), chunk):
+        predicted = np.einsum('nk,nk->n', X[rows[lo:lo + chunk]], Y[cols[lo:lo + chunk]]).astype(np.float64)
+        error = predicted - values[lo:lo + chunk]
+        squared += float(np.sum(error ** 2))
+        absolute += float(np.sum(np.abs(error)))
+    n = max(len(rows), 1)
+    return {'rmse': float(np.sqrt(squared / n)), 'mae': absolute / n, 'rated_pairs': int(len(rows)),
+            'cold_pairs': int(np.count_nonzero(~known))}
+
+
+def ranking_metrics(score, split, k=10, relevant_rating=RELEVANT_RATING, block_size=BLOCK_SIZE):
+    # score(rows) -> users x movies scores, the train movies of a user are never recommended
+    relevant = select_entries(split.test, split.test.data >= relevant_rating)
+    n_relevant = np.diff(relevant.indptr)
+    users = np.flatnonzero((n_relevant > 0) & (np.diff(split.train.indptr) > 0))
+    discounts = 1 / np.log2(np.arange(2, k + 2))
+    ideal = np.cumsum(discounts)
+    precision = recall = ndcg = 0.0
+    recommended = np.zeros(split.train.shape[1], dtype=bool)
+    started = time.perf_counter()
+    for lo in range(0, len(users), block_size):
+        rows = users[lo:lo + block_size]
+        scores = score(rows)
+        seen = split.train[rows]
+        scores[np.repeat(np.arange(len(rows)), np.diff(seen.indptr)), seen.indices] = -np.inf
+        best, _ = top_n(scores, k)
+        hits = np.take_along_axis(relevant[rows].toarray() > 0, best, axis=1)
+        found = hits.sum(axis=1)
+        precision += float(np.sum(found / k))
+        recall += float(np.sum(found / n_relevant[rows]))
+        ndcg += float(np.sum((hits @ discounts) / ideal[np.minimum(n_relevant[rows], k) - 1]))
+        recommended[best.ravel()] = True
+    seconds = time.perf_counter() - started
+    n = max(len(users), 1)
+    return {f'precision@{k}': precision / n, f'recall@{k}': recall / n, f'ndcg@{k}': ndcg / n,
+            'coverage': float(recommended.mean()) if len(recommended) else 0.0, 'users': int(len(users)),
+            'ranking_seconds': seconds, 'users_per_sec': len(users) / max(seconds, 1e-9)}
+
+
+def grid(models=('als',), factors=(64,), regularization=(0.05,), iterations=(10,), modes=('implicit',),
+         alpha=(10.0,)):
+    # run configs of every combination, the popularity baseline once
+    configs = [{'model': 'popularity'}] if 'popularity' in models else []
+    if 'als' in models:
+        configs += [{'model': 'als', 'factors': f, 'regularization': r, 'iterations': i, 'implicit': m == 'implicit',
+                     **({'alpha': a} if m == 'implicit' else {})}
+                    for f, r, i, m, a in product(factors, regularization, iterations, modes, alpha)]
+        # alpha only matters for implicit runs, drop the explicit duplicates
+        configs = list({json.dumps(config, sort_keys=True): config for config in configs}.values())
+    return configs
+
+
+def evaluate_run(split, config, k=10, threads=None):
+    # trains and measures one config, returns its report entry
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = {'config': config}
+    if config['model'] == 'popularity':
+        popularity = np.bincount(split.train.indices, minlength=split.train.shape[1]).astype(np.float32)
+        result['training_seconds'] = time.perf_counter() - started
+        result.update(ranking_metrics(lambda rows: np.tile(popularity, (len(rows), 1)), split, k))
+    else:
+        params = {name: value for name, value in config.items() if name != 'model'}
+        model = train_als(RatingMatrix(split.train, split.user_ids, split.movie_ids, None), workers=threads, **params)
+        result['training_seconds'] = time.perf_counter() - started
+        result['train_rmse'] = model.history[-1]['rmse'] if model.history else None
+        X, Y = model.user_factors, model.item_factors
+        if not config['implicit']:
+            result.update(rating_metrics(X, Y, split))
+        result.update(ranking_metrics(lambda rows: X[rows] @ Y.T, split, k))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result['peak_memory_mb'] = peak / 2 ** 20
+    result['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # of the whole process
+    result['seconds'] = time.perf_counter() - started
+    result['pid'] = os.getpid()
+    return result
+
+
+_shared_split = None
+
+def _load_shared_split(directory):
+    # pool initializer: every worker maps the same files
+    global _shared_split
+    _shared_split = Split.load(directory)
+
+
+def _evaluate_shared(config, k, threads):
+    return evaluate_run(_shared_split, config, k, threads)
+
+
+def evaluate(split, configs, k=10, workers=None, callback=None):
+    # [report entry] of every config, in parallel processes when workers > 1
+    workers = min(workers or os.cpu_count() or 1, len(configs))
+    threads = max((os.cpu_count() or 1) // workers, 1)  # ALS threads per run
+    if workers <= 1:
+        results = []
+        for config in configs:
+            results.append(evaluate_run(split, config, k, threads))
+            if callback:
+                callback(results[-1])
+        return results
+    directory = tempfile.mkdtemp(prefix='evaluation-')
+    try:
+        split.save(directory)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_load_shared_split,
+                                 initargs=(directory,)) as executor:
+            results = []
+            for result in executor.map(_evaluate_shared, configs, [k] * len(configs), [threads] * len(configs)):
+                results.append(result)
+                if callback:
+                    callback(result)
+            return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run(ratings, configs, split='global', test_fraction=0.2, k=10, workers=None, out=None, commit=None):
+    # splits the RatingMatrix, evaluates the configs and writes the JSON report
+    started = time.perf_counter()
+    split = split_leave_last_out(ratings) if split == 'leave-last-out' else split_global(ratings, test_fraction)
+    print(f"{split.meta['split']} split: {split.meta['train_ratings']} train, {split.meta['test_ratings']} test ratings "
+          f"({time.perf_counter() - started:.2f}s)")
+
+    def report(result):
+        metrics = ', '.join(f'{name} {result[name]:.4f}' for name in ('rmse', f'precision@{k}', f'recall@{k}',
+                                                                        f'ndcg@{k}', 'coverage') if name in result)
+        print(f"{json.dumps(result['config'])}: {metrics}, trained in {result['training_seconds']:.1f}s, "
+              f"{result['users_per_sec']:.0f} users/sec, peak {result['peak_memory_mb']:.0f} MB")
+
+    results = evaluate(split, configs, k, workers, callback=report)
+    best = max(results, key=lambda result: result[f'ndcg@{k}'])
+    document = {
+        'commit': commit,
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'ratings_version': ratings.version,
+        **split.meta,
+        'k': k,
+        'relevant_rating': RELEVANT_RATING,
+        'workers': min(workers or os.cpu_count() or 1, len(configs)),
+        'seconds': time.perf_counter() - started,
+        'best': best['config'],
+        'runs': results,
+    }
+    out = out or os.path.join(REPORT_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{split.meta['split']}.json")
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(document, f, indent=2)
+    print(f"Best by ndcg@{k}: {json.dumps(best['config'])}")
+    print(f"Wrote {out}")
+    return document
@@ -0,0 +1,119 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import scipy.sparse as sp
+from sqlalchemy import select
+
+from als import ARTIFACT_DIR, solve_rows
+from models import Ratings, UserFactor
+from metrics import timed_job
+from rating_matrix import indices_of
+
+# Online fold-in: after a rating only the vector of that user is solved again against the fixed
+# movie factors of the served model ( one k x k least squares problem ), the result is published in
+# the user_factors table so every web worker serves recommendations from it until the next training.
+
+logger = logging.getLogger('api_flask.fold_in')  # goes to the api_flask log
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fold-in')
+
+
+def current_model(artifact_dir=ARTIFACT_DIR, serving=None):
+    # served model ( model_registry ) with its precomputed Y^T Y, None before there is one
+    if serving is None:
+        from model_registry import get_serving_model
+        serving = get_serving_model(artifact_dir)
+        if serving is None:
+            return None
+    return serving.model, serving.YtY
+
+
+def fold_in_vector(model, YtY, movie_ids, ratings):
+    # user vector for the given ratings with the movie factors of the model kept fixed
+    columns = indices_of(model.movie_ids, np.asarray(movie_ids, dtype=np.int64))
+    known = columns >= 0
+    R = sp.csr_matrix((np.asarray(ratings, dtype=np.float32)[known], (np.zeros(np.count_nonzero(known)), columns[known])),
+                      shape=(1, len(model.movie_ids)))
+    params = model.params
+    return solve_rows(R, np.asarray(model.item_factors), params.get('regularization', 0.05),
+                      params.get('implicit', True), params.get('alpha', 1.0), YtY)[0]
+
+
+def fold_in_user(db, user_id):
+    # solves and publishes the vector of a user, returns it ( None without a trained model )
+    started = time.perf_counter()
+    current = current_model()
+    if current is None:
+        return None
+    model, YtY = current
+    rows = db.session.execute(select(Ratings.movie_id, Ratings.rating).where(Ratings.user_id == user_id)).all()
+    movie_ids, ratings = zip(*rows) if rows else ((), ())
+    vector = fold_in_vector(model, YtY, movie_ids, ratings)
+
+    factor = db.session.get(UserFactor, user_id) or UserFactor(user_id=user_id)
+    factor.model_version = model.version
+    factor.vector = vector.astype(np.float32).tobytes()
+    factor.updated_at = datetime.now()
+    db.session.add(factor)
+    db.session.commit()
+    logger.info(f"fold-in user {user_id}: {len(rows)} ratings in {(time.perf_counter() - started) * 1000:.2f} ms")
+    return vector
+
+
+def schedule_fold_in(app, db, user_id):
+    # runs fold_in_user after the response, in the background thread of this worker
+    def run():
+        with app.app_context():
+            try:
+                with timed_job('fold_in'):
+                    fold_in_user(db, user_id)
+            except Exception:
+                logger.exception(f"fold-in of user {user_id} failed")
+            finally:
+                db.session.remove()
+    return _executor.submit(run)
+
+
+def user_vector(db, user_id, serving=None):
+    # (vector, rated movie ids) of a user folded in with the served ( or given ) model, None if there is none
+    current = current_model(serving=serving)
+    factor = db.session.get(UserFactor, user_id)
+    if current is None or factor is None or factor.model_version != current[0].version:
+        return None
+    rated = db.session.execute(select(Ratings.movie_id).where(Ratings.user_id == user_id)).scalars().all()
+    return np.frombuffer(factor.vector, dtype=np.float32), rated
+
+
+def drift(db, sample=200, k=10, seed=0):
+    # how far fold-in vectors are from the trained ones, for users whose ratings did not change
+    # returns mean relative L2 distance, mean cosine similarity and the mean top-k overlap of the scores
+    current = current_model()
+    if current is None:
+        raise FileNotFoundError('No model has been published yet, run `flask modelbased` and `flask recommend`')
+    model, YtY = current
+    item_factors = np.asarray(model.item_factors)
+    user_factors = np.asarray(model.user_factors)
+    rng = np.random.default_rng(seed)
+    users = rng.choice(len(model.user_ids), min(sample, len(model.user_ids)), replace=False)
+    distances, cosines, overlaps, times = [], [], [], []
+    for i in users:
+        user_id = int(model.user_ids[i])
+        rows = db.session.execute(select(Ratings.movie_id, Ratings.rating).where(Ratings.user_id == user_id)).all()
+        if not rows:
+            continue
+        started = time.perf_counter()
+        folded = fold_in_vector(model, YtY, *zip(*rows))
+        times.append(time.perf_counter() - started)
+        trained = user_factors[i]
+        norm = np.linalg.norm(trained)
+        distances.append(np.linalg.norm(folded - trained) / norm if norm else 0.0)
+        cosines.append(folded @ trained / (np.linalg.norm(folded) * norm) if norm and np.linalg.norm(folded) else 1.0)
+        top_trained = set(np.argpartition(-(item_factors @ trained), k)[:k])
+        top_folded = set(np.argpartition(-(item_factors @ folded), k)[:k])
+        overlaps.append(len(top_trained & top_folded) / k)
+    return {'model_version': model.version, 'users': len(distances),
+            'relative_l2': float(np.mean(distances)), 'cosine': float(np.mean(cosines)),
+            f'top{k}_overlap': float(np.mean(overlaps)), 'ms_per_fold_in': float(np.mean(times) * 1000)}
@@ -0,0 +1,118 @@
+import os
+import time
+from functools import reduce
+
+import numpy as np
+from sqlalchemy import select
+
+from models import Movie, MovieGenre
+from page_cache import catalogue_version
+
+# In memory genre index for the movie listings
+# every genre maps to the sorted array of its movie ids, a genre filter is a vectorized union
+# ( any of the genres, the old semantics ) or intersection ( all of the genres ) of those arrays.
+# The listings page through the sorted ids with a cursor ( the last / first id of a page ) instead
+# of OFFSET, so every page is a binary search plus one primary key lookup.
+# A snapshot of the index is kept next to the rating matrix cache, so a new worker only reads the
+# database when the catalogue changed since the snapshot was written.
+
+REFRESH_SECONDS = 5  # how often the index checks the database for new movies
+SNAPSHOT_PATH = os.path.join('cache', 'genre_index.npz')
+
+
+class GenreIndex:
+    def __init__(self, all_ids=None, genre_ids=None, stamp=None):
+        self.all_ids = all_ids if all_ids is not None else np.empty(0, dtype=np.int64)
+        self.genre_ids = genre_ids or {}
+        self.stamp = stamp
+        self.checked = time.monotonic()
+
+    @classmethod
+    def load(cls, db):
+        all_ids = np.array(db.session.execute(select(Movie.id).order_by(Movie.id)).scalars().all(), dtype=np.int64)
+        rows = db.session.execute(select(MovieGenre.movie_id, MovieGenre.genre)).all()
+        genre_ids = {}
+        if rows:
+            movie_ids, genres = zip(*rows)
+            names, inverse = np.unique(np.array(genres, dtype=object), return_inverse=True)
+            movie_ids = np.array(movie_ids, dtype=np.int64)
+            for i, name in enumerate(names):
+                genre_ids[name] = np.unique(movie_ids[inverse == i])
+        return cls(all_ids, genre_ids, cls.database_stamp(db))
+
+    @classmethod
+    def load_cached(cls, db, path=SNAPSHOT_PATH):
+        # index from the snapshot if it is still current, otherwise from the database ( and a new snapshot )
+        stamp = cls.database_stamp(db)
+        try:
+            with np.load(path) as snapshot:
+                if int(snapshot['stamp']) == stamp and str(snapshot['source']) == str(db.engine.url):
+                    ids = np.split(snapshot['genre_movie_ids'], snapshot['offsets'][1:-1])
+                    return cls(snapshot['all_ids'], dict(zip(snapshot['genres'].tolist(), ids)), stamp)
+        except (OSError, KeyError, ValueError):
+            pass
+        index = cls.load(db)
+        index.save(str(db.engine.url), path)
+        return index
+
+    def save(self, source, path=SNAPSHOT_PATH):
+        # source: the database the index was loaded from
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        arrays = list(self.genre_ids.values())
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(a) for a in arrays], out=offsets[1:])
+        tmp = f'{path}.{os.getpid()}.tmp.npz'  # workers may write at the same time, the rename is atomic
+        np.savez(tmp, source=np.array(source), stamp=np.int64(self.stamp), all_ids=self.all_ids, genres=np.array(list(self.genre_ids), dtype=str),
+                 offsets=offsets, genre_movie_ids=np.concatenate(arrays) if arrays else np.empty(0, dtype=np.int64))
+        os.replace(tmp, path)
+
+    @staticmethod
+    def database_stamp(db):
+        # the catalogue version, bumped by triggers on every change of movies or genres
+        return catalogue_version(db)
+
+    def refresh_if_changed(self, db, path=SNAPSHOT_PATH):
+        # reloads the index when another process ( e.g. flask loaddata ) added movies, returns the current index
+        if time.monotonic() - self.checked < REFRESH_SECONDS:
+            return self
+        self.checked = time.monotonic()
+        if self.database_stamp(db) == self.stamp:
+            return self
+        return GenreIndex.load_cached(db, path)
+
+    @property
+    def genres(self):
+        return list(self.genre_ids)
+
+    def movie_ids(self, genres=None, mode='any'):
+        # sorted movie ids with any ( union ) or all ( intersection ) of the genres, all movies without genres
+        if not genres:
+            return self.all_ids
+        arrays = [self.genre_ids.get(genre, np.empty(0, dtype=np.int64)) for genre in genres]
+        if mode == 'all':
+            return reduce(lambda a, b: np.intersect1d(a, b, assume_unique=True), arrays)
+        return reduce(np.union1d, arrays)
+
+
+class KeysetPage:
+    # one page of a sorted id list, next_cursor / prev_cursor continue after the last / before the first id
+    def __init__(self, ids, has_prev, has_next, page=1):
+        self.ids = [int(movie_id) for movie_id in ids]
+        self.items = []
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.page = page
+        self.next_cursor = self.ids[-1] if self.ids else None
+        self.prev_cursor = self.ids[0] if self.ids else None
+
+
+def keyset_page(ids, per_page, after=None, before=None, page=1):
+    # page of the sorted ids after ( or before ) a cursor, without one page counts from the start
+    # ( links from before the cursors )
+    if before is not None:
+        end = int(np.searchsorted(ids, before, side='left'))
+        start = max(end - per_page, 0)
+    else:
+        start = int(np.searchsorted(ids, after, side='right')) if after is not None else (max(page, 1) - 1) * per_page
+        end = start + per_page
+    return KeysetPage(ids[start:end], start > 0, end < len(ids), max(page, 1))
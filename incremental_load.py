@@ -0,0 +1,273 @@
+import csv
+import hashlib
+import io
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import select
+
+from jobs import JobProgress
+from models import Movie, MovieGenre, Ratings, Tags, Link, User, LoadCheckpoint
+from read_data import (logger, bulk_connection, parse_movie_row, nocase_key, log_rate,
+                       DEFAULT_USER_PASSWORD)
+from tag_interner import TagInterner
+
+# Incremental loader ( flask loaddata )
+# - every file is read in blocks of whole lines, the blocks are parsed and converted in a process pool
+# - the main process is the only writer, it inserts a block and moves the checkpoint in the same transaction
+# - the checkpoint stores the byte offset and the sha1 of everything before it. If the file still starts
+#   with the same bytes we continue at the offset, otherwise ( e.g. a newer MovieLens release ) the whole
+#   file is read again and only rows that are not in the database yet are inserted
+
+block_size = 4 * 1024 * 1024  # bytes per block handed to a worker
+
+# a crash in the middle of a block must not corrupt the database, so keep the journal
+RESUMABLE_LOAD_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'temp_store': 'MEMORY',
+    'cache_size': '-200000',
+}
+
+
+# --- conversion, runs in the worker processes -------------------------------
+
+def parse_block(data):
+    # csv rows of a block of whole lines
+    return list(csv.reader(io.StringIO(data.decode('utf8'), newline='')))
+
+def convert_movies(data):
+    rows = []
+    for row in parse_block(data):
+        id, original_title, title, year, genres = parse_movie_row(row)
+        rows.append((int(id), original_title, title, int(year) if year else 0, genres))
+    return rows
+
+def convert_ratings(data):
+    return [(int(row[0]), int(row[1]), float(row[2]), datetime.fromtimestamp(int(row[3])))
+            for row in parse_block(data)]
+
+def convert_tags(data):
+    return [(int(row[0]), int(row[1]), row[2], datetime.fromtimestamp(int(row[3])))
+            for row in parse_block(data)]
+
+def convert_links(data):
+    return [{'movie_id': int(row[0]),
+             'ml_url': f"https://movielens.org/movies/{row[0]}",
+             'imdb_url': f"https://www.imdb.com/title/tt{row[1]}",
+             'tmdb_url': f"https://www.themoviedb.org/movie/{row[2]}"}
+            for row in parse_block(data)]
+
+
+# --- reading ------------------------------------------------------------------
+
+def file_prefix_checksum(filename, offset):
+    # sha1 object over the first offset bytes of the file
+    checksum = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        remaining = offset
+        while remaining > 0:
+            data = f.read(min(block_size, remaining))
+            if not data:
+                break
+            checksum.update(data)
+            remaining -= len(data)
+    return checksum
+
+def read_blocks(f, offset):
+    # (end offset, bytes) of consecutive blocks of whole lines starting at offset
+    f.seek(offset)
+    while True:
+        data = f.read(block_size)
+        if not data:
+            return
+        data += f.readline()  # finish the last line
+        offset += len(data)
+        yield offset, data
+
+def ordered_map(executor, fn, items, window):
+    # like executor.map, but only keeps window items in flight so big files are not read into memory at once
+    pending = deque()
+    for item in items:
+        pending.append((item, executor.submit(fn, item[1])))
+        if len(pending) >= window:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+# --- writing ------------------------------------------------------------------
+
+def contains(sorted_keys, keys):
+    # which of the keys are in the sorted array
+    positions = np.searchsorted(sorted_keys, keys)
+    found = positions < len(sorted_keys)
+    found[found] = sorted_keys[positions[found]] == keys[found]
+    return found
+
+
+class IncrementalLoader:
+    def __init__(self, db, data_dir='data', workers=None):
+        self.db = db
+        self.data_dir = data_dir
+        self.workers = workers or os.cpu_count() or 1
+
+    def run(self):
+        with bulk_connection(self.db, RESUMABLE_LOAD_PRAGMAS) as conn, \
+                ProcessPoolExecutor(max_workers=self.workers) as executor:
+            self.conn = conn
+            self.executor = executor
+            self.known_users = set(self.conn.execute(select(User.id)).scalars())
+            self.new_user_count = 0
+            self.load_file('movies.csv', convert_movies, self.movies_writer())
+            self.load_file('ratings.csv', convert_ratings, self.ratings_writer())
+            self.load_file('tags.csv', convert_tags, self.tags_writer())
+            self.load_file('links.csv', convert_links, self.links_writer())
+        logger.info(f"Incremental load: added {self.new_user_count} users to the database.")
+
+    def load_file(self, name, convert, write):
+        filename = os.path.join(self.data_dir, name)
+        if not os.path.exists(filename):
+            logger.info(f"Incremental load: {filename} not found, skipped")
+            return
+        started = time.perf_counter()
+        checkpoint = self.conn.execute(select(LoadCheckpoint.__table__).where(LoadCheckpoint.filename == name)).first()
+        size = os.path.getsize(filename)
+        offset, rows = 0, 0
+        checksum = hashlib.sha1()
+        if checkpoint is not None:
+            prefix = file_prefix_checksum(filename, checkpoint.offset) if checkpoint.offset <= size else None
+            if prefix is not None and prefix.hexdigest() == checkpoint.checksum:
+                offset, rows, checksum = checkpoint.offset, checkpoint.rows, prefix
+            else:
+                logger.info(f"Incremental load: {name} changed since the last load, reading it again")
+
+        with open(filename, 'rb') as f:
+            if offset == 0:
+                header = f.readline()  # skip the header row
+                checksum.update(header)
+                offset = len(header)
+            added = 0
+            progress = JobProgress(total=size, initial=offset, desc=name, unit='B', unit_scale=True)
+            blocks = read_blocks(f, offset)
+            for (end, data), converted in ordered_map(self.executor, convert, blocks, self.workers * 2):
+                added += write(converted)
+                checksum.update(data)
+                rows += len(converted)
+                self.save_checkpoint(name, end, checksum.hexdigest(), rows)
+                self.conn.commit()  # rows of the block and the checkpoint together
+                progress.update(end - offset)
+                offset = end
+            progress.close()
+        log_rate(f"{name} (incremental)", added, started)
+        logger.info(f"{name}: {rows} rows read in total, {added} new rows added.")
+
+    def save_checkpoint(self, name, offset, checksum, rows):
+        table = LoadCheckpoint.__table__
+        values = {'offset': offset, 'checksum': checksum, 'rows': rows, 'updated_at': datetime.now()}
+        result = self.conn.execute(table.update().where(table.c.filename == name).values(**values))
+        if result.rowcount == 0:
+            self.conn.execute(table.insert().values(filename=name, **values))
+
+    def add_users(self, user_ids):
+        new = [user_id for user_id in set(user_ids) if user_id not in self.known_users]
+        if new:
+            self.known_users.update(new)
+            self.conn.execute(User.__table__.insert(), [
+                {'id': user_id, 'username': f'user_{user_id}', 'password': DEFAULT_USER_PASSWORD}
+                for user_id in new])
+            self.new_user_count += len(new)
+
+    # each writer returns a function that inserts the new rows of one converted block
+
+    def movies_writer(self):
+        ids = set(self.conn.execute(select(Movie.id)).scalars())
+        titles = {nocase_key(title) for title in self.conn.execute(select(Movie.title)).scalars()}
+
+        def write(rows):
+            movies, genres = [], []
+            for id, original_title, title, year, movie_genres in rows:
+                title_key = nocase_key(original_title)
+                if id in ids or title_key in titles:
+                    continue
+                ids.add(id)
+                titles.add(title_key)
+                movies.append({'id': id, 'title': original_title, 'title_stripped': title, 'year': year})
+                genres.extend({'movie_id': id, 'genre': genre} for genre in movie_genres)
+            if movies:
+                self.conn.execute(Movie.__table__.insert(), movies)
+                self.conn.execute(MovieGenre.__table__.insert(), genres)
+            return len(movies)
+        return write
+
+    def ratings_writer(self):
+        # (user_id, movie_id) pairs already stored, as sorted int64 keys so 25M of them stay small. The pairs
+        # inserted by this load are kept in a few more sorted arrays of falling size, two of about the same size
+        # are merged, so a block is checked against O(log blocks) arrays and the big one is never copied
+        pairs = np.fromiter((user_id << 32 | movie_id for user_id, movie_id in
+                             self.conn.execute(select(Ratings.user_id, Ratings.movie_id))), dtype=np.int64)
+        pairs.sort()
+        inserted = []
+
+        def write(rows):
+            if not rows:
+                return 0
+            keys = np.fromiter((row[0] << 32 | row[1] for row in rows), dtype=np.int64, count=len(rows))
+            # first row of every pair in the block ( a pair twice in the file would hit the unique index )
+            keys, first = np.unique(keys, return_index=True)
+            stored = np.zeros(len(keys), dtype=bool)
+            for known in [pairs] + inserted:
+                stored |= contains(known, keys)
+            new = first[~stored]
+            rows = [rows[i] for i in np.sort(new)]
+            if rows:
+                self.conn.execute(Ratings.__table__.insert(), [
+                    {'user_id': user_id, 'movie_id': movie_id, 'rating': rating, 'timestamp': timestamp}
+                    for user_id, movie_id, rating, timestamp in rows])
+                self.add_users(row[0] for row in rows)
+                inserted.append(keys[~stored])  # sorted, np.unique sorts
+                while len(inserted) > 1 and len(inserted[-2]) <= 2 * len(inserted[-1]):
+                    last = inserted.pop()
+                    inserted[-1] = np.sort(np.concatenate((inserted[-1], last)), kind='stable')
+            return len(rows)
+        return write
+
+    def tags_writer(self):
+        interner = TagInterner().load(self.conn)
+        existing = set(self.conn.execute(select(Tags.user_id, Tags.movie_id, Tags.tag_name_id)).tuples())
+
+        def write(rows):
+            tags = []
+            for user_id, movie_id, tag_name, timestamp in rows:
+                tag_name_id = interner.intern(tag_name)
+                if (user_id, movie_id, tag_name_id) in existing:
+                    continue
+                existing.add((user_id, movie_id, tag_name_id))
+                tags.append({'user_id': user_id, 'movie_id': movie_id, 'tag_name_id': tag_name_id,
+                             'timestamp': timestamp})
+            interner.flush(self.conn)
+            if tags:
+                self.conn.execute(Tags.__table__.insert(), tags)
+                self.add_users(tag['user_id'] for tag in tags)
+            return len(tags)
+        return write
+
+    def links_writer(self):
+        movie_ids = set(self.conn.execute(select(Link.movie_id)).scalars())
+
+        def write(rows):
+            links = [row for row in rows if row['movie_id'] not in movie_ids]
+            movie_ids.update(row['movie_id'] for row in links)
+            if links:
+                self.conn.execute(Link.__table__.insert(), links)
+            return len(links)
+        return write
+
+
+def incremental_read_data(db, data_dir='data', workers=None):
+    IncrementalLoader(db, data_dir, workers).run()
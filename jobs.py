@@ -0,0 +1,348 @@
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from datetime import datetime
+
+from sqlalchemy import insert, select, update
+from tqdm import tqdm
+
+from metrics import timed_job
+from models import Job
+
+# Background jobs: ingest, rating matrix, training, recommendation precompute and content features
+# - the queue is the jobs table in a SQLite database of its own ( the 'jobs' bind ), so the progress
+#   reports of a running job never wait for ( or hold ) the write lock of the main database, e.g. while a
+#   bulk load has it for minutes
+# - `flask jobs worker` is a separate process that claims queued jobs ( one UPDATE ... RETURNING, two
+#   workers never get the same job ) and runs every job in a child process of its own, up to concurrency
+#   at a time. A retrain never shares a process ( or the GIL ) with the web workers and its memory is
+#   returned when it ends.
+# - a job reports progress with JobProgress ( the tqdm of the loaders ) or JobRun.report, the reports also
+#   pick up a cancellation and raise JobCancelled. A running job that doesn't report within
+#   CANCEL_GRACE_SECONDS after the cancellation is terminated by the worker.
+# - jobs are enqueued with `flask jobs enqueue` or POST /jobs ( with JOBS_API_TOKEN ), e.g. a nightly
+#   `rebuild` from cron, the web workers only insert and read rows of the job database
+
+logger = logging.getLogger('api_flask.jobs')  # goes to the api_flask log
+
+QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED = 'queued', 'running', 'succeeded', 'failed', 'cancelled'
+UNFINISHED = (QUEUED, RUNNING)
+BIND = 'jobs'
+PROGRESS_SECONDS = 1.0  # how often a job writes its progress ( and checks for a cancellation )
+POLL_SECONDS = 1.0  # how often the worker looks for new jobs
+CANCEL_GRACE_SECONDS = 30  # time a cancelled job gets to stop on its own
+
+jobs = Job.__table__
+JOB_TYPES = {}  # name -> function(db, job, **params)
+current_job = None  # JobRun of the job running in this process
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def job_type(name):
+    def register(function):
+        JOB_TYPES[name] = function
+        return function
+    return register
+
+
+_ready = set()
+
+def job_engine(db):
+    # engine of the job database, the table is created on first use
+    engine = db.engines[BIND]
+    if engine not in _ready:
+        jobs.create(engine, checkfirst=True)
+        _ready.add(engine)
+    return engine
+
+
+def worker_name(pid=None):
+    return f'{socket.gethostname()}:{pid or os.getpid()}'
+
+
+def to_dict(row):
+    job = row._asdict()
+    job['params'] = json.loads(job['params'])
+    for name in ('created_at', 'run_after', 'started_at', 'finished_at', 'updated_at'):
+        job[name] = job[name].isoformat(timespec='seconds') if job[name] else None
+    return job
+
+
+def enqueue(db, type, params=None, run_after=None, unique=True):
+    # queues a job and returns it, unique: a queued or running job of the same type and params is returned
+    # instead, so a nightly schedule doesn't pile up runs behind a slow one
+    if type not in JOB_TYPES:
+        raise ValueError(f'unknown job type {type}, one of {", ".join(sorted(JOB_TYPES))}')
+    params = json.dumps(params or {}, sort_keys=True)
+    now = datetime.now()
+    with job_engine(db).begin() as conn:
+        if unique:
+            row = conn.execute(select(jobs).where(jobs.c.type == type, jobs.c.params == params,
+                                                  jobs.c.status.in_(UNFINISHED))).first()
+            if row is not None:
+                return to_dict(row)
+        row = conn.execute(insert(jobs).values(
+            type=type, params=params, status=QUEUED, message='', cancel_requested=False, created_at=now,
+            run_after=run_after or now).returning(*jobs.c)).one()
+    logger.info(f"queued job {row.id} {type} {params}")
+    return to_dict(row)
+
+
+def get_job(db, job_id):
+    with job_engine(db).connect() as conn:
+        row = conn.execute(select(jobs).where(jobs.c.id == job_id)).first()
+    return to_dict(row) if row is not None else None
+
+
+def list_jobs(db, status=None, limit=50):
+    # newest first
+    query = select(jobs).order_by(jobs.c.id.desc()).limit(limit)
+    if status:
+        query = query.where(jobs.c.status == status)
+    with job_engine(db).connect() as conn:
+        return [to_dict(row) for row in conn.execute(query)]
+
+
+def cancel(db, job_id):
+    # a queued job is cancelled right away, a running one when it next reports ( or is terminated )
+    now = datetime.now()
+    with job_engine(db).begin() as conn:
+        conn.execute(update(jobs).where(jobs.c.id == job_id, jobs.c.status == QUEUED).values(
+            status=CANCELLED, cancel_requested=True, finished_at=now, updated_at=now))
+        conn.execute(update(jobs).where(jobs.c.id == job_id, jobs.c.status == RUNNING).values(
+            cancel_requested=True, updated_at=now))
+    return get_job(db, job_id)
+
+
+def claim(db, worker):
+    # the next due job, marked as running by this worker, None when there is none
+    now = datetime.now()
+    next_job = select(jobs.c.id).where(jobs.c.status == QUEUED, jobs.c.run_after <= now) \
+        .order_by(jobs.c.run_after, jobs.c.id).limit(1).scalar_subquery()
+    with job_engine(db).begin() as conn:
+        row = conn.execute(update(jobs).where(jobs.c.id == next_job, jobs.c.status == QUEUED).values(
+            status=RUNNING, worker=worker, started_at=now, updated_at=now).returning(*jobs.c)).first()
+    return to_dict(row) if row is not None else None
+
+
+def finish(db, job_id, status, error=None):
+    # only a running job, the worker may have finished it already ( terminated after a cancellation )
+    now = datetime.now()
+    values = {'status': status, 'error': error, 'finished_at': now, 'updated_at': now}
+    if status == SUCCEEDED:
+        values['progress'] = 1.0
+    with job_engine(db).begin() as conn:
+        conn.execute(update(jobs).where(jobs.c.id == job_id, jobs.c.status == RUNNING).values(**values))
+
+
+class JobRun:
+    # the job running in this process: progress reports and the cancellation check
+    def __init__(self, db, job_id):
+        self.engine = job_engine(db)
+        self.id = job_id
+        self.reported = 0.0
+        self.step_name = ''
+        self.span = (0.0, 1.0)  # part of the whole job the current step covers
+
+    def step(self, name, start=0.0, end=1.0):
+        # a step of a job made of several, its progress maps onto start..end of the job
+        self.step_name = name
+        self.span = (start, end)
+        self.report(0, 1, force=True)
+
+    def report(self, done=None, total=None, message=None, force=False):
+        # writes the progress at most every PROGRESS_SECONDS, raises JobCancelled when the job was cancelled
+        now = time.monotonic()
+        if not force and now - self.reported < PROGRESS_SECONDS and not (total and done >= total):
+            return
+        self.reported = now
+        values = {'updated_at': datetime.now()}
+        if total:
+            start, end = self.span
+            values['progress'] = start + (end - start) * min(done / total, 1.0)
+        if message is not None or self.step_name:
+            values['message'] = ': '.join(part for part in (self.step_name, message) if part)[:255]
+        with self.engine.begin() as conn:
+            cancelled = conn.execute(update(jobs).where(jobs.c.id == self.id).values(**values)
+                                     .returning(jobs.c.cancel_requested)).scalar()
+        if cancelled:
+            raise JobCancelled()
+
+
+class JobProgress(tqdm):
+    # tqdm that also reports to the job running in this process ( if any ), the data loaders use it
+    def display(self, msg=None, pos=None):
+        if current_job is not None:
+            current_job.report(self.n, self.total, f'{self.desc} {self.n:.0f}/{self.total or "?"}'.strip())
+        return super().display(msg, pos)
+
+
+def run_job(db, job):
+    # runs a claimed job in this process and records how it ended
+    global current_job
+    current_job = run = JobRun(db, job['id'])
+    with run.engine.begin() as conn:
+        conn.execute(update(jobs).where(jobs.c.id == job['id']).values(worker=worker_name()))
+    status, error = FAILED, None
+    try:
+        with timed_job(f"job-{job['type']}", persist=True):
+            JOB_TYPES[job['type']](db, run, **job['params'])
+        status = SUCCEEDED
+    except JobCancelled:
+        status = CANCELLED
+    except Exception:
+        error = traceback.format_exc()
+        logger.exception(f"job {job['id']} {job['type']} failed")
+    finally:
+        current_job = None
+        finish(db, job['id'], status, error)
+    logger.info(f"job {job['id']} {job['type']}: {status}")
+    return status
+
+
+def run_in_process(job, config):
+    # target of the child process of a job, with an app of its own
+    from models import db
+    from recommender import create_app
+    app = create_app(config)
+    with app.app_context():
+        run_job(db, job)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def fail_orphans(db):
+    # jobs left running by processes of this host that are gone ( a killed worker )
+    host = socket.gethostname()
+    with job_engine(db).connect() as conn:
+        running = conn.execute(select(jobs.c.id, jobs.c.worker).where(jobs.c.status == RUNNING)).all()
+    for job_id, worker in running:
+        worker_host, _, pid = (worker or '').rpartition(':')
+        if worker_host == host and pid.isdigit() and not process_alive(int(pid)):
+            finish(db, job_id, FAILED, f'worker process {pid} is gone')
+            logger.warning(f"job {job_id} failed, its worker process {pid} is gone")
+
+
+def cancel_requested(db, job_ids):
+    with job_engine(db).connect() as conn:
+        return set(conn.execute(select(jobs.c.id).where(jobs.c.id.in_(job_ids), jobs.c.cancel_requested)).scalars())
+
+
+def requeue(db, job_id):
+    with job_engine(db).begin() as conn:
+        conn.execute(update(jobs).where(jobs.c.id == job_id, jobs.c.status == RUNNING).values(
+            status=QUEUED, worker=None, started_at=None, progress=None, message='requeued after a worker stop',
+            updated_at=datetime.now()))
+
+
+def work(app, db, concurrency=1, poll_seconds=POLL_SECONDS, once=False):
+    # claims and runs jobs until stopped, every job in a new process ( spawned, nothing of this process
+    # such as open database connections is inherited ). once: stop when the queue is empty.
+    # Jobs still running when the worker is stopped are terminated and queued again.
+    context = multiprocessing.get_context('spawn')
+    config = {name: app.config[name] for name in ('SQLALCHEMY_DATABASE_URI', 'SQLALCHEMY_BINDS')}
+    name = worker_name()
+    running = {}  # job id -> [process, job, when the cancellation was seen]
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    fail_orphans(db)
+    logger.info(f"job worker {name} started, concurrency {concurrency}")
+    try:
+        while True:
+            for job_id, (process, job, _) in list(running.items()):
+                if not process.is_alive():
+                    process.join()
+                    del running[job_id]
+                    if process.exitcode:  # died without recording the end, e.g. killed by the OOM killer
+                        finish(db, job_id, FAILED, f'job process exited with code {process.exitcode}')
+            for job_id in cancel_requested(db, list(running)) if running else ():
+                entry = running[job_id]
+                entry[2] = entry[2] or time.monotonic()
+                if time.monotonic() - entry[2] > CANCEL_GRACE_SECONDS and entry[0].is_alive():
+                    logger.warning(f"terminating job {job_id}, it didn't stop after the cancellation")
+                    entry[0].terminate()
+                    finish(db, job_id, CANCELLED)
+            while len(running) < concurrency:
+                job = claim(db, name)
+                if job is None:
+                    break
+                process = context.Process(target=run_in_process, args=(job, config), name=f"job-{job['id']}")
+                process.start()
+                running[job['id']] = [process, job, None]
+                logger.info(f"job {job['id']} {job['type']} started in process {process.pid}")
+            if once and not running:
+                return
+            time.sleep(poll_seconds)
+    finally:
+        for job_id, (process, job, _) in running.items():
+            process.terminate()
+            process.join()
+            requeue(db, job_id)
+
+
+@job_type('ingest')
+def ingest_job(db, job, data_dir='data', workers=None):
+    # new rows of the data files ( flask loaddata )
+    import incremental_load
+    incremental_load.incremental_read_data(db, data_dir=data_dir, workers=workers)
+
+
+@job_type('rating-matrix')
+def rating_matrix_job(db, job, full=False):
+    # ratings snapshot and the cached rating matrix
+    import ratings_snapshot
+    from rating_matrix import get_rating_matrix
+    ratings_snapshot.export(db, full=full)
+    job.report(1, 2, 'snapshot exported', force=True)
+    get_rating_matrix(db)
+
+
+@job_type('train')
+def train_job(db, job, factors=64, regularization=0.05, iterations=10, implicit=True, alpha=10.0, workers=None):
+    import model_based
+    model_based.train(db, factors=factors, regularization=regularization, iterations=iterations,
+                      implicit=implicit, alpha=alpha, workers=workers,
+                      callback=lambda iteration, *_: job.report(iteration, iterations,
+                                                                f'iteration {iteration}/{iterations}'))
+
+
+@job_type('recommend')
+def recommend_job(db, job, top_n=50, block_size=1024, content_weight=0.0, content_k=50, publish=True):
+    import recommendations
+    recommendations.precompute(db, n=top_n, block_size=block_size, content_weight=content_weight,
+                               content_k=content_k, publish=publish,
+                               callback=lambda done, total: job.report(done, total, f'{done}/{total} users'))
+
+
+@job_type('content-features')
+def content_features_job(db, job, full=False):
+    # TF-IDF genre and tag features, queued by new tags
+    import content_features
+    content_features.build(db, full=full)
+
+
+@job_type('rebuild')
+def rebuild_job(db, job, **train_params):
+    # the nightly rebuild: rating matrix, training, recommendations of the new model
+    job.step('rating matrix', 0.0, 0.1)
+    rating_matrix_job(db, job)
+    job.step('train', 0.1, 0.8)
+    train_job(db, job, **train_params)
+    job.step('recommend', 0.8, 1.0)
+    recommend_job(db, job)
@@ -0,0 +1,259 @@
+import bisect
+import hmac
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter as StatementCounter, deque
+from contextlib import contextmanager
+
+from flask import abort, g, has_request_context, request
+from sqlalchemy import event
+
+# Per worker metrics in the Prometheus text format ( GET /metrics )
+# - latency histogram and p50 / p95 / p99 of the last requests per route
+# - SQL statements and SQL time per request from the engine events, a request that runs the same statement
+#   more than N_PLUS_ONE_THRESHOLD times is logged and counted as an N+1 pattern
+# - job durations: jobs in the worker ( fold-in ) are kept in memory, the flask commands ( training,
+#   loading ... ) run in their own process and write their last run to JOB_METRICS_PATH
+# - page cache hits and misses ( page_cache.py )
+# - PROFILE_SAMPLE_RATE of the requests run under cProfile, the profile is kept when the request
+#   took longer than PROFILE_SLOW_SECONDS
+# Every gunicorn worker keeps and exports its own numbers. /metrics wants the bearer token of the /jobs
+# endpoints ( JOBS_API_TOKEN ), scrapes from localhost need none unless METRICS_LOCALHOST is False.
+
+logger = logging.getLogger('api_flask.metrics')  # goes to the api_flask log
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+WINDOW = 1024  # requests per route used for the quantiles
+QUANTILES = (0.5, 0.95, 0.99)
+JOB_METRICS_PATH = os.path.join('logs', 'job_metrics.json')
+
+
+def format_labels(labels):
+    return '{' + ','.join(f'{name}="{str(value)}"' for name, value in labels) + '}' if labels else ''
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        lines += [f'{self.name}{format_labels(key)} {value}' for key, value in sorted(self.values.items())]
+        return lines
+
+
+class Histogram:
+    # cumulative buckets for Prometheus plus a window of recent values for the quantiles
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}  # labels -> [bucket counts, sum, count, window]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0, deque(maxlen=WINDOW)]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+            series[3].append(value)
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        quantile_lines = []
+        with self.lock:
+            for key, (counts, total, count, window) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    lines.append(f'{self.name}_bucket{format_labels(key + (("le", bound),))} {cumulative}')
+                lines.append(f'{self.name}_bucket{format_labels(key + (("le", "+Inf"),))} {count}')
+                lines.append(f'{self.name}_sum{format_labels(key)} {total}')
+                lines.append(f'{self.name}_count{format_labels(key)} {count}')
+                values = sorted(window)
+                for q in QUANTILES:
+                    value = values[min(int(q * len(values)), len(values) - 1)]
+                    quantile_lines.append(f'{self.name}_recent{format_labels(key + (("quantile", q),))} {value}')
+        # quantiles of the last WINDOW observations, a gauge because a histogram has no quantiles
+        return lines + [f'# HELP {self.name}_recent {self.help}, quantiles of the last {WINDOW}',
+                        f'# TYPE {self.name}_recent gauge'] + quantile_lines
+
+
+class Registry:
+    def __init__(self):
+        self.requests = Counter('http_requests_total', 'Requests by route, method and status')
+        self.latency = Histogram('http_request_duration_seconds', 'Request latency by route')
+        self.sql_statements = Counter('sql_statements_total', 'SQL statements run by requests of a route')
+        self.sql_seconds = Counter('sql_seconds_total', 'Time spent in SQL by requests of a route')
+        self.sql_per_request = Histogram('sql_statements_per_request', 'SQL statements per request by route',
+                                         buckets=(1, 2, 3, 5, 10, 20, 50, 100, 200, 500))
+        self.n_plus_one = Counter('sql_n_plus_one_total', 'Requests that repeated one statement too often')
+        self.jobs = Histogram('job_duration_seconds', 'Duration of jobs run in this worker')
+        self.job_runs = Counter('job_runs_total', 'Jobs run in this worker by status')
+        self.profiles = Counter('profiles_written_total', 'cProfile dumps of slow requests')
+        self.page_cache = Counter('page_cache_lookups_total', 'Movie list lookups in the page cache by result')
+
+    def expose(self):
+        lines = []
+        for metric in (self.requests, self.latency, self.sql_statements, self.sql_seconds, self.sql_per_request,
+                       self.n_plus_one, self.jobs, self.job_runs, self.profiles, self.page_cache):
+            lines += metric.expose()
+        lines += expose_job_file()
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def install_sql_metrics(engine):
+    # counts the statements and their time for the request that runs them
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'sql_count' in g:
+            conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'sql_count' in g and conn.info.get('query_started'):
+            g.sql_seconds += time.perf_counter() - conn.info['query_started'].pop()
+            g.sql_count += 1
+            g.sql_statements[statement] += 1
+
+
+def init_app(app):
+    app.config.setdefault('N_PLUS_ONE_THRESHOLD', 10)
+    app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+    app.config.setdefault('PROFILE_SLOW_SECONDS', 0.5)
+    app.config.setdefault('PROFILE_DIR', 'profiles')
+    app.config.setdefault('METRICS_LOCALHOST', True)
+    app.config.setdefault('JOBS_API_TOKEN', None)
+
+    @app.before_request
+    def start_request_metrics():
+        g.start = time.perf_counter()
+        g.sql_count = 0
+        g.sql_seconds = 0.0
+        g.sql_statements = StatementCounter()
+        if app.config['PROFILE_SAMPLE_RATE'] and random.random() < app.config['PROFILE_SAMPLE_RATE']:
+            import cProfile  # only with profiling on, not part of the startup
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def remember_status(response):
+        g.status = response.status_code
+        return response
+
+    @app.teardown_request
+    def record_request_metrics(exc=None):
+        # teardown runs for every request, also when the view raised and no response went through after_request
+        if 'start' not in g:
+            return
+        seconds = time.perf_counter() - g.start
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        status = g.get('status', 500)  # no response: an unhandled exception
+        registry.requests.inc(route=route, method=request.method, status=status)
+        registry.latency.observe(seconds, route=route)
+        registry.sql_statements.inc(g.sql_count, route=route)
+        registry.sql_seconds.inc(g.sql_seconds, route=route)
+        registry.sql_per_request.observe(g.sql_count, route=route)
+        statement, repeats = (g.sql_statements.most_common(1) or [(None, 0)])[0]
+        if repeats > app.config['N_PLUS_ONE_THRESHOLD']:
+            registry.n_plus_one.inc(route=route)
+            logger.warning(f"possible N+1 in {request.method} {route}: {repeats}x {statement.splitlines()[0][:200]}")
+        if profiler is not None and seconds >= app.config['PROFILE_SLOW_SECONDS']:
+            dump_profile(profiler, app.config['PROFILE_DIR'], request.endpoint, seconds)
+
+    @app.route('/metrics')
+    def metrics():
+        check_metrics_access(app.config)
+        return registry.expose(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+def check_metrics_access(config):
+    # the route names, SQL and job numbers are not for everyone: localhost or the /jobs token, 404 without both.
+    # A request forwarded by a proxy on localhost is not local
+    if config['METRICS_LOCALHOST'] and request.remote_addr in ('127.0.0.1', '::1') \
+            and 'X-Forwarded-For' not in request.headers:
+        return
+    token = config['JOBS_API_TOKEN']
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(401)
+
+
+def dump_profile(profiler, profile_dir, endpoint, seconds):
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{seconds * 1000:.0f}ms.prof")
+    profiler.dump_stats(path)
+    registry.profiles.inc(endpoint=endpoint)
+    logger.info(f"slow request profile: {path}")
+
+
+@contextmanager
+def timed_job(name, persist=False):
+    # times a job, persist: also write the last run to JOB_METRICS_PATH ( for the flask commands )
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        yield
+        status = 'success'
+    finally:
+        seconds = time.perf_counter() - started
+        registry.jobs.observe(seconds, job=name)
+        registry.job_runs.inc(job=name, status=status)
+        if persist:
+            record_job(name, seconds, status)
+
+
+def record_job(name, seconds, status, path=JOB_METRICS_PATH):
+    try:
+        with open(path) as f:
+            jobs = json.load(f)
+    except (OSError, ValueError):
+        jobs = {}
+    jobs[name] = {'seconds': seconds, 'status': status, 'finished': time.time()}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(jobs, f)
+    os.replace(tmp, path)
+
+
+def expose_job_file(path=JOB_METRICS_PATH):
+    try:
+        with open(path) as f:
+            jobs = json.load(f)
+    except (OSError, ValueError):
+        return []
+    lines = ['# HELP job_last_duration_seconds Duration of the last run of a flask command',
+             '# TYPE job_last_duration_seconds gauge']
+    lines += [f'job_last_duration_seconds{{job="{name}",status="{job["status"]}"}} {job["seconds"]}'
+              for name, job in sorted(jobs.items())]
+    lines += ['# HELP job_last_finished_timestamp_seconds When the last run of a flask command finished',
+              '# TYPE job_last_finished_timestamp_seconds gauge']
+    lines += [f'job_last_finished_timestamp_seconds{{job="{name}"}} {job["finished"]}'
+              for name, job in sorted(jobs.items())]
+    return lines
@@ -1,47 +1,56 @@
-import numpy as np
+import time
 
-
-from sqlalchemy.exc import IntegrityError
-from models import Movie, Ratings, User
-
-import tensorflow as tf
+from models import Movie, User
+from rating_matrix import get_rating_matrix
+from ratings_snapshot import export
+from als import train_als, ARTIFACT_DIR
 
 
 def test(db):
     print(f"User count {User.query.count()}")
     print(f"Movie count {Movie.query.count()}")
-    print(f"Ratings count {Ratings.query.count()}")
-
-    # mapping from movie_id to index
-    movie_to_index = {}
-    for i, movie in enumerate(Movie.query.all()):
-        movie_to_index[movie.id] = i
-
-    R = np.zeros((User.query.count(), Movie.query.count()))
-    counter = 0
-
-    for rating in Ratings.query.all():
-        #R[rating.user_id - 1, rating.movie_id - 1] = rating.rating
-        try:
-            R[rating.user_id - 1, movie_to_index[rating.movie_id]] = rating.rating
-            counter += 1
-        except KeyError as e:
-            print(f"KeyError: Movie {rating.movie_id} does not exist")
-            print(f"Exception: {e}")
-        except IndexError as e:
-            print(f"IndexError: User {rating.user_id} or Movie {rating.movie_id} does not exist")
-            print(f"Exception: {e}")
-
-    print(f"{counter} added")
+
+    # sparse users x movies matrix, cached on disk until the ratings table changes, built from the
+    # columnar snapshot of the ratings
+    ratings = get_rating_matrix(db)
+    snapshot = export(db)  # only appends what changed since the last export
+    print(f"Ratings count {snapshot.manifest['rating_count']} ({snapshot.rows} rows in snapshot "
+          f"{snapshot.manifest['generation']})")
+    R = ratings.matrix
+
+    print(f"{R.nnz} added")
 
     # print first 10 rows and columns
     print(R.shape)
-    print(R[:10, :10])
+    print(R[:10, :10].toarray())
 
     # print how many ratings are 0 and how many are not
-    print(f"Number of ratings: {np.count_nonzero(R)}")
-    print(f"Number of missing ratings: {np.count_nonzero(R == 0)}")
+    size = R.shape[0] * R.shape[1]
+    print(f"Number of ratings: {R.nnz}")
+    print(f"Number of missing ratings: {size - R.nnz}")
 
     # how many percent are filled
-    print(f"Percent filled: {np.count_nonzero(R) / R.size * 100}%")
-
+    print(f"Percent filled: {R.nnz / size * 100}%")
+
+
+def train(db, factors=64, regularization=0.05, iterations=10, implicit=True, alpha=10.0, workers=None,
+          artifact_dir=ARTIFACT_DIR, callback=None):
+    # trains ALS factors on the current ratings and saves them as a new version,
+    # callback(iteration, seconds, objective, rmse) after every iteration ( e.g. the progress of a job )
+    started = time.perf_counter()
+    ratings = get_rating_matrix(db)
+    print(f"Rating matrix {ratings.shape} with {ratings.nnz} ratings ({time.perf_counter() - started:.2f}s)")
+
+    def report(iteration, seconds, objective, rmse):
+        print(f"iteration {iteration}/{iterations}: {seconds:.2f}s, loss {objective:.4f}, rmse {rmse:.4f}")
+        if callback:
+            callback(iteration, seconds, objective, rmse)
+
+    mode = 'implicit' if implicit else 'explicit'
+    print(f"Training {mode} ALS with {factors} factors, regularization {regularization}, {iterations} iterations")
+    model = train_als(ratings, factors=factors, regularization=regularization, iterations=iterations,
+                      implicit=implicit, alpha=alpha, workers=workers, callback=report)
+    version = model.save(artifact_dir, ratings_version=ratings.version,
+                         training_seconds=sum(step['seconds'] for step in model.history))
+    print(f"Saved model version {version} ({time.perf_counter() - started:.2f}s in total)")
+    return model
@@ -0,0 +1,265 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime
+
+import numpy as np
+
+from als import ALSModel, ARTIFACT_DIR, latest_version, write_atomic
+from recommendations import RECOMMENDATIONS_FILE, RecommendationStore
+
+# Model registry: which version of the model artifacts the web workers serve
+# - every version directory ( written by training, `flask recommend` and `flask ann` ) is published with a
+#   manifest.json listing its files with size and sha256. 'latest' stays the newest trained version for the
+#   batch jobs, 'current' names the published version the web serves, history.json the published versions
+#   in order for the rollback. Without 'current' ( before the first publish ) 'latest' is served.
+# - a published version is immutable: precompute refuses to write into it, train a new version instead
+# - a publish checks the files against the manifest and warms the version in the publishing process before
+#   'current' is replaced: the arrays are memory-mapped read only, so the pages read here are in the page
+#   cache that every gunicorn worker maps instead of holding its own copy
+# - every worker stats 'current' at most every CHECK_SECONDS. A new version is loaded and warmed in a
+#   background thread while the old one keeps serving, then swapped in with one assignment, a request
+#   takes the bundle once and never mixes factors and recommendations of two versions
+
+logger = logging.getLogger('api_flask.model_registry')  # goes to the api_flask log
+
+MANIFEST = 'manifest.json'
+CURRENT = 'current'
+HISTORY = 'history.json'
+CHECK_SECONDS = 1.0
+REQUIRED_FILES = ('user_factors.npy', 'item_factors.npy', 'user_ids.npy', 'movie_ids.npy', 'meta.json',
+                  RECOMMENDATIONS_FILE)
+
+
+class ServingModel:
+    # everything the web serves from one model version: factors, precomputed recommendations, ANN index
+    def __init__(self, version, artifact_dir=ARTIFACT_DIR, key=None):
+        from ann_index import ANNIndex, ANN_FILES
+        self.version = version
+        self.key = key or (version, None)
+        self.model = ALSModel.load(artifact_dir, version)
+        item_factors = np.asarray(self.model.item_factors)
+        self.YtY = item_factors.T @ item_factors  # of the fold-in
+        self.store = RecommendationStore(version, artifact_dir)
+        has_ann = os.path.exists(os.path.join(artifact_dir, version, ANN_FILES[0]))
+        self.ann = ANNIndex.load(version, artifact_dir) if has_ann else None
+        self.warmed = None  # seconds the warm-up took
+
+    def arrays(self):
+        arrays = [self.model.user_factors, self.model.item_factors, self.store.movies, self.store.scores]
+        if self.ann is not None:
+            arrays += [self.ann.items, self.ann.vectors]
+        return arrays
+
+    def warm(self):
+        # reads every page of the mapped arrays and scores one user the way the pages do, returns the seconds
+        started = time.perf_counter()
+        for array in self.arrays():
+            np.asarray(array).sum()
+        if len(self.store.user_ids):
+            self.store.for_user(int(self.store.user_ids[0]), 1)
+            vector = np.asarray(self.model.user_factors[0])
+            if self.ann is not None:
+                self.ann.search(vector, 1)
+            else:
+                np.asarray(self.model.item_factors) @ vector
+        self.warmed = time.perf_counter() - started
+        return self.warmed
+
+
+def file_digest(filename, chunk_size=2 ** 20):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_json(filename, default=None):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def write_manifest(version, artifact_dir=ARTIFACT_DIR):
+    # lists the files of the version directory as they are now, keeps the first publish date
+    path = os.path.join(artifact_dir, version)
+    missing = [name for name in REQUIRED_FILES if not os.path.exists(os.path.join(path, name))]
+    if missing:
+        raise FileNotFoundError(f"model {version} is incomplete, missing {', '.join(missing)}")
+    old = read_json(os.path.join(path, MANIFEST), {})
+    meta = read_json(os.path.join(path, 'meta.json'), {})
+    names = [name for name in sorted(os.listdir(path))
+             if name != MANIFEST and not name.startswith('tmp-') and '.tmp' not in name]  # not half written
+    files = {name: {'size': os.path.getsize(os.path.join(path, name)), 'sha256': file_digest(os.path.join(path, name))}
+             for name in names}
+    manifest = {'version': version, 'created': old.get('created', datetime.now().isoformat(timespec='seconds')),
+                'params': meta.get('params'), 'files': files}
+    write_atomic(os.path.join(path, MANIFEST), json.dumps(manifest, indent=2))
+    return manifest
+
+
+def verify(version, artifact_dir=ARTIFACT_DIR, checksums=True):
+    # raises ValueError if a file of the manifest is missing or changed, returns the manifest
+    path = os.path.join(artifact_dir, version)
+    manifest = read_json(os.path.join(path, MANIFEST))
+    if manifest is None:
+        raise FileNotFoundError(f"model {version} has no manifest, it was never published")
+    for name, expected in manifest['files'].items():
+        filename = os.path.join(path, name)
+        if not os.path.exists(filename):
+            raise ValueError(f"model {version}: {name} is missing")
+        if os.path.getsize(filename) != expected['size'] or \
+                (checksums and file_digest(filename) != expected['sha256']):
+            raise ValueError(f"model {version}: {name} does not match the manifest")
+    return manifest
+
+
+def current_version(artifact_dir=ARTIFACT_DIR):
+    # the published version, 'latest' as long as nothing was published
+    try:
+        with open(os.path.join(artifact_dir, CURRENT)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return latest_version(artifact_dir)
+
+
+def published_key(artifact_dir=ARTIFACT_DIR):
+    # (version, mtime of its manifest) of the published version, publishing the served version again
+    # ( e.g. after `flask ann` added the index ) changes it as well
+    version = current_version(artifact_dir)
+    if version is None:
+        return None
+    try:
+        return version, os.stat(os.path.join(artifact_dir, version, MANIFEST)).st_mtime_ns
+    except FileNotFoundError:
+        return version, None
+
+
+def versions(artifact_dir=ARTIFACT_DIR):
+    # version directories, oldest first
+    if not os.path.isdir(artifact_dir):
+        return []
+    return sorted(name for name in os.listdir(artifact_dir) if os.path.isdir(os.path.join(artifact_dir, name)))
+
+
+def history(artifact_dir=ARTIFACT_DIR):
+    # [{'version', 'published', 'rolled_back' ( when it was rolled back, if it was )}] oldest first
+    return read_json(os.path.join(artifact_dir, HISTORY), [])
+
+
+def is_published(version, artifact_dir=ARTIFACT_DIR):
+    # a published version is immutable, web workers may map its files and the manifest vouches for them
+    return os.path.exists(os.path.join(artifact_dir, version, MANIFEST)) or \
+        any(entry['version'] == version for entry in history(artifact_dir))
+
+
+def publish(version=None, artifact_dir=ARTIFACT_DIR, warm=True):
+    # seals the version ( latest by default ) with its manifest, warms it and makes it the served version
+    # publishing a published version again checks its files first, files added since ( the ANN index ) are
+    # added to the manifest
+    version = version or latest_version(artifact_dir)
+    if version is None:
+        raise FileNotFoundError(f'No trained model in {artifact_dir}')
+    if os.path.exists(os.path.join(artifact_dir, version, MANIFEST)):
+        verify(version, artifact_dir)
+    write_manifest(version, artifact_dir)
+    activate(version, artifact_dir, warm)
+    entries = history(artifact_dir)
+    if not entries or entries[-1]['version'] != version or entries[-1].get('rolled_back'):
+        entries.append({'version': version, 'published': datetime.now().isoformat(timespec='seconds')})
+        write_atomic(os.path.join(artifact_dir, HISTORY), json.dumps(entries, indent=2))
+    return version
+
+
+def rollback(artifact_dir=ARTIFACT_DIR, warm=True):
+    # serves the version published before the current one again and marks the current one rolled back,
+    # returns the version
+    entries = history(artifact_dir)
+    active = [entry for entry in entries if not entry.get('rolled_back')]
+    current = current_version(artifact_dir)
+    rolled_back = []
+    while active and active[-1]['version'] == current:
+        rolled_back.append(active.pop())
+    if not active:
+        raise ValueError('no earlier published model to roll back to')
+    version = active[-1]['version']
+    verify(version, artifact_dir)
+    activate(version, artifact_dir, warm)
+    for entry in rolled_back:
+        entry['rolled_back'] = datetime.now().isoformat(timespec='seconds')
+    write_atomic(os.path.join(artifact_dir, HISTORY), json.dumps(entries, indent=2))
+    return version
+
+
+def activate(version, artifact_dir, warm):
+    # the workers pick up the change of 'current', the version is warmed here first
+    verify(version, artifact_dir, checksums=False)
+    if warm:
+        seconds = ServingModel(version, artifact_dir).warm()
+        logger.info(f"model {version} warmed in {seconds * 1000:.1f} ms")
+    write_atomic(os.path.join(artifact_dir, CURRENT), version)
+    logger.info(f"model {version} published")
+
+
+_serving = None  # ServingModel of this worker
+_pending = None  # key of the version that is loading in the background
+_failed = None  # key of a version that could not be loaded, not tried again until it is published again
+_checked = 0.0
+_lock = threading.Lock()
+
+def get_serving_model(artifact_dir=ARTIFACT_DIR, wait=True):
+    # model of the published version in this worker, None before there is one. A newer version loads and
+    # warms in the background while the current one keeps serving. wait: load synchronously when this
+    # worker serves nothing yet, the first request is better served late than without recommendations
+    global _checked, _pending
+    now = time.monotonic()
+    if _serving is not None and now - _checked < CHECK_SECONDS:
+        return _serving
+    _checked = now
+    key = published_key(artifact_dir)
+    if key is None or key == _failed or (_serving is not None and _serving.key == key):
+        return _serving
+    with _lock:
+        if _serving is None and wait:
+            load(key, artifact_dir)
+        elif _pending != key:
+            _pending = key
+            threading.Thread(target=load, args=(key, artifact_dir, True), name='model-load', daemon=True).start()
+    return _serving
+
+
+def load(key, artifact_dir, background=False):
+    global _serving, _pending, _failed
+    version = key[0]
+    try:
+        serving = ServingModel(version, artifact_dir, key)
+        serving.warm()
+    except (OSError, ValueError):
+        # e.g. a version without recommendations or removed after it was published, the old one keeps serving
+        logger.exception(f"loading model {version} failed")
+        serving = None
+    with _lock if background else nullcontext():
+        if serving is not None:
+            _serving = serving
+            logger.info(f"serving model {version}, warmed in {serving.warmed * 1000:.1f} ms")
+        else:
+            _failed = key
+        if _pending == key:
+            _pending = None
+
+
+def readiness(artifact_dir=ARTIFACT_DIR):
+    # (ready, status) of this worker: ready once the published version is loaded and warmed, or when there
+    # is no model at all ( the pages work without recommendations )
+    serving = get_serving_model(artifact_dir, wait=False)
+    version = current_version(artifact_dir)
+    status = {'published': version, 'serving': serving.version if serving is not None else None,
+              'loading': _pending and _pending[0], 'failed': _failed and _failed[0]}
+    return serving is not None or version is None, status
@@ -31,7 +31,7 @@ class Movie(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100, collation='NOCASE'), nullable=False, unique=True)
     title_stripped = db.Column(db.String(100, collation='NOCASE'), nullable=False, unique=False)
-    year = db.Column(db.Integer, nullable=False, server_default='0')
+    year = db.Column(db.Integer, nullable=False, server_default='0', index=True)
     genres = db.relationship('MovieGenre', backref='Movie', lazy=True)
     links = db.relationship('Link', backref='Movie')
     tags = db.relationship('Tags', backref='Movie')
@@ -39,25 +39,41 @@ class Movie(db.Model):
 
 class MovieGenre(db.Model):
     __tablename__ = 'movie_genres'
+    # genre filter and genres of a page of movies, both covering ( the id is part of every index )
+    __table_args__ = (db.Index('ix_movie_genres_genre_movie', 'genre', 'movie_id'),
+                      db.Index('ix_movie_genres_movie_genre', 'movie_id', 'genre'))
     id = db.Column(db.Integer, primary_key=True)
     movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'), nullable=False)
     genre = db.Column(db.String(255), nullable=False, server_default='')
 
 class Ratings(db.Model):
     __tablename__ = 'movie_ratings'
+    # one rating per user and movie, rating writes are upserts on this index ( see rating_writes.py )
+    __table_args__ = (db.Index('ux_movie_ratings_user_movie', 'user_id', 'movie_id', unique=True),
+                      db.Index('ix_movie_ratings_movie_rating', 'movie_id', 'rating'))  # ratings of a movie
     id = db.Column(db.Integer, primary_key=True)
     movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     rating = db.Column(db.Float, nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False)
 
+class RatingChange(db.Model):
+    # log of overwritten ratings, one row per update of movie_ratings written by a trigger ( see rating_writes.py )
+    # the sequence only grows, so the ratings snapshot finds every overwrite since its export, whatever timestamp
+    # the rating carries and in whichever order the writers committed
+    __tablename__ = 'rating_changes'
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = db.Column(db.Integer, primary_key=True)
+    rating_id = db.Column(db.Integer, nullable=False)
+
 class TagNames(db.Model):
     __tablename__ = 'movie_tagnames'
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(255), nullable=False)
+    name = db.Column(db.String(255), nullable=False, unique=True, index=True)
 
 class Tags(db.Model):
     __tablename__ = 'movie_tags'
+    __table_args__ = (db.Index('ix_movie_tags_movie_tagname', 'movie_id', 'tag_name_id'),)
     id = db.Column(db.Integer, primary_key=True)
     tag_name_id = db.Column(db.Integer, db.ForeignKey('movie_tagnames.id'), nullable=False)
     movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'), nullable=False)
@@ -68,7 +84,64 @@ class Tags(db.Model):
 class Link(db.Model):
     __tablename__ = 'movie_links'
     id = db.Column(db.Integer, primary_key=True)
-    movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'), nullable=False)
+    movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'), nullable=False, index=True)
     ml_url = db.Column(db.String(MAX_URL_LENGTH), nullable=False, default='')
     imdb_url = db.Column(db.String(MAX_URL_LENGTH), nullable=False, default='')
-    tmdb_url = db.Column(db.String(MAX_URL_LENGTH), nullable=False, default='')
\ No newline at end of file
+    tmdb_url = db.Column(db.String(MAX_URL_LENGTH), nullable=False, default='')
+
+class LoadCheckpoint(db.Model):
+    # how far a data file has been loaded by the incremental loader
+    __tablename__ = 'load_checkpoints'
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255), nullable=False, unique=True)
+    offset = db.Column(db.Integer, nullable=False, default=0)  # byte offset of the first unloaded row
+    checksum = db.Column(db.String(64), nullable=False, default='')  # sha1 of the bytes before offset
+    rows = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime)
+
+class UserFactor(db.Model):
+    # latent vector of a user folded in after a new rating, newer than the trained model version
+    __tablename__ = 'user_factors'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    model_version = db.Column(db.String(32), nullable=False)
+    vector = db.Column(db.LargeBinary, nullable=False)  # float32 bytes
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+class CatalogueVersion(db.Model):
+    # single row counter, bumped by triggers whenever movies, genres, tags or links change ( see page_cache.py )
+    __tablename__ = 'catalogue_version'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class MovieStats(db.Model):
+    # rating aggregates of a movie, kept current by triggers on movie_ratings ( see movie_stats.py )
+    __tablename__ = 'movie_stats'
+    # the sort orders of the listings, the movie id breaks ties and is the keyset cursor
+    __table_args__ = (db.Index('ix_movie_stats_count_movie', 'rating_count', 'movie_id'),
+                      db.Index('ix_movie_stats_mean_movie', 'shrunk_mean', 'movie_id'))
+    movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'), primary_key=True)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Float, nullable=False, default=0)
+    rating_sum_squares = db.Column(db.Float, nullable=False, default=0)
+    shrunk_mean = db.Column(db.Float, nullable=False)  # mean pulled towards the mean of all ratings
+    last_rated = db.Column(db.DateTime)
+
+class Job(db.Model):
+    # background job of the queue in jobs.py, kept in a database of its own ( the 'jobs' bind )
+    __bind_key__ = 'jobs'
+    __tablename__ = 'jobs'
+    __table_args__ = (db.Index('ix_jobs_status_run_after', 'status', 'run_after'),)  # the next queued job
+    id = db.Column(db.Integer, primary_key=True)
+    type = db.Column(db.String(32), nullable=False)
+    params = db.Column(db.Text, nullable=False, default='{}')  # JSON keyword arguments of the job function
+    status = db.Column(db.String(16), nullable=False, default='queued')
+    progress = db.Column(db.Float)  # 0 to 1, None while unknown
+    message = db.Column(db.String(255), nullable=False, default='')
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    worker = db.Column(db.String(255))  # host:pid of the process running it
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False)
+    run_after = db.Column(db.DateTime, nullable=False)  # not started before
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
@@ -0,0 +1,190 @@
+import calendar
+import logging
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import func, select, text, tuple_
+
+from models import Movie, MovieGenre, MovieStats
+
+# Rating aggregates per movie ( movie_stats )
+# - count, sum and sum of squares of the ratings, the last rating time and a Bayesian mean
+#   (sum + PRIOR_WEIGHT * prior mean) / (count + PRIOR_WEIGHT), so a movie with two 5 star ratings
+#   doesn't top the "top rated" listing
+# - built in one vectorized pass ( numpy bincount ) by the bulk loader and `flask rebuild-stats`
+# - kept current by SQLite triggers on movie_ratings: an insert adds a rating, an overwrite ( the upsert of
+#   rate_movie ) takes the old rating out and the new one in, a delete takes it out. Every write is O(1) and
+#   part of the transaction of the rating, whatever process writes it. Ratings are half stars, so the sums
+#   stay exact.
+# - the prior mean is the mean of all ratings when the stats were last rebuilt, it is part of the triggers
+# - the listings sort by rating_count or shrunk_mean with an index walk, newest by movies.year
+
+logger = logging.getLogger('api_flask.movie_stats')  # goes to the api_flask log
+
+PRIOR_WEIGHT = 10  # how many ratings the prior is worth
+DEFAULT_PRIOR_MEAN = 3.5  # before there are any ratings
+RATING_TRIGGERS = ('movie_stats_rating_insert', 'movie_stats_rating_update', 'movie_stats_rating_delete')
+MOVIE_TRIGGERS = ('movie_stats_movie_insert', 'movie_stats_movie_delete')
+STATS_TRIGGERS = RATING_TRIGGERS + MOVIE_TRIGGERS
+KNOWN_MOVIE = 'EXISTS (SELECT 1 FROM movies WHERE id = NEW.movie_id)'
+
+# sort mode -> (sort column, id column), descending
+SORTS = {
+    'popular': (MovieStats.rating_count, MovieStats.movie_id),
+    'top-rated': (MovieStats.shrunk_mean, MovieStats.movie_id),
+    'newest': (Movie.year, Movie.id),
+}
+
+
+def stats_triggers(prior_mean, prior_weight=PRIOR_WEIGHT):
+    # {trigger name: create statement}
+    prior = prior_mean * prior_weight
+    # a rating of a movie that isn't in movies ( the legacy loader keeps them ) gets no stats row, like in rebuild
+    add = (f'INSERT INTO movie_stats (movie_id, rating_count, rating_sum, rating_sum_squares, shrunk_mean, last_rated) '
+           f'SELECT NEW.movie_id, 1, NEW.rating, NEW.rating * NEW.rating, '
+           f'(NEW.rating + {prior!r}) / {1 + prior_weight!r}, NEW.timestamp WHERE {KNOWN_MOVIE} '
+           f'ON CONFLICT (movie_id) DO UPDATE SET rating_count = rating_count + 1, '
+           f'rating_sum = rating_sum + excluded.rating_sum, '
+           f'rating_sum_squares = rating_sum_squares + excluded.rating_sum_squares, '
+           f'shrunk_mean = (rating_sum + excluded.rating_sum + {prior!r}) / (rating_count + {1 + prior_weight!r}), '
+           f'last_rated = max(coalesce(last_rated, excluded.last_rated), excluded.last_rated);')
+    remove = (f'UPDATE movie_stats SET rating_count = rating_count - 1, rating_sum = rating_sum - OLD.rating, '
+              f'rating_sum_squares = rating_sum_squares - OLD.rating * OLD.rating, '
+              f'shrunk_mean = (rating_sum - OLD.rating + {prior!r}) / (rating_count - 1 + {prior_weight!r}) '
+              f'WHERE movie_id = OLD.movie_id;')
+    return {
+        'movie_stats_rating_insert': f'AFTER INSERT ON movie_ratings BEGIN {add} END',
+        'movie_stats_rating_update': f'AFTER UPDATE OF movie_id, rating ON movie_ratings BEGIN {remove} {add} END',
+        'movie_stats_rating_delete': f'AFTER DELETE ON movie_ratings BEGIN {remove} END',
+        # every movie has a row, so the listings sorted by the stats include movies without ratings
+        'movie_stats_movie_insert': f'AFTER INSERT ON movies BEGIN INSERT OR IGNORE INTO movie_stats '
+                                    f'(movie_id, rating_count, rating_sum, rating_sum_squares, shrunk_mean) '
+                                    f'VALUES (NEW.id, 0, 0, 0, {prior_mean!r}); END',
+        'movie_stats_movie_delete': 'AFTER DELETE ON movies BEGIN DELETE FROM movie_stats WHERE movie_id = OLD.id; END',
+    }
+
+
+def drop_triggers(conn, names=STATS_TRIGGERS):
+    # e.g. before a bulk load, which rebuilds the stats in one pass afterwards
+    for name in names:
+        conn.execute(text(f'DROP TRIGGER IF EXISTS {name}'))
+
+
+def create_triggers(conn, prior_mean):
+    drop_triggers(conn)
+    for name, body in stats_triggers(prior_mean).items():
+        conn.execute(text(f'CREATE TRIGGER {name} {body}'))
+
+
+def aggregate(movie_ids, rating_movie_ids, ratings, timestamps, prior_weight=PRIOR_WEIGHT):
+    # (prior mean, count, sum, sum of squares, shrunk mean, last timestamp) per movie of the sorted movie_ids
+    import numpy as np
+    positions = np.minimum(np.searchsorted(movie_ids, rating_movie_ids), max(len(movie_ids) - 1, 0))
+    known = movie_ids[positions] == rating_movie_ids if len(movie_ids) else np.zeros(len(positions), dtype=bool)
+    positions, ratings, timestamps = positions[known], ratings[known].astype(np.float64), timestamps[known]
+    n = len(movie_ids)
+    count = np.bincount(positions, minlength=n)
+    total = np.bincount(positions, weights=ratings, minlength=n)
+    squares = np.bincount(positions, weights=ratings * ratings, minlength=n)
+    last = np.full(n, -1, dtype=np.int64)
+    np.maximum.at(last, positions, timestamps)
+    prior_mean = float(ratings.mean()) if len(ratings) else DEFAULT_PRIOR_MEAN
+    shrunk = (total + prior_mean * prior_weight) / (count + prior_weight)
+    return prior_mean, count, total, squares, shrunk, last
+
+
+def rebuild(conn, rating_movie_ids, ratings, timestamps):
+    # replaces movie_stats with the aggregates of the given rating columns and recreates the triggers,
+    # timestamps are the stored datetimes of movie_ratings as UTC seconds ( stored_seconds )
+    import numpy as np
+    started = time.perf_counter()
+    movie_ids = np.array(conn.execute(select(Movie.id).order_by(Movie.id)).scalars().all(), dtype=np.int64)
+    prior_mean, count, total, squares, shrunk, last = aggregate(movie_ids, rating_movie_ids, ratings, timestamps)
+    conn.execute(MovieStats.__table__.delete())
+    if len(movie_ids):
+        conn.execute(MovieStats.__table__.insert(), [
+            {'movie_id': int(movie_id), 'rating_count': int(n), 'rating_sum': float(s), 'rating_sum_squares': float(q),
+             'shrunk_mean': float(mean), 'last_rated': utc_timestamp(int(ts)) if ts >= 0 else None}
+            for movie_id, n, s, q, mean, ts in zip(movie_ids, count, total, squares, shrunk, last)])
+    create_triggers(conn, prior_mean)
+    logger.info(f"movie_stats: {len(movie_ids)} movies, {int(count.sum())} ratings, prior mean {prior_mean:.3f} "
+                f"in {time.perf_counter() - started:.2f}s")
+    return len(movie_ids)
+
+
+def utc_timestamp(seconds):
+    # SQLite's strftime('%s') reads the stored datetimes as UTC, this turns its seconds back into them
+    return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)
+
+
+def stored_seconds(stored):
+    # seconds of a stored ( naive ) datetime the way strftime('%s') reads it, the inverse of utc_timestamp
+    return calendar.timegm(stored.timetuple())
+
+
+def rebuild_from_database(db):
+    from rating_matrix import fetch_ratings
+    _, movie_ids, ratings, timestamps = fetch_ratings(db)
+    rows = rebuild(db.session.connection(), movie_ids, ratings, timestamps)
+    db.session.commit()
+    return rows
+
+
+def ensure_movie_stats(db):
+    # builds the stats of a database older than them ( or whose bulk load was interrupted ), or older than
+    # the check for unknown movies in the triggers ( the rebuild drops the stats rows of unknown movies )
+    existing = dict(db.session.execute(text("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'")).all())
+    if set(STATS_TRIGGERS) <= existing.keys() and KNOWN_MOVIE in existing['movie_stats_rating_insert']:
+        return False
+    rebuild_from_database(db)
+    return True
+
+
+def genre_condition(id_column, genres, mode=None):
+    # movies with any ( or all ) of the genres, checked per movie while walking the sort index, so a page
+    # stops after a few rows instead of sorting every movie of the genres
+    of_movie = (MovieGenre.movie_id == id_column, MovieGenre.genre.in_(genres))
+    if mode == 'all':
+        return select(func.count(MovieGenre.genre.distinct())).where(*of_movie).scalar_subquery() == len(genres)
+    return select(MovieGenre.id).where(*of_movie).exists()
+
+
+def sorted_query(sort, genres=None, mode=None):
+    # movie ids of the sort mode within the genre filter, unordered
+    id_column = SORTS[sort][1]
+    query = select(id_column)
+    if genres:
+        query = query.where(genre_condition(id_column, genres, mode))
+    return query
+
+
+def sort_order(sort, ascending=False):
+    value, id_column = SORTS[sort]
+    return (value.asc(), id_column.asc()) if ascending else (value.desc(), id_column.desc())
+
+
+def sorted_page(db, sort, per_page, after=None, before=None, page=1, genres=None, mode=None):
+    # keyset page of a sort mode, the cursors are movie ids like in the id ordered listings:
+    # the page continues after ( or before ) the position of that movie in the sort order. Without a
+    # ( known ) cursor page counts from the start, links from before the cursors still work
+    from genre_index import KeysetPage
+    value, id_column = SORTS[sort]
+    query = sorted_query(sort, genres, mode)
+    cursor = before if before is not None else after
+    cursor_value = db.session.execute(select(value).where(id_column == cursor)).scalar() \
+        if cursor is not None else None
+    offset = 0
+    if cursor_value is None:  # no or an unknown cursor: page is the position
+        before = after = None
+        offset = (max(page, 1) - 1) * per_page
+        query = query.offset(offset)
+    elif before is not None:
+        query = query.where(tuple_(value, id_column) > tuple_(cursor_value, cursor))
+    else:
+        query = query.where(tuple_(value, id_column) < tuple_(cursor_value, cursor))
+    ids = db.session.execute(query.order_by(*sort_order(sort, before is not None)).limit(per_page + 1)).scalars().all()
+    more = len(ids) > per_page
+    ids = ids[:per_page]
+    if before is not None:
+        return KeysetPage(ids[::-1], more, True, max(page, 1))
+    return KeysetPage(ids, after is not None or offset > 0, more, max(page, 1))
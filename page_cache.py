@@ -0,0 +1,93 @@
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+
+from sqlalchemy import select, text
+
+from metrics import registry
+from models import CatalogueVersion
+
+# Cache for the rendered movie lists of /movies and /movies/genres
+# - entries are keyed on (sorted genres, mode, movie ids of the page) and only hold html that is the same for
+#   every user, per user parts ( header, chosen ratings ) are rendered around it on every request
+# - every entry remembers the catalogue version it was rendered for. SQLite triggers bump that version
+#   whenever movies, genres, tags or links change, no matter which process ( web, flask initdb, loaddata ) wrote
+# - hits and misses are counted in page_cache_lookups_total on /metrics
+# - least recently used entries are evicted once the cached html exceeds max_bytes
+
+CATALOGUE_TABLES = ('movies', 'movie_genres', 'movie_tags', 'movie_tagnames', 'movie_links')
+
+
+def catalogue_triggers():
+    # (trigger name, table, action) of the triggers that bump the catalogue version
+    return [(f'bump_catalogue_{table}_{action.lower()}', table, action)
+            for table in CATALOGUE_TABLES for action in ('INSERT', 'UPDATE', 'DELETE')]
+
+
+def ensure_catalogue_version(db):
+    # creates the version row and the triggers that bump it, safe to call on every start
+    db.session.execute(text('INSERT OR IGNORE INTO catalogue_version (id, version) VALUES (1, 0)'))
+    for name, table, action in catalogue_triggers():
+        db.session.execute(text(
+            f'CREATE TRIGGER IF NOT EXISTS {name} AFTER {action} ON {table} '
+            f'BEGIN UPDATE catalogue_version SET version = version + 1 WHERE id = 1; END'))
+    db.session.commit()
+
+
+def catalogue_version(db):
+    return db.session.execute(select(CatalogueVersion.version).where(CatalogueVersion.id == 1)).scalar() or 0
+
+
+class CachedPage:
+    def __init__(self, version, html):
+        self.version = version
+        self.html = html
+        self.size = len(html.encode('utf8'))
+        self.etag = hashlib.sha1(f'{version}|{html}'.encode('utf8')).hexdigest()
+
+
+class PageCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+
+    def get(self, key, version):
+        # entry for the key if it was rendered for this catalogue version
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.version != version:
+                registry.page_cache.inc(result='miss')
+                return None
+            self.entries.move_to_end(key)
+            registry.page_cache.inc(result='hit')
+            return entry
+
+    def put(self, key, version, html):
+        entry = CachedPage(version, html)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            if entry.size <= self.max_bytes:
+                self.entries[key] = entry
+                self.size += entry.size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+        return entry
+
+    def get_or_render(self, key, version, render):
+        return self.get(key, version) or self.put(key, version, render())
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+def user_etag(entry, user_id, user_ratings, extra=''):
+    # etag of a whole page: the shared html plus everything per user ( or page, extra ) rendered around it
+    ratings = ','.join(f'{movie_id}:{rating}' for movie_id, rating in sorted(user_ratings.items()))
+    return hashlib.sha1(f'{entry.etag}|{user_id}|{ratings}|{extra}'.encode('utf8')).hexdigest()
@@ -0,0 +1,153 @@
+import hashlib
+import logging
+import os
+import time
+
+import numpy as np
+import scipy.sparse as sp
+from sqlalchemy import Integer, cast, func, select
+
+from models import Movie, Ratings
+from rating_writes import change_sequence
+
+logger = logging.getLogger('api_flask.rating_matrix')  # goes to the api_flask log
+
+CACHE_DIR = 'cache'
+FETCH_SIZE = 100000  # rows per fetch from the database
+
+
+class RatingMatrix:
+    # users x movies ratings as a float32 CSR matrix plus the maps between ids and row/column indices
+    # user_ids and movie_ids are sorted, so the index of an id is a binary search away
+    def __init__(self, matrix, user_ids, movie_ids, timestamps, version=''):
+        self.matrix = matrix
+        self.user_ids = user_ids
+        self.movie_ids = movie_ids
+        self.timestamps = timestamps  # unix seconds, aligned with matrix.data
+        self.version = version
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @property
+    def nnz(self):
+        return self.matrix.nnz
+
+    def user_index(self, user_id):
+        # row of a user, None if the user has no ratings
+        return _index_of(self.user_ids, user_id)
+
+    def movie_index(self, movie_id):
+        # column of a movie, None if the movie is unknown
+        return _index_of(self.movie_ids, movie_id)
+
+    def user_indices(self, user_ids):
+        # rows of many users at once, -1 for unknown users
+        return indices_of(self.user_ids, user_ids)
+
+    def save(self, filename):
+        tmp = filename + '.tmp.npz'
+        np.savez(tmp, data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr,
+                 shape=np.array(self.matrix.shape), user_ids=self.user_ids, movie_ids=self.movie_ids,
+                 timestamps=self.timestamps, version=np.array(self.version))
+        os.replace(tmp, filename)  # readers never see a half written file
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            matrix = sp.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+            return cls(matrix, f['user_ids'], f['movie_ids'], f['timestamps'], str(f['version']))
+
+
+def _index_of(ids, id):
+    i = np.searchsorted(ids, id)
+    if i < len(ids) and ids[i] == id:
+        return int(i)
+    return None
+
+def indices_of(ids, values):
+    # positions of values in the sorted ids array, -1 for values that are not in it
+    values = np.asarray(values)
+    i = np.searchsorted(ids, values).clip(0, max(len(ids) - 1, 0))
+    found = (ids[i] == values) if len(ids) else np.zeros(values.shape, dtype=bool)
+    return np.where(found, i, -1)
+
+
+def ratings_version(db):
+    # changes whenever ratings are added, removed or overwritten ( the change log of rating_writes )
+    count, max_id = db.session.execute(select(func.count(), func.max(Ratings.id))).one()
+    movie_count, max_movie_id = db.session.execute(select(func.count(), func.max(Movie.id))).one()
+    key = f'{count}|{max_id}|{change_sequence(db)[0]}|{movie_count}|{max_movie_id}'
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def fetch_ratings(db):
+    # (user_id, movie_id, rating, timestamp) columns as numpy arrays, fetched in chunks
+    # the timestamp is converted to unix seconds by SQLite so no datetime objects are created
+    query = select(Ratings.user_id, Ratings.movie_id, Ratings.rating,
+                   cast(func.strftime('%s', Ratings.timestamp), Integer))
+    result = db.session.execute(query.execution_options(yield_per=FETCH_SIZE))
+    users, movies, ratings, timestamps = [], [], [], []
+    for rows in result.partitions():
+        columns = list(zip(*rows))
+        users.append(np.array(columns[0], dtype=np.int64))
+        movies.append(np.array(columns[1], dtype=np.int64))
+        ratings.append(np.array(columns[2], dtype=np.float32))
+        timestamps.append(np.array(columns[3], dtype=np.int64))
+    if not users:
+        return (np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float32), np.empty(0, np.int64))
+    return np.concatenate(users), np.concatenate(movies), np.concatenate(ratings), np.concatenate(timestamps)
+
+
+def build_rating_matrix(db, version='', snapshot_dir=None):
+    # from the columnar snapshot, brought up to date first ( an append of the ratings written since )
+    import ratings_snapshot
+    started = time.perf_counter()
+    snapshot = ratings_snapshot.export(db, snapshot_dir or ratings_snapshot.SNAPSHOT_DIR)
+    users, movies, ratings, timestamps = snapshot.ratings()
+
+    # columns for every movie of the catalogue, ratings of unknown movies are dropped
+    movie_ids = np.array(db.session.execute(select(Movie.id).order_by(Movie.id)).scalars().all(), dtype=np.int64)
+    columns = indices_of(movie_ids, movies)
+    known = columns >= 0
+    if not known.all():
+        logger.info(f"Ignoring {np.count_nonzero(~known)} ratings of movies that do not exist")
+        users, columns, ratings, timestamps = users[known], columns[known], ratings[known], timestamps[known]
+
+    # rows only for users that rated something
+    user_ids, rows = np.unique(users, return_inverse=True)
+
+    # sort by (user, movie, time) and keep the newest rating of duplicate (user, movie) pairs
+    order = np.lexsort((timestamps, columns, rows))
+    rows, columns, ratings, timestamps = rows[order], columns[order], ratings[order], timestamps[order]
+    last = np.ones(len(rows), dtype=bool)
+    last[:-1] = (rows[1:] != rows[:-1]) | (columns[1:] != columns[:-1])
+    rows, columns, ratings, timestamps = rows[last], columns[last], ratings[last], timestamps[last]
+
+    # the sorted rows give the CSR layout directly, timestamps stay aligned with matrix.data
+    indptr = np.zeros(len(user_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(user_ids)), out=indptr[1:])
+    matrix = sp.csr_matrix((ratings, columns.astype(np.int32), indptr), shape=(len(user_ids), len(movie_ids)))
+
+    logger.info(f"Built {matrix.shape} rating matrix with {matrix.nnz} ratings in {time.perf_counter() - started:.2f}s")
+    return RatingMatrix(matrix, user_ids, movie_ids, timestamps, version)
+
+
+def get_rating_matrix(db, cache_dir=CACHE_DIR, rebuild=False):
+    # rating matrix of the current ratings table, from the on-disk cache when the table didn't change
+    version = ratings_version(db)
+    filename = os.path.join(cache_dir, f'rating_matrix-{version}.npz')
+    if not rebuild and os.path.exists(filename):
+        started = time.perf_counter()
+        matrix = RatingMatrix.load(filename)
+        logger.info(f"Loaded rating matrix {version} in {time.perf_counter() - started:.2f}s")
+        return matrix
+
+    matrix = build_rating_matrix(db, version, os.path.join(cache_dir, 'ratings_snapshot'))
+    os.makedirs(cache_dir, exist_ok=True)
+    for old in os.listdir(cache_dir):  # only keep the current version
+        if old.startswith('rating_matrix-') and old.endswith('.npz'):
+            os.remove(os.path.join(cache_dir, old))
+    matrix.save(filename)
+    return matrix
@@ -0,0 +1,159 @@
+import atexit
+import logging
+import threading
+from datetime import datetime
+
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.sqlite import insert
+
+from models import Movie, RatingChange, Ratings
+
+# Rating writes
+# - a user has at most one rating per movie, enforced by a unique index on (user_id, movie_id), so a rating
+#   is a single INSERT ... ON CONFLICT DO UPDATE instead of a lookup plus insert / update ( which let two
+#   concurrent clicks create two rows )
+# - a batch of ratings is one executemany in one transaction
+# - optionally ( RATING_WRITE_BEHIND ) ratings are acknowledged once they are in the buffer of the worker
+#   and committed every RATING_FLUSH_SECONDS: a crash of the worker loses at most the ratings of that
+#   interval, everything else is flushed on a clean shutdown
+# - every overwrite is logged in rating_changes by CHANGE_TRIGGER, the ratings snapshot appends the rows logged
+#   after its export instead of relying on the timestamps ( a buffered rating is committed after its timestamp )
+
+logger = logging.getLogger('api_flask.rating_writes')  # goes to the api_flask log
+
+RATING_INDEX = 'ux_movie_ratings_user_movie'
+CHANGE_TRIGGER = 'log_rating_change'
+MAX_BATCH_SIZE = 1000  # ratings accepted by one /rate_movies request
+
+
+def ensure_rating_index(db):
+    # creates the unique index on databases created before it existed, duplicates keep their newest row
+    exists = db.session.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name"),
+                                {'name': RATING_INDEX}).first()
+    if exists:
+        return
+    removed = db.session.execute(text(
+        'DELETE FROM movie_ratings WHERE id NOT IN (SELECT max(id) FROM movie_ratings GROUP BY user_id, movie_id)'
+    )).rowcount
+    db.session.execute(text(f'CREATE UNIQUE INDEX IF NOT EXISTS {RATING_INDEX} ON movie_ratings (user_id, movie_id)'))
+    db.session.commit()
+    logger.info(f"created {RATING_INDEX}, removed {removed} duplicate ratings")
+
+
+def ensure_change_log(db):
+    # the trigger that logs overwritten ratings, safe to call on every start
+    db.session.execute(text(
+        f'CREATE TRIGGER IF NOT EXISTS {CHANGE_TRIGGER} AFTER UPDATE OF user_id, movie_id, rating, timestamp '
+        f'ON movie_ratings BEGIN INSERT INTO rating_changes (rating_id) VALUES (NEW.id); END'))
+    db.session.commit()
+
+
+def change_sequence(db):
+    # (last sequence number ever logged, sequence number up to which the log was pruned)
+    last = db.session.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'rating_changes'")).scalar() or 0
+    first = db.session.execute(select(func.min(RatingChange.seq))).scalar()
+    return last, (first - 1 if first is not None else last)
+
+
+def parse_ratings(items, rating_range):
+    # ([(movie id, rating)], [{'movie_id', 'message'}]) of the items of a request, invalid ones are rejected
+    valid, rejected = [], []
+    for item in items:
+        if not isinstance(item, dict):
+            rejected.append({'movie_id': None, 'message': 'Expected an object with movie_id and rating'})
+            continue
+        movie_id = item.get('movie_id')
+        try:
+            movie_id = int(movie_id)
+        except (TypeError, ValueError):
+            rejected.append({'movie_id': movie_id, 'message': f'Invalid movie_id, expected an integer, got {movie_id!r}'})
+            continue
+        try:
+            rating = float(item.get('rating'))
+        except (TypeError, ValueError):
+            rejected.append({'movie_id': movie_id,
+                             'message': f"Invalid rating, expected a float, got {item.get('rating')!r}"})
+            continue
+        if rating < rating_range[0] or rating > rating_range[1]:
+            rejected.append({'movie_id': movie_id, 'message': f'Invalid rating value, expected value between '
+                                                              f'{rating_range[0]} and {rating_range[1]}, got {rating}'})
+            continue
+        valid.append((movie_id, rating))
+    return valid, rejected
+
+
+def known_movie_ids(db, movie_ids):
+    return set(db.session.execute(select(Movie.id).where(Movie.id.in_(set(movie_ids)))).scalars())
+
+
+def upsert_statement():
+    statement = insert(Ratings)
+    return statement.on_conflict_do_update(
+        index_elements=[Ratings.user_id, Ratings.movie_id],
+        set_={'rating': statement.excluded.rating, 'timestamp': statement.excluded.timestamp})
+
+
+def upsert_ratings(db, rows):
+    # rows: [{'user_id', 'movie_id', 'rating', 'timestamp'}], written in one transaction
+    if not rows:
+        return 0
+    db.session.execute(upsert_statement(), rows)
+    db.session.commit()
+    return len(rows)
+
+
+class RatingBuffer:
+    # write-behind buffer of one worker, the newest rating per (user, movie) wins
+    def __init__(self, app, db, flush_seconds=1.0, on_flush=None):
+        self.app = app
+        self.db = db
+        self.flush_seconds = flush_seconds
+        self.on_flush = on_flush  # called with the user ids of every flushed batch
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='rating-buffer', daemon=True)
+        self.thread.start()
+        atexit.register(self.flush, notify=False)  # the fold-in executor is gone at exit
+
+    def add(self, rows):
+        with self.lock:
+            for row in rows:
+                self.pending[(row['user_id'], row['movie_id'])] = row
+
+    def pending_for(self, user_id, movie_ids):
+        # {movie id: rating} of a user that is not committed yet, so a user always sees their own ratings
+        with self.lock:
+            return {movie_id: self.pending[user_id, movie_id]['rating']
+                    for movie_id in movie_ids if (user_id, movie_id) in self.pending}
+
+    def flush(self, notify=True):
+        with self.lock:
+            rows, self.pending = list(self.pending.values()), {}
+        if not rows:
+            return 0
+        with self.app.app_context():
+            try:
+                upsert_ratings(self.db, rows)
+            except Exception:
+                logger.exception(f"flushing {len(rows)} ratings failed, keeping them for the next flush")
+                self.db.session.rollback()
+                with self.lock:
+                    for row in rows:
+                        self.pending.setdefault((row['user_id'], row['movie_id']), row)
+                return 0
+            finally:
+                self.db.session.remove()
+        if notify and self.on_flush:
+            self.on_flush({row['user_id'] for row in rows})
+        return len(rows)
+
+    def run(self):
+        while not self.wake.wait(self.flush_seconds):
+            self.flush()
+
+
+def rating_rows(user_id, ratings, timestamp=None):
+    timestamp = timestamp or datetime.now()
+    return [{'user_id': user_id, 'movie_id': movie_id, 'rating': rating, 'timestamp': timestamp}
+            for movie_id, rating in ratings]
@@ -0,0 +1,251 @@
+import fcntl
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import Integer, cast, func, select
+
+from als import latest_version, write_atomic
+from models import RatingChange, Ratings
+from rating_matrix import FETCH_SIZE, indices_of, ratings_version
+from rating_writes import change_sequence
+
+# Columnar snapshot of movie_ratings for the batch jobs ( training, evaluation, similarity ... )
+# - one raw file per column: int32 user index, int32 movie index, float32 rating, int64 unix timestamp,
+#   plus the id maps ( index -> user / movie id, int64 ) and manifest.json with the row counts, the
+#   ratings version of the database and the watermark of the last export
+# - readers memory-map the files read only, the batch processes ( flask commands, jobs, the evaluation
+#   pool ) share the page cache copy of the files instead of holding their own arrays
+# - `export` appends the ratings written since the last export: new rows by id ( a primary key range ) and
+#   overwritten rows, found in the rating_changes log past the sequence number of the export ( see
+#   rating_writes.py ), whatever their timestamp. The snapshot is a log, the newest row of a (user, movie)
+#   pair is its current rating. Deleted ratings can't be appended, the rating count gives them away and a
+#   full export writes a new generation, as does a log pruned past the sequence number of the snapshot.
+#   Every export prunes the log up to its sequence number.
+# - appends write past the rows of the manifest and replace the manifest last, a reader only maps the rows
+#   of the manifest it read, so it never sees a half written append. A full export writes a new generation
+#   directory and points 'latest' at it like the model artifacts.
+# - exports hold an exclusive lock on LOCK_FILE for the whole export, jobs, commands and the rating matrix
+#   export at the same time and would otherwise interleave appends or remove a generation being written
+
+logger = logging.getLogger('api_flask.ratings_snapshot')  # goes to the api_flask log
+
+SNAPSHOT_DIR = os.path.join('cache', 'ratings_snapshot')
+LOCK_FILE = 'export.lock'
+FORMAT = 2
+COLUMNS = (('user_index', np.int32), ('movie_index', np.int32), ('rating', np.float32), ('timestamp', np.int64))
+ID_MAPS = (('user_ids', np.int64), ('movie_ids', np.int64))
+
+
+class RatingsSnapshot:
+    # read only, memory-mapped view of the rows of one manifest
+    def __init__(self, path, manifest):
+        self.path = path
+        self.manifest = manifest
+        self.rows = manifest['rows']
+        self.columns = {name: self._map(name, dtype, self.rows) for name, dtype in COLUMNS}
+        self.user_ids = self._map('user_ids', np.int64, manifest['users'])  # in order of first appearance
+        self.movie_ids = self._map('movie_ids', np.int64, manifest['movies'])
+
+    def _map(self, name, dtype, length):
+        if not length:  # mmap can't map an empty file
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, f'{name}.bin'), dtype=dtype, mode='r', shape=(length,))
+
+    @classmethod
+    def open(cls, directory=SNAPSHOT_DIR):
+        # the latest generation, None if there is no snapshot
+        generation = latest_version(directory)
+        if generation is None:
+            return None
+        path = os.path.join(directory, generation)
+        with open(os.path.join(path, 'manifest.json')) as f:
+            return cls(path, json.load(f))
+
+    @property
+    def user_index(self):
+        return self.columns['user_index']
+
+    @property
+    def movie_index(self):
+        return self.columns['movie_index']
+
+    @property
+    def rating(self):
+        return self.columns['rating']
+
+    @property
+    def timestamp(self):
+        return self.columns['timestamp']
+
+    def latest(self):
+        # rows of the current rating of every (user, movie) pair, the newest row of the pair, in row order
+        keys = self.user_index.astype(np.int64) * max(len(self.movie_ids), 1) + self.movie_index
+        _, last = np.unique(keys[::-1], return_index=True)
+        return np.sort(self.rows - 1 - last)
+
+    def ratings(self):
+        # (user_id, movie_id, rating, timestamp) columns of the current ratings, like rating_matrix.fetch_ratings
+        rows = self.latest()
+        return (self.user_ids[self.user_index[rows]], self.movie_ids[self.movie_index[rows]],
+                np.asarray(self.rating[rows]), np.asarray(self.timestamp[rows]))
+
+
+def fetch_rows(db, query):
+    # (rating id, user_id, movie_id, rating, unix timestamp) columns of the query, fetched in chunks
+    dtypes = (np.int64, np.int64, np.int64, np.float32, np.int64)
+    result = db.session.execute(query.execution_options(yield_per=FETCH_SIZE))
+    chunks = [[np.array(column, dtype=dtype) for column, dtype in zip(zip(*rows), dtypes)]
+              for rows in result.partitions()]
+    if not chunks:
+        return tuple(np.empty(0, dtype=dtype) for dtype in dtypes)
+    return tuple(np.concatenate(columns) for columns in zip(*chunks))
+
+
+def rating_rows():
+    # the timestamp is converted to unix seconds by SQLite, like in fetch_ratings
+    return select(Ratings.id, Ratings.user_id, Ratings.movie_id, Ratings.rating,
+                  cast(func.strftime('%s', Ratings.timestamp), Integer))
+
+
+def extend_ids(ids, values):
+    # (id map, index of every value), ids that are not in the map yet are appended sorted
+    order = np.argsort(ids, kind='stable')
+    positions = indices_of(ids[order], values)
+    new = np.unique(values[positions < 0])
+    indices = np.where(positions >= 0, order[positions.clip(0)] if len(ids) else 0,
+                       len(ids) + np.searchsorted(new, values))
+    return np.concatenate([ids, new]), indices.astype(np.int32)
+
+
+def append_files(path, arrays, lengths):
+    # appends every array to its file, after cutting off what an interrupted append left behind
+    for name, (array, dtype) in arrays.items():
+        with open(os.path.join(path, f'{name}.bin'), 'ab') as f:
+            f.truncate(lengths[name] * np.dtype(dtype).itemsize)
+            np.ascontiguousarray(array, dtype=dtype).tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def write_manifest(path, manifest):
+    write_atomic(os.path.join(path, 'manifest.json'), json.dumps(manifest, indent=2))
+
+
+def watermark(db):
+    # (rating count, max rating id, last sequence number of the change log)
+    count, max_id = db.session.execute(select(func.count(), func.max(Ratings.id))).one()
+    return count, max_id or 0, change_sequence(db)[0]
+
+
+def prune_changes(db, seq):
+    # the log entries up to seq are in the snapshot
+    db.session.execute(RatingChange.__table__.delete().where(RatingChange.seq <= seq))
+    db.session.commit()
+
+
+@contextmanager
+def export_lock(directory):
+    # one exporter at a time per snapshot directory, the others wait
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, LOCK_FILE), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def export(db, directory=SNAPSHOT_DIR, full=False):
+    # brings the snapshot up to date and returns it: appends what changed since the last export, or writes
+    # a new generation ( full, no snapshot yet, another database, deleted ratings )
+    with export_lock(directory):
+        return export_locked(db, directory, full)
+
+
+def export_locked(db, directory, full):
+    started = time.perf_counter()
+    version = ratings_version(db)
+    count, max_id, seq = watermark(db)
+    snapshot = None if full else RatingsSnapshot.open(directory)
+    if snapshot is not None:
+        manifest = snapshot.manifest
+        if manifest['ratings_version'] == version:
+            return snapshot
+        inserted = db.session.execute(select(func.count()).where(
+            Ratings.id > manifest['max_rating_id'], Ratings.id <= max_id)).scalar()
+        if manifest['format'] != FORMAT or manifest['database'] != db.engine.url.render_as_string():
+            logger.info("ratings snapshot of another database or format, writing a new one")
+        elif manifest['rating_count'] + inserted != count:
+            logger.info("ratings were deleted since the last export, writing a new snapshot")
+        elif manifest['change_seq'] < change_sequence(db)[1]:
+            logger.info("the change log was pruned past the snapshot, writing a new one")
+        else:
+            return append(db, snapshot, version, (count, max_id, seq), started)
+
+    # every rating in id order
+    ids, users, movies, ratings, timestamps = fetch_rows(db, rating_rows().where(Ratings.id <= max_id))
+    user_ids, user_index = extend_ids(np.empty(0, np.int64), users)
+    movie_ids, movie_index = extend_ids(np.empty(0, np.int64), movies)
+    generation = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    path = os.path.join(directory, generation)
+    os.makedirs(path)
+    append_files(path, {'user_index': (user_index, np.int32), 'movie_index': (movie_index, np.int32),
+                        'rating': (ratings, np.float32), 'timestamp': (timestamps, np.int64),
+                        'user_ids': (user_ids, np.int64), 'movie_ids': (movie_ids, np.int64)},
+                 dict.fromkeys(('user_index', 'movie_index', 'rating', 'timestamp', 'user_ids', 'movie_ids'), 0))
+    now = datetime.now().isoformat(timespec='seconds')
+    write_manifest(path, {
+        'format': FORMAT, 'generation': generation, 'database': db.engine.url.render_as_string(),
+        'ratings_version': version, 'rows': len(ids), 'users': len(user_ids), 'movies': len(movie_ids),
+        'rating_count': count, 'max_rating_id': max_id, 'change_seq': seq,
+        'columns': {name: np.dtype(dtype).name for name, dtype in COLUMNS + ID_MAPS},
+        'created': now, 'updated': now, 'appends': 0})
+    write_atomic(os.path.join(directory, 'latest'), generation)
+    remove_old_generations(directory, generation)
+    prune_changes(db, seq)
+    logger.info(f"ratings snapshot {generation}: {len(ids)} ratings in {time.perf_counter() - started:.2f}s")
+    return RatingsSnapshot.open(directory)
+
+
+def append(db, snapshot, version, current, started):
+    # appends the ratings inserted ( id past the watermark ) or overwritten ( logged past the sequence number )
+    # since the export
+    count, max_id, seq = current
+    manifest = dict(snapshot.manifest)
+    last_id = manifest['max_rating_id']
+    changed = select(RatingChange.rating_id).where(RatingChange.seq > manifest['change_seq'], RatingChange.seq <= seq)
+    parts = [fetch_rows(db, rating_rows().where(Ratings.id > last_id, Ratings.id <= max_id)),
+             fetch_rows(db, rating_rows().where(Ratings.id.in_(changed), Ratings.id <= last_id))]
+    ids, users, movies, ratings, timestamps = (np.concatenate(column) for column in zip(*parts))
+
+    user_ids, user_index = extend_ids(np.asarray(snapshot.user_ids), users)
+    movie_ids, movie_index = extend_ids(np.asarray(snapshot.movie_ids), movies)
+    lengths = {name: manifest['rows'] for name, _ in COLUMNS}
+    lengths.update(user_ids=manifest['users'], movie_ids=manifest['movies'])
+    append_files(snapshot.path, {'user_index': (user_index, np.int32), 'movie_index': (movie_index, np.int32),
+                                 'rating': (ratings, np.float32), 'timestamp': (timestamps, np.int64),
+                                 'user_ids': (user_ids[manifest['users']:], np.int64),
+                                 'movie_ids': (movie_ids[manifest['movies']:], np.int64)}, lengths)
+    manifest.update(ratings_version=version, rows=manifest['rows'] + len(ids), users=len(user_ids),
+                    movies=len(movie_ids), rating_count=count, max_rating_id=max_id, change_seq=seq,
+                    updated=datetime.now().isoformat(timespec='seconds'), appends=manifest['appends'] + 1)
+    write_manifest(snapshot.path, manifest)
+    prune_changes(db, seq)
+    logger.info(f"ratings snapshot {manifest['generation']}: appended {len(ids)} ratings "
+                f"in {time.perf_counter() - started:.2f}s")
+    return RatingsSnapshot(snapshot.path, manifest)
+
+
+def remove_old_generations(directory, current):
+    # readers that still map an old generation keep their files until they let go of them
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name != current and os.path.isdir(path):
+            for filename in os.listdir(path):
+                os.remove(os.path.join(path, filename))
+            os.rmdir(path)
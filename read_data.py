@@ -1,9 +1,16 @@
 import csv
-from sqlalchemy.exc import IntegrityError
-from models import Movie, MovieGenre, Ratings, TagNames, Tags, Link, User
+from sqlalchemy import Integer, cast, func, select
+from sqlalchemy.exc import IntegrityError, OperationalError
+from models import Movie, MovieGenre, Ratings, Tags, Link, User
+from tag_interner import TagInterner
+import movie_stats
+from array import array
+from contextlib import contextmanager
 from datetime import datetime
-from tqdm import tqdm
+from jobs import JobProgress
+import numpy as np
 import re
+import time
 
 import logging
 from logging.handlers import RotatingFileHandler
@@ -25,28 +32,40 @@ logger.addHandler(handler)
 # - when an error occurs when commiting a batch,
 commit_batch_size = 1000 # commit every 1000 rows for faster performance
 commit_batch_size_movies = 100 # commit from the movies files every x rows ( lower number for better duplicate handling )
+bulk_chunk_size = 50000 # rows per executemany in the bulk loader
+
+# hashed password with the user_manager, passwrod: User123
+DEFAULT_USER_PASSWORD = '$2b$12$Yx/CbwsNtJaW38hrY5Nvfe/nUHkZPdfSOPY.cAuPtrn2Ogw5zp/vq'
+
+# pragmas used while bulk loading, trading durability for speed ( a crashed load has to be redone anyway )
+LOAD_PRAGMAS = {
+    'synchronous': 'OFF',
+    'journal_mode': 'MEMORY',
+    'temp_store': 'MEMORY',
+    'cache_size': '-200000',  # ~200MB page cache
+}
 
 def count_rows(filename, encoding='utf8'):
     return sum(1 for row in csv.reader(open(filename, newline='', encoding=encoding))) - 1
 
 # TODO , fix the individual commit when error accurs in a better way
 # - add title without the year
-def check_and_read_data(db):
+def check_and_read_data(db, data_dir='data'):
     # check if we have movies in the database
     # read data if database is empty
     unique_users = set()
 
     if Movie.query.count() == 0:
         # read movies from csv
-        total = count_rows('data/movies.csv')
-        with open('data/movies.csv', newline='', encoding='utf8') as csvfile:
+        total = count_rows(os.path.join(data_dir, 'movies.csv'))
+        with open(os.path.join(data_dir, 'movies.csv'), newline='', encoding='utf8') as csvfile:
             rowcount = Counter(name='Movies added')
             dupecount = Counter(name='Duplicate movies')
             movie_with_no_year = Counter(name='Movies with no year')
             reader = csv.reader(csvfile, delimiter=',')
             next(reader, None)  # skip the header row
             batch = []
-            for i, row in enumerate(tqdm(reader, total=total), start=1):
+            for i, row in enumerate(JobProgress(reader, total=total), start=1):
                 batch.append(row)
                 try:
                     rowcount.increment()
@@ -76,15 +95,20 @@ def check_and_read_data(db):
             logger.info(f"{total} rows read. Added {rowcount} movies to the database. Ignored {dupecount} duplicates. {movie_with_no_year} movies with no year.")
 
     if Ratings.query.count() == 0:
-        total = count_rows('data/ratings.csv')
+        total = count_rows(os.path.join(data_dir, 'ratings.csv'))
 
-        with open('data/ratings.csv', newline='', encoding='utf8') as csvfile:
+        with open(os.path.join(data_dir, 'ratings.csv'), newline='', encoding='utf8') as csvfile:
             rowcount = 0
             dupecount = 0
+            seen = set()  # (user, movie) pairs, a duplicate would fail the unique index and the whole batch
 
             reader = csv.reader(csvfile, delimiter=',')
             next(reader, None) # skip the header row
-            for i, row in enumerate(tqdm(reader, total=total)):
+            for i, row in enumerate(JobProgress(reader, total=total)):
+                if (row[0], row[1]) in seen:
+                    dupecount += 1
+                    continue
+                seen.add((row[0], row[1]))
                 try:
                     user_id = row[0]
                     timestamp = datetime.fromtimestamp(int(row[3]))
@@ -112,37 +136,34 @@ def check_and_read_data(db):
 
             logger.info('Ratings:')
             logger.info(f"{total} rows read. Added {rowcount} ratings to the database. Ignored {dupecount} duplicates.")
+        # the triggers kept the stats current with the default prior, the bulk loader's rebuild uses the
+        # mean of the loaded ratings, so both loaders leave the same stats
+        movie_stats.rebuild_from_database(db)
 
 
     if Tags.query.count() == 0:
-        total = count_rows('data/tags.csv')
+        total = count_rows(os.path.join(data_dir, 'tags.csv'))
 
-        with open('data/tags.csv', newline='', encoding='utf8') as csvfile:
+        with open(os.path.join(data_dir, 'tags.csv'), newline='', encoding='utf8') as csvfile:
             rowcount = 0
             dupecount = 0
             unique_tag_count = 0
+            interner = TagInterner().load(db.session)
 
             reader = csv.reader(csvfile, delimiter=',')
             next(reader, None)  # skip the header row
-            for i, row in enumerate(tqdm(reader, total=total)):
+            for i, row in enumerate(JobProgress(reader, total=total)):
                 try:
                     user_id = row[0]
                     movie_id = row[1]
                     tag_name = row[2]
                     timestamp = datetime.fromtimestamp(int(row[3]))
 
-                    # check if the tag name already exists
-                    tagname = TagNames.query.filter_by(name=tag_name).first()
-
-                    if tagname is None:
-                        # if the tag name doesn't exist, create a new Tagname
-                        tagname = TagNames(name=tag_name)
-                        db.session.add(tagname)
-                        db.session.commit()  # commit immediately to get the new Tagname's ID
-                        unique_tag_count += 1
+                    # new tag names get their id in memory and are inserted with the next commit
+                    tag_name_id = interner.intern(tag_name)
 
                     # create a new Tag with the Tagname's ID
-                    tag = Tags(user_id=user_id, movie_id=movie_id, tag_name_id=tagname.id, timestamp=timestamp)
+                    tag = Tags(user_id=user_id, movie_id=movie_id, tag_name_id=tag_name_id, timestamp=timestamp)
                     db.session.add(tag)
 
                     # add the user to the database if it doesn't exist
@@ -151,13 +172,16 @@ def check_and_read_data(db):
                         unique_users.add(user_id)
 
                     if i % commit_batch_size == 0:  # batch size, faster
+                        unique_tag_count += interner.flush(db.session)
                         db.session.commit()
                     rowcount += 1
                 except IntegrityError:
                     dupecount += 1
                     db.session.rollback()
+                    interner.load(db.session)  # the rolled back names are gone again
                     pass
             try:
+                unique_tag_count += interner.flush(db.session)
                 db.session.commit()
             except IntegrityError:
                 dupecount += 1
@@ -170,15 +194,15 @@ def check_and_read_data(db):
 
 	
     if Link.query.count() == 0:
-        total = count_rows('data/links.csv')
+        total = count_rows(os.path.join(data_dir, 'links.csv'))
 
-        with open('data/links.csv', newline='', encoding='utf8') as csvfile:
+        with open(os.path.join(data_dir, 'links.csv'), newline='', encoding='utf8') as csvfile:
             rowcount = 0
             dupecount = 0
 
             reader = csv.reader(csvfile, delimiter=',')
             next(reader, None)
-            for i, row in enumerate(tqdm(reader, total=total)):
+            for i, row in enumerate(JobProgress(reader, total=total)):
                 try:
                     movie_id = row[0]
                     ml_id = row[0]
@@ -218,29 +242,32 @@ def check_and_read_data(db):
 def add_user(db, user_id):
     # logger.info(f"creating new user: {user_id}")
     username = f'user_{user_id}'
-    # passwrod: User123
-    password = '$2b$12$Yx/CbwsNtJaW38hrY5Nvfe/nUHkZPdfSOPY.cAuPtrn2Ogw5zp/vq' # hashed password with the user_manager
-
-    user = User(id=user_id, username=username, password=password)
+    user = User(id=user_id, username=username, password=DEFAULT_USER_PASSWORD)
     db.session.add(user)
     
 
-def commit_problematic_batch(db, batch, rowcount, dupecount, **kwargs):
+def commit_problematic_batch(db, batch, rowcount, dupecount, movie_with_no_year_counter=None, **kwargs):
     # commit a batch of data that had an error,commit each row/entry individually
     # this is slower but allows us to identify the problematic row and keeps the counters accurate
     print(f'committing {len(batch)} rows individually')
+    if movie_with_no_year_counter:
+        # the rows were counted when the batch was added, count the ones that make it in again
+        movie_with_no_year_counter.change_by(-sum(parse_movie_row(row)[3] is None for row in batch))
     for row in batch:
         try:
-            add_movie_and_genre(db, row, **kwargs)
+            add_movie_and_genre(db, row, movie_with_no_year_counter=movie_with_no_year_counter, **kwargs)
             db.session.commit()  # commit immediately to get the new movie's ID
         except IntegrityError:
             logger.info(f"Ignoring duplicate movie id: {row[0]} , title: {row[1]}")
             db.session.rollback()
             rowcount.decrement()
             dupecount.increment()
+            if movie_with_no_year_counter and parse_movie_row(row)[3] is None:
+                movie_with_no_year_counter.decrement()
             pass
 
-def add_movie_and_genre(db, row, movie_with_no_year_counter=None, **kwargs):
+def parse_movie_row(row):
+    # split a movies.csv row into (id, original title, title without year, year or None, genres)
     id = row[0]
     original_title = row[1]
     year_match = re.search(r'\((\d{4})\)\s*$', original_title) # match the year at the end of the title
@@ -250,17 +277,240 @@ def add_movie_and_genre(db, row, movie_with_no_year_counter=None, **kwargs):
     else:
         year = None
         title = original_title.strip()
+    genres = row[2].split('|')  # genres is a list of genres
+    return id, original_title, title, year, genres
+
+def add_movie_and_genre(db, row, movie_with_no_year_counter=None, **kwargs):
+    id, original_title, title, year, genres = parse_movie_row(row)
+    if year is None:
         # logger.info(f"--Movie with no year: {original_title}")
         if movie_with_no_year_counter:
             movie_with_no_year_counter.increment()
     movie = Movie(id=id, title=original_title, title_stripped=title, year=year)
     db.session.add(movie)
-    genres = row[2].split('|')  # genres is a list of genres
     for genre in genres:  # add each genre to the movie_genre table
         movie_genre = MovieGenre(movie_id=id, genre=genre)
         db.session.add(movie_genre)
 
 
+# ---------------------------------------------------------------------------
+# bulk loader
+# one streaming pass per file, Core level executemany in chunks and in memory
+# deduplication of users and movies instead of one ORM object per csv row
+# ---------------------------------------------------------------------------
+
+# SQLite NOCASE only folds ASCII letters, use the same folding for the title dedupe
+_NOCASE = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+def nocase_key(value):
+    return value.translate(_NOCASE)
+
+@contextmanager
+def bulk_connection(db, pragmas=None):
+    # connection with the load time pragmas set, restores the previous values afterwards
+    pragmas = LOAD_PRAGMAS if pragmas is None else pragmas
+    db.session.remove()  # don't keep a read transaction open on another connection
+    db.engine.dispose()  # leaving WAL mode needs the only connection to the database
+    with db.engine.connect() as conn:
+        previous = {name: conn.exec_driver_sql(f'PRAGMA {name}').scalar() for name in pragmas}
+        for name, value in pragmas.items():
+            try:
+                conn.exec_driver_sql(f'PRAGMA {name} = {value}')
+            except OperationalError:
+                # e.g. the journal mode while a web worker has the database open, load with the current one
+                logger.warning(f"could not set PRAGMA {name} = {value}, keeping {previous[name]}")
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.rollback()
+            for name, value in previous.items():
+                conn.exec_driver_sql(f'PRAGMA {name} = {value}')
+
+def table_is_empty(conn, model):
+    return conn.execute(select(func.count()).select_from(model.__table__)).scalar() == 0
+
+class ChunkedInserter:
+    # collects rows for one table and inserts them with executemany every chunk_size rows
+    def __init__(self, conn, model, chunk_size=None, depends_on=(), ignore_conflicts=False):
+        self.conn = conn
+        self.table = model.__table__
+        self.insert = self.table.insert().prefix_with('OR IGNORE') if ignore_conflicts else self.table.insert()
+        self.chunk_size = chunk_size or bulk_chunk_size
+        self.depends_on = depends_on  # inserters whose rows are referenced by ours, flushed first
+        self.rows = []
+        self.count = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            for inserter in self.depends_on:
+                inserter.flush()
+            result = self.conn.execute(self.insert, self.rows)
+            self.conn.commit()
+            self.count += result.rowcount  # without the ignored rows
+            self.rows = []
+        return self.count
+
+class InternerFlush:
+    # lets a ChunkedInserter insert the pending tag names before the tags referencing them
+    def __init__(self, interner, conn):
+        self.interner = interner
+        self.conn = conn
+        self.count = 0
+
+    def flush(self):
+        self.count += self.interner.flush(self.conn)
+        return self.count
+
+def stored_rating_columns(conn):
+    # (movie ids, ratings, timestamps) of the stored ratings, the timestamps as the seconds of strftime('%s')
+    query = select(Ratings.movie_id, Ratings.rating, cast(func.strftime('%s', Ratings.timestamp), Integer))
+    rows = conn.execute(query).all()
+    if not rows:
+        return np.empty(0, np.int64), np.empty(0, np.float64), np.empty(0, np.int64)
+    movie_ids, ratings, timestamps = zip(*rows)
+    return np.array(movie_ids, np.int64), np.array(ratings, np.float64), np.array(timestamps, np.int64)
+
+def log_rate(name, rows, started):
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    message = f"{name}: {rows} rows in {elapsed:.2f}s ({rows / elapsed:.0f} rows/sec)"
+    logger.info(message)
+    print(message)
+
+def read_csv(filename, desc):
+    # stream the rows of a csv file once, without counting them beforehand
+    with open(filename, newline='', encoding='utf8') as csvfile:
+        reader = csv.reader(csvfile, delimiter=',')
+        next(reader, None)  # skip the header row
+        yield from JobProgress(reader, desc=desc, unit=' rows')
+
+def bulk_read_data(db, data_dir='data', chunk_size=None):
+    # bulk version of check_and_read_data, loads every table that is still empty
+    with bulk_connection(db) as conn:
+        known_users = set(conn.execute(select(User.id)).scalars())
+        new_users = ChunkedInserter(conn, User, chunk_size)
+
+        def add_user_once(user_id):
+            if user_id not in known_users:
+                known_users.add(user_id)
+                new_users.add({'id': user_id, 'username': f'user_{user_id}', 'password': DEFAULT_USER_PASSWORD})
+
+        if table_is_empty(conn, Movie):
+            bulk_load_movies(conn, os.path.join(data_dir, 'movies.csv'), chunk_size)
+
+        if table_is_empty(conn, Ratings):
+            started = time.perf_counter()
+            # no per row stats triggers, the columns are kept for one pass over them once all rows are in
+            movie_stats.drop_triggers(conn, movie_stats.RATING_TRIGGERS)
+            columns = (array('q'), array('d'), array('q'))  # movie ids, ratings, timestamps
+            # a duplicate (user, movie) row is ignored, the first one stays
+            ratings = ChunkedInserter(conn, Ratings, chunk_size, ignore_conflicts=True)
+            total = 0
+            for row in read_csv(os.path.join(data_dir, 'ratings.csv'), 'ratings'):
+                total += 1
+                user_id = int(row[0])
+                movie_id, rating, timestamp = int(row[1]), float(row[2]), int(row[3])
+                stored = datetime.fromtimestamp(timestamp)
+                ratings.add({'movie_id': movie_id, 'user_id': user_id, 'rating': rating, 'timestamp': stored})
+                add_user_once(user_id)
+                columns[0].append(movie_id)
+                columns[1].append(rating)
+                columns[2].append(movie_stats.stored_seconds(stored))
+            rowcount = ratings.flush()
+            log_rate('Ratings', rowcount, started)
+            started = time.perf_counter()
+            columns = [np.frombuffer(column, dtype=column.typecode) for column in columns]
+            if rowcount < total:  # the columns still have the ignored duplicates, aggregate the stored rows
+                columns = stored_rating_columns(conn)
+            movie_stats.rebuild(conn, *columns)
+            conn.commit()
+            log_rate('Movie stats', rowcount, started)
+            logger.info('Ratings:')
+            logger.info(f"{total} rows read. Added {rowcount} ratings to the database. "
+                        f"Ignored {total - rowcount} duplicates.")
+
+        if table_is_empty(conn, Tags):
+            bulk_load_tags(conn, os.path.join(data_dir, 'tags.csv'), add_user_once, chunk_size)
+
+        if table_is_empty(conn, Link):
+            started = time.perf_counter()
+            links = ChunkedInserter(conn, Link, chunk_size)
+            total = 0
+            for row in read_csv(os.path.join(data_dir, 'links.csv'), 'links'):
+                total += 1
+                links.add({'movie_id': int(row[0]),
+                           'ml_url': f"https://movielens.org/movies/{row[0]}",
+                           'imdb_url': f"https://www.imdb.com/title/tt{row[1]}",
+                           'tmdb_url': f"https://www.themoviedb.org/movie/{row[2]}"})
+            rowcount = links.flush()
+            log_rate('Links', rowcount, started)
+            logger.info('Links:')
+            logger.info(f"{total} rows read. Added {rowcount} Links to the database. Ignored 0 duplicates.")
+
+        started = time.perf_counter()
+        usercount = new_users.flush()
+        log_rate('Users', usercount, started)
+        logger.info('Users:')
+        logger.info(f"added {usercount} users to the database.")
+
+def bulk_load_movies(conn, filename, chunk_size=None):
+    started = time.perf_counter()
+    rowcount = Counter(name='Movies added')
+    dupecount = Counter(name='Duplicate movies')
+    movie_with_no_year = Counter(name='Movies with no year')
+    movies = ChunkedInserter(conn, Movie, chunk_size)
+    genres = ChunkedInserter(conn, MovieGenre, chunk_size, depends_on=[movies])
+    seen_ids = set()
+    seen_titles = set()
+    total = 0
+    for row in read_csv(filename, 'movies'):
+        total += 1
+        id, original_title, title, year, movie_genres = parse_movie_row(row)
+        id = int(id)
+        # same rule as the unique constraints on movies.id and movies.title
+        title_key = nocase_key(original_title)
+        if id in seen_ids or title_key in seen_titles:
+            logger.info(f"Ignoring duplicate movie id: {id} , title: {original_title}")
+            dupecount.increment()
+            continue
+        seen_ids.add(id)
+        seen_titles.add(title_key)
+        if year is None:
+            movie_with_no_year.increment()
+        rowcount.increment()
+        movies.add({'id': id, 'title': original_title, 'title_stripped': title, 'year': int(year) if year else 0})
+        for genre in movie_genres:
+            genres.add({'movie_id': id, 'genre': genre})
+    movies.flush()
+    genres.flush()
+    log_rate('Movies', rowcount.get(), started)
+    logger.info('Movies:')
+    logger.info(f"{total} rows read. Added {rowcount} movies to the database. Ignored {dupecount} duplicates. {movie_with_no_year} movies with no year.")
+
+def bulk_load_tags(conn, filename, add_user_once, chunk_size=None):
+    started = time.perf_counter()
+    interner = TagInterner().load(conn)
+    new_tagnames = InternerFlush(interner, conn)
+    tags = ChunkedInserter(conn, Tags, chunk_size, depends_on=[new_tagnames])
+    total = 0
+    for row in read_csv(filename, 'tags'):
+        total += 1
+        user_id = int(row[0])
+        tags.add({'user_id': user_id, 'movie_id': int(row[1]), 'tag_name_id': interner.intern(row[2]),
+                  'timestamp': datetime.fromtimestamp(int(row[3]))})
+        add_user_once(user_id)
+    rowcount = tags.flush()
+    unique_tag_count = new_tagnames.flush()
+    log_rate('Tags', rowcount, started)
+    logger.info('Tags:')
+    logger.info(f"{total} rows read. Added {rowcount} tags to the database. Ignored 0 duplicates. {unique_tag_count} unique tags added.")
+
+
 # simple counter class
 class Counter:
     def __init__(self, start=0, name='Counter'):
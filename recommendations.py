@@ -0,0 +1,143 @@
+import os
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+from als import ALSModel, ARTIFACT_DIR
+from rating_matrix import get_rating_matrix, indices_of
+
+# Top-N recommendations of every user, computed in one batch job after training
+# and stored next to the factors of the model version as memory-mapped arrays:
+#   recommendations.npy        users x n movie ids ( -1 where there are fewer than n )
+#   recommendation_scores.npy  users x n scores
+# rows follow user_ids.npy of the model, so serving a page is a binary search and a slice.
+
+RECOMMENDATIONS_FILE = 'recommendations.npy'
+SCORES_FILE = 'recommendation_scores.npy'
+
+
+def top_n(scores, n):
+    # column indices of the n highest scores per row, best first
+    n = min(n, scores.shape[1])
+    best = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    best_scores = np.take_along_axis(scores, best, axis=1)
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+def precompute_recommendations(ratings, model, n=50, block_size=1024, callback=None, content=None,
+                               content_weight=0.0):
+    # (movie ids, scores) of the n best unrated movies for every user of the model
+    # ratings is the current RatingMatrix, it may contain ratings made after training
+    # content: content neighbours of the model movies ( ContentFeatures.neighbours ), makes the scores a
+    # hybrid: a user's ratings spread over the neighbours of the rated movies, blended in per movie
+    X, Y = np.asarray(model.user_factors), np.asarray(model.item_factors)
+    R = ratings.matrix
+    n = min(n, Y.shape[0])
+    # rows of the model users in the rating matrix and model columns of the rating matrix columns
+    user_rows = ratings.user_indices(model.user_ids)
+    model_columns = indices_of(model.movie_ids, ratings.movie_ids)
+    if content is not None:
+        from content_features import hybrid_scores, hybrid_weights
+        rating_columns = indices_of(ratings.movie_ids, model.movie_ids)
+        rating_counts = np.bincount(R.indices, minlength=R.shape[1])
+        weights = hybrid_weights(np.where(rating_columns >= 0, rating_counts[rating_columns.clip(0)], 0),
+                                 content_weight)
+    movies = np.full((X.shape[0], n), -1, dtype=np.int32)
+    scores = np.full((X.shape[0], n), -np.inf, dtype=np.float32)
+    for lo in range(0, X.shape[0], block_size):
+        hi = min(lo + block_size, X.shape[0])
+        block = X[lo:hi] @ Y.T
+        # mask the movies the users already rated
+        rows = user_rows[lo:hi]
+        known = np.flatnonzero(rows >= 0)
+        rated = R[rows[known]]
+        columns = model_columns[rated.indices]
+        block_rows = np.repeat(known, np.diff(rated.indptr))
+        if content is not None:
+            ok = columns >= 0
+            profile = sp.csr_matrix((rated.data[ok], (block_rows[ok], columns[ok])), shape=(hi - lo, Y.shape[0]))
+            block = hybrid_scores(block, (profile @ content).toarray(), weights)
+        block[block_rows[columns >= 0], columns[columns >= 0]] = -np.inf
+        best, best_scores = top_n(block, n)
+        found = np.isfinite(best_scores)
+        movies[lo:hi] = np.where(found, model.movie_ids[best], -1)
+        scores[lo:hi] = best_scores
+        if callback:
+            callback(hi, X.shape[0])
+    return movies, scores
+
+
+def save_recommendations(movies, scores, version, artifact_dir=ARTIFACT_DIR):
+    path = os.path.join(artifact_dir, version)
+    for filename, array in ((RECOMMENDATIONS_FILE, movies), (SCORES_FILE, scores)):
+        tmp = os.path.join(path, f'tmp-{filename}')
+        np.save(tmp, array)
+        os.replace(tmp, os.path.join(path, filename))
+
+
+class RecommendationStore:
+    # read only view of the precomputed recommendations of one model version
+    def __init__(self, version, artifact_dir=ARTIFACT_DIR):
+        path = os.path.join(artifact_dir, version)
+        self.version = version
+        self.user_ids = np.load(os.path.join(path, 'user_ids.npy'))
+        self.movies = np.load(os.path.join(path, RECOMMENDATIONS_FILE), mmap_mode='r')
+        self.scores = np.load(os.path.join(path, SCORES_FILE), mmap_mode='r')
+
+    def for_user(self, user_id, n=None):
+        # recommended movie ids of the user, best first, empty if the user is unknown to the model
+        i = np.searchsorted(self.user_ids, user_id)
+        if i >= len(self.user_ids) or self.user_ids[i] != user_id:
+            return []
+        row = self.movies[i, :n]
+        return [int(movie_id) for movie_id in row if movie_id >= 0]
+
+
+def online_recommendations(user_vector, rated_movie_ids=(), n=50, serving=None, artifact_dir=ARTIFACT_DIR):
+    # top-n movie ids for a user vector that is not in the precomputed table ( new or just updated users )
+    # uses the ANN index of the served model ( or the given model_registry.ServingModel ) when there is one,
+    # the exact search otherwise
+    if serving is None:
+        from model_registry import get_serving_model
+        serving = get_serving_model(artifact_dir)
+        if serving is None:
+            return []
+    if serving.ann is None:
+        model = serving.model
+        scores = np.asarray(model.item_factors) @ user_vector
+        columns = indices_of(model.movie_ids, np.asarray(rated_movie_ids, dtype=np.int64))
+        scores[columns[columns >= 0]] = -np.inf
+        best, best_scores = top_n(scores[None, :], n)
+        return [int(model.movie_ids[c]) for c, s in zip(best[0], best_scores[0]) if np.isfinite(s)]
+    movie_ids, _ = serving.ann.search_movies(user_vector, n, exclude_movie_ids=rated_movie_ids)
+    return [int(movie_id) for movie_id in movie_ids]
+
+
+def precompute(db, n=50, block_size=1024, artifact_dir=ARTIFACT_DIR, version=None, callback=None,
+               content_weight=0.0, content_k=50, publish=True):
+    # batch job: scores all users of the latest ( or given ) model version and stores their top-n,
+    # callback(users done, users) after every block. content_weight > 0 blends in the content features
+    # ( brought up to date first ), movies with few ratings get up to all of their score from them.
+    # publish: the web serves the version once it is stored and warmed ( model_registry.publish )
+    import model_registry
+    started = time.perf_counter()
+    model = ALSModel.load(artifact_dir, version)
+    if model_registry.is_published(model.version, artifact_dir):
+        raise ValueError(f'model {model.version} is published and can not change, train a new version first')
+    ratings = get_rating_matrix(db)
+    content = None
+    if content_weight > 0:
+        import content_features
+        features, _ = content_features.build(db)
+        content = features.neighbours(model.movie_ids, content_k)
+    movies, scores = precompute_recommendations(ratings, model, n, block_size, callback, content, content_weight)
+    save_recommendations(movies, scores, model.version, artifact_dir)
+    seconds = time.perf_counter() - started
+    print(f"Stored top {movies.shape[1]} recommendations of {movies.shape[0]} users for model {model.version} "
+          f"in {seconds:.2f}s ({movies.shape[0] / max(seconds, 1e-9):.0f} users/sec)")
+    if publish:
+        model_registry.publish(model.version, artifact_dir)
+        print(f"Published model {model.version}")
+    return model.version
@@ -1,31 +1,51 @@
 # Contains parts from: https://flask-user.readthedocs.io/en/latest/quickstart_app.html
 
-from flask import Flask, render_template, request, g, url_for, redirect, jsonify
+import time
+started = time.perf_counter()  # the whole import counts towards the startup report
+
+import click
+from flask import Flask, Blueprint, abort, current_app, render_template, request, url_for, redirect, jsonify, session
 from flask_user import login_required, UserManager, current_user
-from sqlalchemy.orm import joinedload
+from markupsafe import Markup
+from sqlalchemy.orm import selectinload
 
 
-from models import db, User, Movie, MovieGenre, Link, Tags, TagNames, Ratings
-from read_data import check_and_read_data
+from models import db, User, Movie, Tags, Ratings, MovieStats
+from tag_interner import add_tags
+from page_cache import PageCache, catalogue_version, user_etag
+from storage import ensure_schema, install_connection_pragmas
+from movie_stats import SORTS, sorted_page
+from rating_writes import MAX_BATCH_SIZE, RatingBuffer, known_movie_ids, parse_ratings, rating_rows, upsert_ratings
+from startup import StartupTimer
+import metrics
+from metrics import timed_job
 
 from datetime import datetime
-import time
 
+import hmac
+import json
 import logging
+from functools import wraps
 from logging.handlers import RotatingFileHandler
 import os
 
-if not os.path.exists('logs'):
-    os.mkdir('logs')
+# numpy / scipy ( genre index, fold-in, models ) and the data loaders are imported on first use,
+# so starting a worker or a flask command that doesn't need them stays fast
 
-# logging
 logger = logging.getLogger('api_flask')
-logger.setLevel(logging.INFO)
-handler = RotatingFileHandler('logs/api_flask.log', maxBytes=10*1024*1024, backupCount=3)
-handler.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s | %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+IMPORT_SECONDS = time.perf_counter() - started
+
+def configure_logging():
+    if logger.handlers:
+        return
+    if not os.path.exists('logs'):
+        os.mkdir('logs')
+    logger.setLevel(logging.INFO)
+    handler = RotatingFileHandler('logs/api_flask.log', maxBytes=10*1024*1024, backupCount=3)
+    handler.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s | %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
 
 # Class-based application configuration
 class ConfigClass(object):
@@ -37,6 +57,7 @@ class ConfigClass(object):
     # Flask-SQLAlchemy settings
     SQLALCHEMY_DATABASE_URI = 'sqlite:///movie_recommender.sqlite'  # File-based SQL database
     SQLALCHEMY_TRACK_MODIFICATIONS = False  # Avoids SQLAlchemy warning
+    SQLALCHEMY_BINDS = {'jobs': 'sqlite:///jobs.sqlite'}  # the background job queue ( see jobs.py )
 
     # Flask-User settings
     USER_APP_NAME = "Movie Recommender"  # Shown in and email templates and page footers
@@ -44,22 +65,170 @@ class ConfigClass(object):
     USER_ENABLE_USERNAME = True  # Enable username authentication
     USER_REQUIRE_RETYPE_PASSWORD = True  # Simplify register form
 
+    # snapshot of the genre index, read by new workers while the catalogue is unchanged
+    GENRE_INDEX_SNAPSHOT = os.path.join('cache', 'genre_index.npz')
+
+    # Metrics settings ( GET /metrics )
+    N_PLUS_ONE_THRESHOLD = 10  # a request running one statement more often than this is logged
+    PROFILE_SAMPLE_RATE = 0.0  # share of the requests run under cProfile, 0 disables profiling
+    PROFILE_SLOW_SECONDS = 0.5  # profiles of faster requests are dropped
+    PROFILE_DIR = 'profiles'
+    METRICS_LOCALHOST = True  # scrapes from localhost need no token, others the bearer token JOBS_API_TOKEN
+
+    # Page cache settings
+    PAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024  # rendered movie lists kept in memory per worker
+
+    # Rating write settings
+    RATING_WRITE_BEHIND = False  # True: buffer ratings and commit them periodically, lost on a crash of the worker
+    RATING_FLUSH_SECONDS = 1.0  # how often the write-behind buffer is committed
+
+    # Background job settings ( flask jobs worker, /jobs )
+    JOBS_API_TOKEN = os.environ.get('JOBS_API_TOKEN')  # bearer token of the /jobs endpoints, unset disables them
+    JOBS_CONCURRENCY = 1  # jobs a worker runs at the same time
+
+# routes and flask commands, registered on the app by create_app
+main = Blueprint('main', __name__, cli_group=None)
+
 # Create Flask app
-app = Flask(__name__)
-app.debug = True  # only for development
-app.config.from_object(__name__ + '.ConfigClass')  # configuration
-app.app_context().push()  # create an app context before initializing db
-db.init_app(app)  # initialize database
-db.create_all()  # create database if necessary
-user_manager = UserManager(app, db, User)  # initialize Flask-User management
+def create_app(config=None):
+    # gunicorn 'recommender:create_app()', `flask` finds it on its own
+    timer = StartupTimer()
+    configure_logging()
+    app = Flask(__name__)
+    app.debug = True  # only for development
+    app.config.from_object(ConfigClass)  # configuration
+    app.config.from_mapping(config or {})
+    db.init_app(app)  # initialize database
+    with app.app_context():
+        for engine in db.engines.values():  # the main and the job database
+            install_connection_pragmas(engine)  # WAL and tuned pragmas on every connection
+        metrics.install_sql_metrics(db.engine)  # SQL statements and time per request
+        with timer.step('schema'):
+            ensure_schema(db)  # one query when the database is up to date
+        db.session.remove()
+    with timer.step('flask-user'):
+        UserManager(app, db, User)  # initialize Flask-User management
+    app.register_blueprint(main)
+    metrics.init_app(app)  # latency, SQL and job metrics on /metrics
+
+    app.extensions['page_cache'] = PageCache(app.config['PAGE_CACHE_MAX_BYTES'])
+    app.extensions['rating_buffer'] = None
+    if app.config['RATING_WRITE_BEHIND']:
+        # the users of a flushed batch get their vectors folded in once the ratings are in the database
+        from fold_in import schedule_fold_in
+        app.extensions['rating_buffer'] = RatingBuffer(
+            app, db, app.config['RATING_FLUSH_SECONDS'],
+            on_flush=lambda user_ids: [schedule_fold_in(app, db, user_id) for user_id in user_ids])
+
+    app.extensions['startup_report'] = timer.finish(IMPORT_SECONDS)  # logged to the api_flask log
+    return app
 
 
 # global variables
 MOVIES_PER_PAGE = 5
+RECOMMENDATIONS_PER_PAGE = 20
+SIMILAR_MOVIES = 10
+SEARCH_RESULTS = 20
+AUTOCOMPLETE_RESULTS = 8
 RATING_RANGE = (0, 5)
 
-unique_genres = MovieGenre.query.with_entities(MovieGenre.genre).distinct().all()
-GENRELISTE = [genre[0] for genre in unique_genres]
+def current_genre_index():
+    # the genre index of the app, loaded on first use ( from the snapshot if the catalogue didn't change )
+    # and reloaded when another process changed the catalogue
+    from genre_index import GenreIndex
+    index = current_app.extensions.get('genre_index')
+    path = current_app.config['GENRE_INDEX_SNAPSHOT']
+    index = GenreIndex.load_cached(db, path) if index is None else index.refresh_if_changed(db, path)
+    current_app.extensions['genre_index'] = index
+    return index
+
+def current_title_index():
+    # the title search index of the app, loaded on first use and reloaded when the catalogue changed
+    from title_search import TitleIndex
+    index = current_app.extensions.get('title_index')
+    index = TitleIndex.load(db) if index is None else index.refresh_if_changed(db)
+    current_app.extensions['title_index'] = index
+    return index
+
+def all_genres():
+    return current_genre_index().genres
+
+def rating_buffer():
+    return current_app.extensions['rating_buffer']
+
+def page_cache():
+    return current_app.extensions['page_cache']
+
+def movie_listing_options():
+    # everything movies.html shows of a movie, loaded with one query per relationship for the whole page
+    # instead of lazily per movie ( 4 queries for a page, no matter how many movies it has ). Built on use,
+    # the options configure all mappers, which would otherwise be part of the import
+    return (
+        selectinload(Movie.genres),
+        selectinload(Movie.links),
+        selectinload(Movie.tags).joinedload(Tags.tag_name),
+    )
+
+def movies_by_ids(movie_ids):
+    # the movies with all their listing data, in the order of movie_ids
+    movies = Movie.query.options(*movie_listing_options()).filter(Movie.id.in_(movie_ids)).all()
+    movies_by_id = {movie.id: movie for movie in movies}
+    return [movies_by_id[movie_id] for movie_id in movie_ids if movie_id in movies_by_id]
+
+def movies_for_page(pagination):
+    # the movies of a keyset page, in id order
+    pagination.items = movies_by_ids(pagination.ids)
+    return pagination.items
+
+def render_movie_list(movies, genres=None, mode=None):
+    return Markup(render_template("movie_list.html", movies=movies, genres=genres or [], mode=mode))
+
+def chosen_ratings(movie_ids):
+    # {movie id: rating} of the current user for the given movies
+    rows = Ratings.query.with_entities(Ratings.movie_id, Ratings.rating).filter(
+        Ratings.user_id == current_user.id, Ratings.movie_id.in_(movie_ids))
+    ratings = {movie_id: rating for movie_id, rating in rows}
+    if rating_buffer():
+        ratings.update(rating_buffer().pending_for(current_user.id, movie_ids))
+    return ratings
+
+def write_ratings(user_id, ratings):
+    # upserts [(movie id, rating)] of a user in one transaction ( or hands them to the write-behind buffer ),
+    # returns the ratings of movies that do not exist
+    known = known_movie_ids(db, [movie_id for movie_id, _ in ratings])
+    unknown = [(movie_id, rating) for movie_id, rating in ratings if movie_id not in known]
+    rows = rating_rows(user_id, [(movie_id, rating) for movie_id, rating in ratings if movie_id in known])
+    if rows:
+        if rating_buffer():
+            rating_buffer().add(rows)
+        else:
+            upsert_ratings(db, rows)
+            # update the user's latent vector in the background so recommendations follow the new ratings
+            from fold_in import schedule_fold_in
+            schedule_fold_in(current_app._get_current_object(), db, user_id)
+    return unknown
+
+def listing_response(pagination, genres=None, mode=None, sort=None):
+    # movies.html for a keyset page, the movie list comes from the page cache and the per user parts
+    # ( header, chosen ratings ) are rendered around it. The ETag covers both, so a browser or proxy
+    # revalidating an unchanged page gets a 304 without any rendering.
+    # The movie list is keyed on the movies it shows, the sorted listings change with every rating
+    key = (tuple(genres or ()), mode, tuple(pagination.ids))
+    entry = page_cache().get_or_render(key, catalogue_version(db),
+                                     lambda: render_movie_list(movies_for_page(pagination), genres, mode))
+    user_ratings = chosen_ratings(pagination.ids)
+    etag = user_etag(entry, current_user.id, user_ratings, f'{sort}|{pagination.has_prev}|{pagination.has_next}')
+    if etag in request.if_none_match and '_flashes' not in session:
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.make_response(render_template(
+            "movies.html", movies_html=Markup(entry.html), genres=genres or [], mode=mode, sort=sort,
+            pagination=pagination, user_ratings=user_ratings, all_genres=all_genres()))
+    response.set_etag(etag)
+    # may be stored, but has to be revalidated, and only for the same session
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
 
 def create_test_user():
     # Test123
@@ -70,120 +239,602 @@ def create_test_user():
     db.session.commit()
     print(f'Created test user with username: {test_user.username} and password: Test123')
 
-@app.cli.command('initdb')
-def initdb_command():
-    global db
+@main.cli.command('initdb')
+@click.option('--bulk', is_flag=True, help='Use the bulk loader (one pass per file, chunked executemany).')
+def initdb_command(bulk):
     """Creates the database tables."""
-    check_and_read_data(db)
+    import read_data
+    with timed_job('initdb', persist=True):
+        if bulk:
+            read_data.bulk_read_data(db)
+        else:
+            read_data.check_and_read_data(db)
     print('Initialized the database.')
     
     create_test_user()
 
-@app.cli.command('modelbased')
-def modelbased_command():
+@main.cli.command('migrate')
+def migrate_command():
+    """Upgrades an existing database in place (WAL, missing indexes, statistics)."""
+    import storage
+    if not storage.migrate(db):
+        raise SystemExit(1)
+
+@main.cli.command('check-queries')
+def check_queries_command():
+    """Fails if a hot query does a full table scan (EXPLAIN QUERY PLAN)."""
+    import storage
+    failures = storage.check_query_plans(db)
+    storage.report_query_plans(failures)
+    if failures:
+        raise SystemExit(1)
+
+@main.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Rebuilds the rating aggregates of every movie (and the prior of the shrunk mean)."""
+    import movie_stats
+    with timed_job('rebuild-stats', persist=True):
+        rows = movie_stats.rebuild_from_database(db)
+    print(f'Rebuilt the stats of {rows} movies.')
+
+@main.cli.command('export-ratings')
+@click.option('--full', is_flag=True, help='Write a new snapshot instead of appending the ratings written since.')
+def export_ratings_command(full):
+    """Exports the ratings to the memory-mapped columnar snapshot."""
+    import ratings_snapshot
+    with timed_job('export-ratings', persist=True):
+        snapshot = ratings_snapshot.export(db, full=full)
+    print(f"Snapshot {snapshot.manifest['generation']}: {snapshot.rows} rows, {len(snapshot.user_ids)} users, "
+          f"{len(snapshot.movie_ids)} movies.")
+
+@main.cli.group('jobs')
+def jobs_group():
+    """Background jobs: ingest, rating matrix, training and recommendations."""
+
+@jobs_group.command('worker')
+@click.option('--concurrency', type=int, default=None, help='Jobs run at the same time, defaults to JOBS_CONCURRENCY.')
+@click.option('--once', is_flag=True, help='Stop when the queue is empty.')
+def jobs_worker_command(concurrency, once):
+    """Runs queued jobs, each in a process of its own."""
+    import jobs
+    jobs.work(current_app, db, concurrency or current_app.config['JOBS_CONCURRENCY'], once=once)
+
+@jobs_group.command('enqueue')
+@click.argument('job_type')
+@click.option('--param', 'params', multiple=True, help='Job parameter as name=value (value as JSON if it parses).')
+@click.option('--run-after', type=click.DateTime(), default=None, help='Not started before this time.')
+def jobs_enqueue_command(job_type, params, run_after):
+    """Queues a job (ingest, rating-matrix, train, recommend, rebuild or content-features)."""
+    import jobs
+    try:
+        job = jobs.enqueue(db, job_type, dict(parse_param(param) for param in params), run_after)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='JOB_TYPE')
+    print(f"job {job['id']} {job['type']}: {job['status']}")
+
+def parse_param(param):
+    # name=value of --param, the value as JSON ( 32, true, "x" ) or else as a string
+    name, _, value = param.partition('=')
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+@jobs_group.command('list')
+@click.option('--status', default=None, help='Only jobs with this status.')
+@click.option('--limit', default=20, show_default=True)
+def jobs_list_command(status, limit):
+    """Lists the latest jobs."""
+    import jobs
+    for job in jobs.list_jobs(db, status, limit):
+        progress = f"{job['progress']:.0%}" if job['progress'] is not None else '-'
+        print(f"{job['id']:>6} {job['type']:<14} {job['status']:<10} {progress:>5} {job['created_at']} {job['message']}")
+
+@jobs_group.command('cancel')
+@click.argument('job_id', type=int)
+def jobs_cancel_command(job_id):
+    """Cancels a queued or running job."""
+    import jobs
+    job = jobs.cancel(db, job_id)
+    if job is None:
+        raise click.BadParameter(f'no job {job_id}', param_hint='JOB_ID')
+    print(f"job {job_id}: {job['status']}{' (cancel requested)' if job['status'] == 'running' else ''}")
+
+@main.cli.command('startup-report')
+@click.option('--top', default=10, show_default=True, help='Packages shown.')
+def startup_report_command(top):
+    """Shows where the cold start of a worker goes."""
+    from startup import import_times
+    total, packages, output = import_times(
+        "import recommender; print(recommender.create_app().extensions['startup_report'])")
+    print(f"cold start in a new interpreter: {total * 1000:.0f} ms ( including the interpreter itself )")
+    print(output.strip())
+    print("slowest imports:")
+    for package, seconds in packages[:top]:
+        print(f"{seconds * 1000:>8.1f} ms  {package}")
+
+@main.cli.command('synth-data')
+@click.option('--scale', type=click.Choice(['100k', '1m', '10m', '25m']), default='1m', show_default=True,
+              help='MovieLens size to imitate.')
+@click.option('--out', default=None, help='Output directory, defaults to data/synthetic-<scale>.')
+@click.option('--ratings', type=int, default=None, help='Number of ratings, overrides the scale.')
+@click.option('--seed', default=42, show_default=True, help='Random seed.')
+def synth_data_command(scale, out, ratings, seed):
+    """Writes synthetic MovieLens csv files with power law popularity and activity."""
+    import synthetic_data
+    n_movies, n_users, n_ratings, n_tags = synthetic_data.SCALES[scale]
+    synthetic_data.generate(out or os.path.join('data', f'synthetic-{scale}'), n_movies, n_users,
+                            ratings or n_ratings, n_tags, seed=seed)
+
+@main.cli.command('benchmark')
+@click.option('--data-dir', default='data', show_default=True, help='Directory with the MovieLens csv files.')
+@click.option('--out', default=None, help='Result file, defaults to benchmarks/<date>-<commit>.json.')
+@click.option('--legacy/--no-legacy', default=True, show_default=True, help='Also time check_and_read_data (slow).')
+@click.option('--requests', default=200, show_default=True, help='Requests per route benchmark.')
+@click.option('--ratings', default=500, show_default=True, help='Ratings written by the rating benchmarks.')
+@click.option('--compare', 'compare_with', default=None, help='Older result file to compare against.')
+def benchmark_command(data_dir, out, legacy, requests, ratings, compare_with):
+    """Times loading, the rating matrix, the listing routes and rating writes."""
+    import json
+    import benchmark
+    report = benchmark.run(data_dir, out, legacy=legacy, requests=requests, ratings=ratings)
+    if compare_with:
+        with open(compare_with) as f:
+            if benchmark.compare(json.load(f), report):
+                raise SystemExit(1)
+
+@main.cli.command('loaddata')
+@click.option('--data-dir', default='data', show_default=True, help='Directory with the MovieLens csv files.')
+@click.option('--workers', type=int, default=None, help='Parser processes, defaults to the number of cores.')
+def loaddata_command(data_dir, workers):
+    """Loads new rows of the data files, resumes an interrupted load."""
+    import incremental_load
+    with timed_job('loaddata', persist=True):
+        incremental_load.incremental_read_data(db, data_dir=data_dir, workers=workers)
+    print('Loaded new data.')
+
+@main.cli.command('modelbased')
+@click.option('--factors', default=64, show_default=True, help='Number of latent factors.')
+@click.option('--regularization', default=0.05, show_default=True, help='L2 regularization.')
+@click.option('--iterations', default=10, show_default=True, help='ALS iterations.')
+@click.option('--implicit/--explicit', default=True, show_default=True, help='Implicit (confidence) or explicit ALS.')
+@click.option('--alpha', default=10.0, show_default=True, help='Confidence scaling for implicit ALS.')
+@click.option('--workers', type=int, default=None, help='Solver threads, defaults to the number of cores.')
+@click.option('--stats', is_flag=True, help='Only print rating matrix statistics.')
+def modelbased_command(factors, regularization, iterations, implicit, alpha, workers, stats):
+    """Trains the matrix factorization model."""
     import model_based
-    model_based.test(db)
-
-@app.before_request
-def start_timer():
-    g.start = time.time()
+    if stats:
+        model_based.test(db)
+        return
+    with timed_job('modelbased', persist=True):
+        model_based.train(db, factors=factors, regularization=regularization, iterations=iterations,
+                          implicit=implicit, alpha=alpha, workers=workers)
+
+def comma_list(convert):
+    # click callback for grid options like --factors 32,64
+    def parse(ctx, param, value):
+        try:
+            return [convert(item) for item in value.split(',') if item.strip()]
+        except ValueError:
+            raise click.BadParameter(f'expected a comma separated list, got {value}')
+    return parse
+
+@main.cli.command('evaluate')
+@click.option('--split', type=click.Choice(['global', 'leave-last-out']), default='global', show_default=True,
+              help='Test ratings: the newest test_fraction of all ratings, or the last rating of every user.')
+@click.option('--test-fraction', default=0.2, show_default=True, help='Share of the ratings in the global test split.')
+@click.option('--k', default=10, show_default=True, help='k of precision@k, recall@k and NDCG@k.')
+@click.option('--factors', default='64', show_default=True, callback=comma_list(int), help='Grid, comma separated.')
+@click.option('--regularization', default='0.05', show_default=True, callback=comma_list(float),
+              help='Grid, comma separated.')
+@click.option('--iterations', default='10', show_default=True, callback=comma_list(int), help='Grid, comma separated.')
+@click.option('--mode', default='implicit', show_default=True, callback=comma_list(str),
+              help='Grid of implicit and/or explicit.')
+@click.option('--alpha', default='10.0', show_default=True, callback=comma_list(float),
+              help='Grid of the implicit confidence scaling.')
+@click.option('--baseline/--no-baseline', default=True, show_default=True, help='Also evaluate the popularity ranking.')
+@click.option('--workers', type=int, default=None, help='Parallel runs, defaults to the number of cores.')
+@click.option('--out', default=None, help='Report file, defaults to evaluations/<date>-<split>.json.')
+def evaluate_command(split, test_fraction, k, factors, regularization, iterations, mode, alpha, baseline, workers, out):
+    """Evaluates a grid of models on a temporal split of the ratings."""
+    import evaluation
+    from benchmark import git_commit
+    from rating_matrix import get_rating_matrix
+    if set(mode) - {'implicit', 'explicit'}:
+        raise click.BadParameter(f'unknown mode in {",".join(mode)}', param_hint='--mode')
+    configs = evaluation.grid(('als', 'popularity') if baseline else ('als',), factors, regularization, iterations,
+                              mode, alpha)
+    with timed_job('evaluate', persist=True):
+        evaluation.run(get_rating_matrix(db), configs, split, test_fraction, k, workers, out, commit=git_commit())
+
+@main.cli.command('recommend')
+@click.option('--top-n', default=50, show_default=True, help='Recommendations stored per user.')
+@click.option('--block-size', default=1024, show_default=True, help='Users scored per matrix multiplication.')
+@click.option('--content-weight', default=0.0, show_default=True,
+              help='Share of the genre/tag score (0-1), rarely rated movies get up to twice that.')
+@click.option('--content-k', default=50, show_default=True, help='Content neighbours per movie of the hybrid score.')
+@click.option('--publish/--no-publish', default=True, show_default=True,
+              help='Serve the model once its recommendations are stored.')
+def recommend_command(top_n, block_size, content_weight, content_k, publish):
+    """Precomputes the top-N recommendations of every user with the latest model."""
+    import recommendations
+    try:
+        with timed_job('recommend', persist=True):
+            recommendations.precompute(db, n=top_n, block_size=block_size, content_weight=content_weight,
+                                       content_k=content_k, publish=publish)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+@main.cli.group('models')
+def models_group():
+    """Model versions: which one the web serves, publish and rollback."""
+
+@models_group.command('list')
+def models_list_command():
+    """Lists the model versions, * marks the served one."""
+    import model_registry
+    from als import latest_version
+    current, latest = model_registry.current_version(), latest_version()
+    published = {entry['version']: entry for entry in model_registry.history()}  # the last entry of a version
+    for version in model_registry.versions():
+        entry = published.get(version, {})
+        flags = [flag for flag, on in (('latest', version == latest), ('unpublished', not entry),
+                                       ('rolled back', 'rolled_back' in entry)) if on]
+        print(f"{'*' if version == current else ' '} {version} {entry.get('published', '-'):<19} {' '.join(flags)}")
+
+@models_group.command('publish')
+@click.argument('version', required=False)
+def models_publish_command(version):
+    """Serves a model version (the latest by default) once it is warmed."""
+    import model_registry
+    try:
+        version = model_registry.publish(version)
+    except (OSError, ValueError) as e:
+        raise click.ClickException(str(e))
+    print(f"Published model {version}")
+
+@models_group.command('rollback')
+def models_rollback_command():
+    """Serves the previously published model version again."""
+    import model_registry
+    try:
+        version = model_registry.rollback()
+    except (OSError, ValueError) as e:
+        raise click.ClickException(str(e))
+    print(f"Rolled back to model {version}")
+
+@main.cli.command('content-features')
+@click.option('--full', is_flag=True, help='Rebuild everything instead of adding the new tags.')
+def content_features_command(full):
+    """Builds the TF-IDF genre and tag features of the movies."""
+    import content_features
+    with timed_job('content-features', persist=True):
+        features, how = content_features.build(db, full=full)
+    print(f"Content features {features.version} ({how}): {features.matrix.shape[0]} movies, "
+          f"{len(features.genres)} genres, {len(features.tag_ids)} tags, {features.matrix.nnz} entries.")
+
+@main.cli.command('similar')
+@click.option('--k', default=20, show_default=True, help='Neighbours stored per movie.')
+@click.option('--block-size', default=256, show_default=True, help='Movies per similarity block.')
+@click.option('--content-weight', default=0.0, show_default=True, help='Weight of the genre/tag similarity (0-1).')
+@click.option('--min-common', default=1, show_default=True, help='Minimum number of users that rated both movies.')
+def similar_command(k, block_size, content_weight, min_common):
+    """Precomputes the nearest neighbours of every movie."""
+    import similarity
+    with timed_job('similar', persist=True):
+        similarity.build(db, k=k, block_size=block_size, content_weight=content_weight, min_common=min_common)
+
+@main.cli.command('ann')
+@click.option('--lists', type=int, default=None, help='Number of k-means lists, defaults to sqrt(movies).')
+@click.option('--sample', default=1000, show_default=True, help='Users used for the recall report.')
+@click.option('--k', default=10, show_default=True, help='k of the recall@k report.')
+def ann_command(lists, sample, k):
+    """Builds the approximate nearest neighbour index of the latest model."""
+    import ann_index
+    try:
+        with timed_job('ann', persist=True):
+            ann_index.build(n_lists=lists, sample=sample, k=k)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+@main.cli.command('foldin-drift')
+@click.option('--sample', default=200, show_default=True, help='Users compared.')
+def foldin_drift_command(sample):
+    """Compares fold-in vectors with the trained vectors of the served model."""
+    import fold_in
+    try:
+        result = fold_in.drift(db, sample=sample)
+    except (OSError, ValueError) as e:
+        raise click.ClickException(str(e))
+    for name, value in result.items():
+        print(f"{name}: {value}")
 
 # The Home page is accessible to anyone
-@app.route('/')
+@main.route('/')
 def home_page():
     # render home.html template
     return render_template("home.html")
 
 # The Members page is only accessible to authenticated users via the @login_required decorator
-@app.route('/movies')
+@main.route('/movies')
 @login_required  # User must be authenticated
 def movies_page():
     page = request.args.get('page', 1, type=int)
-    # String-based templates
-    pagination = Movie.query.paginate(page=page, per_page=MOVIES_PER_PAGE, count=False, error_out=False)
-    movies = pagination.items
-    pagination.has_next
-    # print(f'movies count: {len(movies)}')
-    # print(f'pagination: {pagination}')
+    after = request.args.get('after', None, type=int)
+    before = request.args.get('before', None, type=int)
+    sort = listing_sort()
+    if sort:
+        # keyset pagination along an index of movie_stats ( or movies.year )
+        pagination = sorted_page(db, sort, MOVIES_PER_PAGE, after, before, page)
+        return listing_response(pagination, sort=sort)
+    # keyset pagination over the sorted movie ids of the genre index
+    from genre_index import keyset_page
+    pagination = keyset_page(current_genre_index().all_ids, MOVIES_PER_PAGE, after, before, page)
     
-    return render_template("movies.html", movies=movies, pagination=pagination, all_genres=GENRELISTE)
+    return listing_response(pagination)
 
-# @app.route('/movies/genres/<genres>')
-@app.route('/movies/genres')
+# @main.route('/movies/genres/<genres>')
+@main.route('/movies/genres')
 @login_required  # User must be authenticated
 def movies_by_genres():
 
     logger.info(f'genres: {request.args.get("genres", None)}')
 
     # get genres page number from query parameters
-    genres_param = request.args.get('genres', None)
     page = request.args.get('page', 1, type=int)
+    after = request.args.get('after', None, type=int)
+    before = request.args.get('before', None, type=int)
+    genres, mode = genre_filter()
+    sort = listing_sort()
+    if not genres:
+        logger.info(f'genres: {genres}')
+        return redirect(url_for('main.movies_page', page=page, after=after, before=before, sort=sort))
+
+    if sort:
+        pagination = sorted_page(db, sort, MOVIES_PER_PAGE, after, before, page, genres, mode)
+        return listing_response(pagination, genres, mode, sort)
+    # get all movies of the selected genres, paginated with the ids of the genre index as cursor
+    from genre_index import keyset_page
+    movie_ids = current_genre_index().movie_ids(genres, mode)
+    pagination = keyset_page(movie_ids, MOVIES_PER_PAGE, after, before, page)
+    
+    return listing_response(pagination, genres, mode)
+
+def genre_filter():
+    # genres ( sorted, without duplicates ) and mode of the query parameters
+    genres_param = request.args.get('genres', None)
+    mode = 'all' if request.args.get('mode') == 'all' else None  # None: any of the genres ( union ), all: intersection
 
     # split the genres parameter into a list of genres
     genres = genres_param.split(',') if genres_param else []
     genres = list(set(genres)) # remove duplicates
     genres.sort() # sort alphabetically
-    if not genres:
-        logger.info(f'genres: {genres}')
-        return redirect(url_for('movies_page', page=page ))
+    return genres, mode
 
-    # get all movies of the selected genres, paginated
-    # movies = Movie.query.filter(Movie.genres.any(MovieGenre.genre.in_(genres))).limit(10).all()
+def listing_sort():
+    # popular, top-rated or newest, None: by movie id
+    sort = request.args.get('sort')
+    return sort if sort in SORTS else None
 
-    query = Movie.query.filter(Movie.genres.any(MovieGenre.genre.in_(genres)))
-    pagination = query.paginate(page=page, per_page=MOVIES_PER_PAGE, count=False, error_out=False)
-    movies = pagination.items
-    
-    return render_template("movies.html", movies=movies, genres=genres, pagination=pagination, all_genres=GENRELISTE)
+def search_titles(query, limit):
+    # [SearchResult] for the query, within the genre filter of the request
+    genres, mode = genre_filter()
+    movie_ids = current_genre_index().movie_ids(genres, mode) if genres else None
+    return current_title_index().search(query, limit, movie_ids)
+
+@main.route('/movies/search')
+@login_required  # User must be authenticated
+def search_movies():
+    query = request.args.get('q', '').strip()
+    genres, mode = genre_filter()
+    if not query:
+        return redirect(url_for('main.movies_by_genres', genres=','.join(genres), mode=mode) if genres
+                        else url_for('main.movies_page'))
+
+    movie_ids = [result.movie_id for result in search_titles(query, SEARCH_RESULTS)]
+    movies = movies_by_ids(movie_ids)
+    heading = f'Movies matching "{query}"' if movies else f'No movies matching "{query}"'
+    return render_template("movies.html", movies_html=render_movie_list(movies, genres, mode), genres=genres,
+                           mode=mode, query=query, heading=heading, filter_endpoint='main.search_movies',
+                           user_ratings=chosen_ratings(movie_ids), all_genres=all_genres())
+
+@main.route('/movies/autocomplete')
+@login_required  # User must be authenticated
+def autocomplete_movies():
+    # titles for the search box, straight from the in memory index without a query
+    query = request.args.get('q', '')
+    limit = min(request.args.get('limit', AUTOCOMPLETE_RESULTS, type=int), SEARCH_RESULTS)
+    results = [{'id': result.movie_id, 'title': result.title, 'year': result.year,
+                'url': url_for('main.movie_page', movie_id=result.movie_id)}
+               for result in search_titles(query, limit)]
+    response = jsonify({'query': query, 'results': results})
+    # the browser answers a repeated prefix ( backspace ) itself
+    response.cache_control.private = True
+    response.cache_control.max_age = 60
+    return response
+
+@main.route('/recommendations')
+@login_required  # User must be authenticated
+def recommendations_page():
+    # precomputed by `flask recommend`, so this is a lookup and one query
+    from model_registry import get_serving_model
+    from recommendations import online_recommendations
+    from fold_in import user_vector
+
+    # one version for the whole request, even if the worker swaps in a new one meanwhile
+    serving = get_serving_model()
+    # users that rated something since the last training have a folded in vector, score it online
+    folded = user_vector(db, current_user.id, serving) if serving else None
+    if folded is not None:
+        movie_ids = online_recommendations(folded[0], folded[1], RECOMMENDATIONS_PER_PAGE, serving)
+    else:
+        movie_ids = serving.store.for_user(current_user.id, RECOMMENDATIONS_PER_PAGE) if serving else []
+    movies = movies_by_ids(movie_ids)
+    heading = 'Recommended for you' if movies else 'No recommendations yet, rate some movies first'
+
+    return render_template("movies.html", movies_html=render_movie_list(movies), heading=heading,
+                           user_ratings=chosen_ratings(movie_ids), all_genres=all_genres())
+
+def similar_movies(movie_id, n=SIMILAR_MOVIES):
+    # [(movie, similarity)] from the precomputed neighbour table ( `flask similar` ), for movies without
+    # neighbours there ( new or rarely rated ) the movies closest in genres and tags
+    from similarity import get_similarity_index
+    from content_features import get_content_features
+
+    index = get_similarity_index()
+    neighbours = index.similar(movie_id, n) if index else []
+    if not neighbours:
+        features = get_content_features()
+        neighbours = features.similar(movie_id, n) if features else []
+    movies_by_id = {movie.id: movie for movie in Movie.query.filter(Movie.id.in_([m for m, _ in neighbours]))}
+    return [(movies_by_id[m], score) for m, score in neighbours if m in movies_by_id]
+
+@main.route('/movies/<int:movie_id>')
+@login_required  # User must be authenticated
+def movie_page(movie_id):
+    movie = db.get_or_404(Movie, movie_id, options=movie_listing_options())
+    return render_template("movie_info.html", movie=movie, similar=similar_movies(movie_id),
+                           stats=db.session.get(MovieStats, movie_id),
+                           user_ratings=chosen_ratings([movie_id]), all_genres=all_genres())
 
-# @app.route('/movies/int:<movie_id>')
-# @login_required  # User must be authenticated
-# def movie_page(movie_id):
-#     movie = Movie.query.get(movie_id)
-#     return render_template("movie_info.html", movie=movie)
+@main.route('/movies/<int:movie_id>/similar')
+@login_required  # User must be authenticated
+def movie_similar(movie_id):
+    n = request.args.get('n', SIMILAR_MOVIES, type=int)
+    similar = [{'id': movie.id, 'title': movie.title_stripped, 'year': movie.year, 'similarity': round(score, 4),
+                'url': url_for('main.movie_page', movie_id=movie.id)} for movie, score in similar_movies(movie_id, n)]
+    return jsonify({'movie_id': movie_id, 'similar': similar})
 
-@app.route('/rate_movie', methods=['POST'])
+@main.route('/rate_movie', methods=['POST'])
 @login_required  # User must be authenticated
 def rate_movie():
-    logger.info(f'rate_movie')
+    logger.info('rate_movie')
 
-    data = request.get_json()
-    movie_id = data['movie_id']
-    rating = data['rating']
+    data = request.get_json(silent=True)
+    ratings, rejected = parse_ratings([data], RATING_RANGE)
+    if rejected:
+        return jsonify({'success': False, 'message': rejected[0]['message']}), 400
+    movie_id, rating = ratings[0]
     user_id = current_user.id
-    timestamp = datetime.now()
 
-    logger.info(f'movie_id: {movie_id}, rating: {rating}, user_id: {user_id}, timestamp: {timestamp}')
+    logger.info(f'movie_id: {movie_id}, rating: {rating}, user_id: {user_id}')
 
-    # check if rating value is valid
-    # check if rating is a number
-    try:
-        rating = float(rating)
-    except ValueError:
-        return jsonify({'success': False, 'message': f'Invalid rating value type, expected float, got {type(rating)}'})
-    # check if rating is in the correct range
-    if rating < RATING_RANGE[0] or rating > RATING_RANGE[1]:
-        return jsonify({'success': False, 'message': f'Invalid rating value, expected value between {RATING_RANGE[0]} and {RATING_RANGE[1]}, got {rating}'})
-    
-    # check if rating already exists
-    rating_obj = Ratings.query.filter_by(movie_id=movie_id, user_id=user_id).first()
-    if rating_obj:
-        logger.info(f'rating already exists: {rating_obj.rating}')
-        # overwrite rating
-        rating_obj.rating = rating
-        rating_obj.timestamp = timestamp
-        db.session.commit()
-        logger.info(f'rating updated: {rating_obj.rating}')
-    else:
-        logger.info(f'creating new rating')
-        rating_obj = Ratings(movie_id=movie_id, user_id=user_id, rating=rating, timestamp=timestamp)
-        db.session.add(rating_obj)
-        db.session.commit()
-        logger.info(f'rating created: {rating_obj.rating}')
+    unknown = write_ratings(user_id, ratings)
+    if unknown:
+        return jsonify({'success': False, 'message': f'Unknown movie {movie_id}'}), 400
+    logger.info(f'rating saved: {rating}')
 
     return jsonify({'success': True})
 
+@main.route('/rate_movies', methods=['POST'])
+@login_required  # User must be authenticated
+def rate_movies():
+    # many ratings in one request: {"ratings": [{"movie_id": 1, "rating": 4}, ...]}, written in one transaction
+    data = request.get_json(silent=True) or {}
+    items = data.get('ratings')
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'message': 'Expected a non empty list of ratings'})
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({'success': False, 'message': f'At most {MAX_BATCH_SIZE} ratings per request, got {len(items)}'})
+
+    ratings, rejected = parse_ratings(items, RATING_RANGE)
+    unknown = write_ratings(current_user.id, ratings)
+    rejected += [{'movie_id': movie_id, 'message': f'Unknown movie {movie_id}'} for movie_id, _ in unknown]
+    logger.info(f'rate_movies user_id: {current_user.id}, saved: {len(ratings) - len(unknown)}, rejected: {len(rejected)}')
+    return jsonify({'success': not rejected, 'saved': len(ratings) - len(unknown), 'rejected': rejected})
+
+@main.route('/tag_movie', methods=['POST'])
+@login_required  # User must be authenticated
+def tag_movie():
+    data = request.get_json(silent=True)
+    data = data if isinstance(data, dict) else {}
+    try:
+        movie_id = int(data.get('movie_id'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': f"Invalid movie_id, expected an integer, got {data.get('movie_id')!r}"}), 400
+    tags = data.get('tags', [])
+    if isinstance(tags, str):
+        tags = tags.split(',')
+    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+        return jsonify({'success': False, 'message': 'Invalid tags, expected a string or a list of strings'}), 400
+    tags = [tag.strip() for tag in tags if tag.strip()]
+    if not tags:
+        return jsonify({'success': False, 'message': 'No tags given'})
+    if not known_movie_ids(db, [movie_id]):
+        return jsonify({'success': False, 'message': f'Unknown movie {movie_id}'}), 400
+
+    logger.info(f'tag_movie movie_id: {movie_id}, tags: {tags}, user_id: {current_user.id}')
+    ids = add_tags(db, current_user.id, movie_id, tags)
+    # the job worker adds the new tags to the content features, one queued job covers any number of tags
+    import jobs
+    jobs.enqueue(db, 'content-features')
+    return jsonify({'success': True, 'tag_ids': ids})
+
+
+def jobs_token_required(view):
+    # the /jobs endpoints are for cron and operators: a bearer token instead of a login, 404 without a token
+    @wraps(view)
+    def check_token(*args, **kwargs):
+        token = current_app.config['JOBS_API_TOKEN']
+        if not token:
+            abort(404)
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(401)
+        return view(*args, **kwargs)
+    return check_token
+
+@main.route('/jobs', methods=['GET'])
+@jobs_token_required
+def list_jobs():
+    import jobs
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    return jsonify({'jobs': jobs.list_jobs(db, request.args.get('status'), limit)})
+
+@main.route('/jobs', methods=['POST'])
+@jobs_token_required
+def enqueue_job():
+    # {"type": "rebuild", "params": {...}, "run_after": "2024-01-01T03:00:00"}, the worker runs it
+    import jobs
+    data = request.get_json(silent=True) or {}
+    try:
+        run_after = datetime.fromisoformat(data['run_after']) if data.get('run_after') else None
+        params = data.get('params') or {}
+        if not isinstance(params, dict):
+            raise ValueError('params must be an object')
+        job = jobs.enqueue(db, data.get('type'), params, run_after)
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify(job), 202, {'Location': url_for('main.job_status', job_id=job['id'])}
+
+@main.route('/jobs/<int:job_id>')
+@jobs_token_required
+def job_status(job_id):
+    import jobs
+    job = jobs.get_job(db, job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+@main.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+@jobs_token_required
+def cancel_job(job_id):
+    import jobs
+    job = jobs.cancel(db, job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+
+@main.route('/ready')
+def ready():
+    # readiness check of the load balancer: 503 while this worker loads and warms the published model,
+    # a worker that already serves a model stays ready while it warms the next one
+    from model_registry import readiness
+    is_ready, status = readiness()
+    return jsonify({'ready': is_ready, **status}), 200 if is_ready else 503
+
 
 # Start development web server
 if __name__ == '__main__':
-    app.run(port=5000, debug=True)
+    create_app().run(port=5000, debug=True)
@@ -0,0 +1,138 @@
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+import scipy.sparse as sp
+from sqlalchemy import select
+
+from als import latest_version, write_atomic
+from models import MovieGenre, Tags
+from rating_matrix import get_rating_matrix, indices_of
+from recommendations import top_n
+
+# Item to item nearest neighbours
+# every movie is a vector over the users that rated it, with the user mean subtracted ( adjusted cosine ).
+# The similarities are computed for a block of movies at a time ( sparse x sparse product ), only the
+# top-k of every row is kept, so memory stays at block_size x movies no matter how big the catalogue is.
+# Optionally blended with the cosine similarity of the genre / tag vectors of the movies.
+
+ARTIFACT_DIR = os.path.join('artifacts', 'similar')
+
+
+def normalized_item_vectors(ratings, adjusted=True):
+    # movies x users matrix with unit length rows
+    R = ratings.matrix.astype(np.float32)
+    if adjusted:
+        counts = np.diff(R.indptr)
+        means = np.asarray(R.sum(axis=1)).ravel() / np.maximum(counts, 1)
+        R = R.copy()
+        R.data -= np.repeat(means, counts).astype(np.float32)
+        R.eliminate_zeros()
+    return _normalize_rows(R.T.tocsr())
+
+def _normalize_rows(M):
+    norms = np.sqrt(np.asarray(M.multiply(M).sum(axis=1)).ravel())
+    return sp.diags((1 / np.where(norms > 0, norms, 1)).astype(np.float32)) @ M
+
+
+def content_vectors(db, movie_ids):
+    # movies x (genres + tags) matrix with unit length rows, a 1 for every genre and tag of a movie
+    genre_rows = db.session.execute(select(MovieGenre.movie_id, MovieGenre.genre)).all()
+    tag_rows = db.session.execute(select(Tags.movie_id, Tags.tag_name_id).distinct()).all()
+    features = {}
+    rows, columns = [], []
+    for movie_id, feature in [(m, ('genre', g)) for m, g in genre_rows] + [(m, ('tag', t)) for m, t in tag_rows]:
+        rows.append(movie_id)
+        columns.append(features.setdefault(feature, len(features)))
+    rows = indices_of(movie_ids, np.array(rows, dtype=np.int64))
+    columns = np.array(columns, dtype=np.int64)
+    known = rows >= 0
+    M = sp.csr_matrix((np.ones(np.count_nonzero(known), dtype=np.float32), (rows[known], columns[known])),
+                      shape=(len(movie_ids), max(len(features), 1)))
+    M.data[:] = 1  # duplicates were summed up
+    return _normalize_rows(M)
+
+
+def build_similarity_index(ratings, k=20, block_size=256, content=None, content_weight=0.0, min_common=1):
+    # (neighbour movie ids, similarities) of every movie of the rating matrix, k per movie, best first
+    items = normalized_item_vectors(ratings)
+    items_t = items.T.tocsr()
+    rated = (ratings.matrix != 0).astype(np.float32)
+    rated_t = rated.T.tocsr()
+    n_movies = items.shape[0]
+    k = min(k, max(n_movies - 1, 1))
+    neighbours = np.full((n_movies, k), -1, dtype=np.int32)
+    scores = np.zeros((n_movies, k), dtype=np.float32)
+    for lo in range(0, n_movies, block_size):
+        hi = min(lo + block_size, n_movies)
+        block = (items[lo:hi] @ items_t).toarray()
+        if min_common > 1:
+            # similarities based on very few common users are noise
+            common = (rated_t[lo:hi] @ rated).toarray()
+            block[common < min_common] = 0
+        if content is not None and content_weight > 0:
+            block = (1 - content_weight) * block + content_weight * (content[lo:hi] @ content.T).toarray()
+        block[np.arange(hi - lo), np.arange(lo, hi)] = -np.inf  # a movie is not its own neighbour
+        best, best_scores = top_n(block, k)
+        found = best_scores > 0
+        neighbours[lo:hi] = np.where(found, ratings.movie_ids[best], -1)
+        scores[lo:hi] = np.where(found, best_scores, 0)
+    return neighbours, scores
+
+
+def save_similarity_index(neighbours, scores, movie_ids, artifact_dir=ARTIFACT_DIR):
+    version = datetime.now().strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(artifact_dir, version)
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'neighbours.npy'), neighbours)
+    np.save(os.path.join(path, 'scores.npy'), scores)
+    np.save(os.path.join(path, 'movie_ids.npy'), movie_ids)
+    write_atomic(os.path.join(artifact_dir, 'latest'), version)
+    return version
+
+
+class SimilarityIndex:
+    # read only, memory-mapped view of one version of the neighbour table
+    def __init__(self, version, artifact_dir=ARTIFACT_DIR):
+        path = os.path.join(artifact_dir, version)
+        self.version = version
+        self.movie_ids = np.load(os.path.join(path, 'movie_ids.npy'))
+        self.neighbours = np.load(os.path.join(path, 'neighbours.npy'), mmap_mode='r')
+        self.scores = np.load(os.path.join(path, 'scores.npy'), mmap_mode='r')
+
+    def similar(self, movie_id, n=None):
+        # [(movie id, similarity)] of the nearest neighbours of a movie, best first
+        i = np.searchsorted(self.movie_ids, movie_id)
+        if i >= len(self.movie_ids) or self.movie_ids[i] != movie_id:
+            return []
+        return [(int(m), float(s)) for m, s in zip(self.neighbours[i, :n], self.scores[i, :n]) if m >= 0]
+
+
+_index = None
+_index_mtime = None
+
+def get_similarity_index(artifact_dir=ARTIFACT_DIR):
+    # index of the latest version, reloaded when a new version is published
+    global _index, _index_mtime
+    try:
+        mtime = os.stat(os.path.join(artifact_dir, 'latest')).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if _index is None or mtime != _index_mtime:
+        _index = SimilarityIndex(latest_version(artifact_dir), artifact_dir)
+        _index_mtime = mtime
+    return _index
+
+
+def build(db, k=20, block_size=256, content_weight=0.0, min_common=1, artifact_dir=ARTIFACT_DIR):
+    # batch job behind `flask similar`
+    started = time.perf_counter()
+    ratings = get_rating_matrix(db)
+    content = content_vectors(db, ratings.movie_ids) if content_weight > 0 else None
+    neighbours, scores = build_similarity_index(ratings, k, block_size, content, content_weight, min_common)
+    version = save_similarity_index(neighbours, scores, ratings.movie_ids, artifact_dir)
+    seconds = time.perf_counter() - started
+    print(f"Stored {neighbours.shape[1]} neighbours of {neighbours.shape[0]} movies as version {version} "
+          f"in {seconds:.2f}s ({neighbours.shape[0] / max(seconds, 1e-9):.0f} movies/sec)")
+    return version
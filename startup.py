@@ -0,0 +1,61 @@
+import logging
+import re
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+# Where the start of a worker goes
+# - StartupTimer collects the time of every step of create_app, it is logged once the app is ready
+# - import_times runs `python -X importtime` in a fresh interpreter and sums the import time of every module
+#   per top level package, so a heavy import that slipped back into the startup path shows up in `flask startup-report`
+
+logger = logging.getLogger('api_flask.startup')  # goes to the api_flask log
+
+
+class StartupTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.steps = []  # [(name, seconds)]
+
+    @contextmanager
+    def step(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.perf_counter() - started))
+
+    @property
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def report(self):
+        return ', '.join(f'{name} {seconds * 1000:.1f} ms' for name, seconds in self.steps)
+
+    def finish(self, import_seconds):
+        # logs and returns the report of the whole start once the app is ready
+        total = self.total
+        report = (f"started in {(import_seconds + total) * 1000:.1f} ms: import {import_seconds * 1000:.1f} ms, "
+                  f"{self.report()}, app {total * 1000:.1f} ms")
+        logger.info(report)
+        return report
+
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+\d+ \|\s*(\S+)$')
+
+
+def import_times(statement='import recommender'):
+    # (total seconds, [(top level package, cumulative seconds)] slowest first, stdout) of a cold start
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            capture_output=True, text=True, check=True)
+    total = time.perf_counter() - started
+    packages = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            # self time of every module, summed up per top level package
+            package = match.group(2).split('.')[0]
+            packages[package] = packages.get(package, 0) + int(match.group(1)) / 1e6
+    return total, sorted(packages.items(), key=lambda item: -item[1]), result.stdout
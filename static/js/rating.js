@@ -3,51 +3,100 @@ document.addEventListener('DOMContentLoaded', function() {
     var ratingButtons = document.querySelectorAll('.rating-btn');
     ratingButtons.forEach(function(button) {
         button.addEventListener('click', rateMovie);
+        // highlight the ratings the user already gave ( rendered per user, outside the cached movie list )
+        var chosen = (window.userRatings || {})[button.getAttribute('data-movieId')];
+        if (chosen !== undefined && chosen == button.getAttribute('data-rating')) {
+            button.classList.add('ChosenRating');
+        }
     });
     
 });
 
+// clicks are queued and sent to /rate_movies together, RATING_BATCH_DELAY ms after the last click
+var RATING_BATCH_DELAY = 500;
+var queuedRatings = {};  // movie id -> rating, the last click on a movie wins
+var ratingTimer = null;
+// a failed batch is sent again after RATING_RETRY_DELAY ms, doubled on every failure up to RATING_RETRY_MAX
+var RATING_RETRY_DELAY = 1000;
+var RATING_RETRY_MAX = 60000;
+var ratingRetryDelay = RATING_RETRY_DELAY;
+
 function rateMovie(event) {
     event.preventDefault();
 
     var movieId = this.getAttribute('data-movieId');
     var rating = this.getAttribute('data-rating');
-    var invokingElement = this
 
-    rate_movie_url = appConfig['urls']['rate_movie']
+    // change the color of the rating button clicked right away, the request follows with the batch
+    markRating(this.parentElement, rating);
+    queuedRatings[movieId] = rating;
+    scheduleRatings(RATING_BATCH_DELAY);
+}
+
+function scheduleRatings(delay) {
+    clearTimeout(ratingTimer);
+    ratingTimer = setTimeout(sendQueuedRatings, delay);
+}
+
+function markRating(container, rating) {
+    var ratingButtons = container.querySelectorAll('.rating-btn');
+    for (var i = 0; i < ratingButtons.length; i++) {
+        if (ratingButtons[i].getAttribute('data-rating') == rating) {
+            ratingButtons[i].classList.add('ChosenRating');
+        }
+        else {
+            ratingButtons[i].classList.remove('ChosenRating');
+        }
+    }
+}
+
+function takeQueuedRatings() {
+    var ratings = Object.keys(queuedRatings).map(function (movieId) {
+        return {'movie_id': movieId, 'rating': queuedRatings[movieId]};
+    });
+    queuedRatings = {};
+    clearTimeout(ratingTimer);
+    return ratings;
+}
+
+function sendQueuedRatings() {
+    var ratings = takeQueuedRatings();
+    if (ratings.length == 0) {
+        return;
+    }
     // jQuery AJAX call
     $.ajax({
-        url: rate_movie_url,
+        url: appConfig['urls']['rate_movies'],
         type: 'POST',
         contentType: 'application/json',
-        data: JSON.stringify({
-            'movie_id': movieId,
-            'rating': rating
-        }),
+        data: JSON.stringify({'ratings': ratings}),
         dataType: 'json',
         success: function (data) {
             console.log('Success:', data);
-            // Update the rating display
-            // change the color of the rating button clicked
-            var ratingButtons = invokingElement.parentElement.querySelectorAll('.rating-btn');
-            for (var i = 0; i < ratingButtons.length; i++) {
-                if (ratingButtons[i].getAttribute('data-rating') == rating) {
-                    ratingButtons[i].classList.add('ChosenRating');
-                    // ratingButtons[i].classList.remove('btn-primary');
-
-                }
-                else {
-                    ratingButtons[i].classList.remove('ChosenRating');
-                    // ratingButtons[i].classList.add('btn-primary');
-
-                }
-            }
-
-
+            ratingRetryDelay = RATING_RETRY_DELAY;
         },
         error: function(jqXHR, textStatus, errorThrown) {
-            console.error('Error loading data:', textStatus, errorThrown);
-            // Handle errors
+            console.error('Error saving ratings:', textStatus, errorThrown);
+            if (jqXHR.status >= 400 && jqXHR.status < 500) {
+                return;  // rejected, sending them again would not help
+            }
+            // queue them again unless the user rated the movie once more in the meantime, and retry later
+            ratings.forEach(function (r) {
+                if (!(r.movie_id in queuedRatings)) {
+                    queuedRatings[r.movie_id] = r.rating;
+                }
+            });
+            scheduleRatings(ratingRetryDelay);
+            ratingRetryDelay = Math.min(ratingRetryDelay * 2, RATING_RETRY_MAX);
         }
     });
-}
\ No newline at end of file
+}
+
+// ratings still queued when the user leaves the page
+window.addEventListener('pagehide', function () {
+    var ratings = takeQueuedRatings();
+    if (ratings.length > 0) {
+        navigator.sendBeacon(appConfig['urls']['rate_movies'],
+            new Blob([JSON.stringify({'ratings': ratings})], {type: 'application/json'}));
+    }
+});
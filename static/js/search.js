@@ -0,0 +1,51 @@
+document.addEventListener('DOMContentLoaded', function() {
+    var input = document.getElementById('movie-search');
+    if (input) {
+        input.addEventListener('input', function () {
+            clearTimeout(suggestTimer);
+            suggestTimer = setTimeout(suggestMovies, SUGGEST_DELAY);
+        });
+    }
+});
+
+// suggestions are asked for SUGGEST_DELAY ms after the last key, only the answer to the latest query is shown
+var SUGGEST_DELAY = 80;
+var suggestTimer = null;
+var latestQuery = '';
+
+function suggestMovies() {
+    var form = document.getElementById('movie-search').form;
+    var query = form.elements['q'].value.trim();
+    latestQuery = query;
+    if (query.length == 0) {
+        showSuggestions([]);
+        return;
+    }
+    // the hidden genre fields of the form restrict the suggestions to the genre filter
+    $.ajax({
+        url: appConfig['urls']['autocomplete_movies'],
+        type: 'GET',
+        data: $(form).serialize(),
+        dataType: 'json',
+        success: function (data) {
+            if (data.query.trim() == latestQuery) {
+                showSuggestions(data.results);
+            }
+        },
+        error: function(jqXHR, textStatus, errorThrown) {
+            console.error('Error loading suggestions:', textStatus, errorThrown);
+        }
+    });
+}
+
+function showSuggestions(results) {
+    var list = document.getElementById('movie-search-suggestions');
+    list.innerHTML = '';
+    results.forEach(function (movie) {
+        var link = document.createElement('a');
+        link.className = 'list-group-item';
+        link.href = movie.url;
+        link.textContent = movie.year ? movie.title + ' (' + movie.year + ')' : movie.title;
+        list.appendChild(link);
+    });
+}
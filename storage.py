@@ -0,0 +1,133 @@
+import logging
+import re
+
+from sqlalchemy import event, select, text
+from sqlalchemy.dialects import sqlite
+
+from models import Movie, MovieGenre, Ratings, Tags, Link, TagNames
+from movie_stats import STATS_TRIGGERS, ensure_movie_stats, sort_order, sorted_query
+from page_cache import catalogue_triggers, ensure_catalogue_version
+from rating_writes import CHANGE_TRIGGER, RATING_INDEX, ensure_change_log, ensure_rating_index
+from tag_interner import ensure_tag_name_index
+
+# Storage profile of the SQLite database
+# - every connection runs in WAL mode ( readers don't block the writer and the other way round ) with
+#   synchronous=NORMAL, which in WAL mode only risks the last transactions on a power loss, not corruption
+# - a starting app only checks that the tables, the rating index and the catalogue triggers exist
+# - the secondary indexes are declared in models.py, `flask migrate` creates the missing ones on an
+#   existing database in place
+# - `flask check-queries` asks SQLite for the plan of the hot queries and fails on a full table scan
+
+logger = logging.getLogger('api_flask.storage')  # goes to the api_flask log
+
+CONNECTION_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': '5000',  # ms a writer waits for the lock instead of failing with "database is locked"
+    'cache_size': '-65536',  # ~64MB page cache per connection
+    'temp_store': 'MEMORY',
+    'mmap_size': str(256 * 1024 * 1024),
+}
+
+
+def install_connection_pragmas(engine, pragmas=None):
+    # sets the pragmas on every new connection of the engine
+    pragmas = CONNECTION_PRAGMAS if pragmas is None else pragmas
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+
+def ensure_schema(db):
+    # creates what a new database ( or one older than a table or trigger ) is missing, returns whether it had to
+    existing = {name for name, in db.session.execute(text('SELECT name FROM sqlite_master'))}
+    expected = set(db.metadata.tables) | {RATING_INDEX, CHANGE_TRIGGER} | \
+        {name for name, _, _ in catalogue_triggers()} | set(STATS_TRIGGERS)
+    if expected <= existing:
+        return False
+    db.create_all()
+    ensure_rating_index(db)
+    ensure_tag_name_index(db)
+    ensure_change_log(db)
+    ensure_catalogue_version(db)
+    ensure_movie_stats(db)
+    return True
+
+
+# the queries of the routes and jobs that run all the time, with example parameters
+HOT_QUERIES = {
+    'chosen ratings of a page': select(Ratings.movie_id, Ratings.rating).where(
+        Ratings.user_id == 1, Ratings.movie_id.in_([1, 2, 3])),
+    'ratings of a user': select(Ratings.movie_id, Ratings.rating).where(Ratings.user_id == 1),
+    'ratings of a movie': select(Ratings.rating).where(Ratings.movie_id == 1),
+    'movies of a genre': select(MovieGenre.movie_id).where(MovieGenre.genre == 'Comedy'),
+    'genres of a page': select(MovieGenre).where(MovieGenre.movie_id.in_([1, 2, 3])),
+    'tags of a page': select(Tags).where(Tags.movie_id.in_([1, 2, 3])),
+    'links of a page': select(Link).where(Link.movie_id.in_([1, 2, 3])),
+    'movies of a year': select(Movie.id).where(Movie.year == 1995),
+    'tag names by name': select(TagNames.id).where(TagNames.name.in_(['funny'])),
+    'most popular movies': sorted_query('popular').order_by(*sort_order('popular')).limit(6),
+    'top rated movies of a genre': sorted_query('top-rated', ['Comedy']).order_by(*sort_order('top-rated')).limit(6),
+    'newest movies with all genres': sorted_query('newest', ['Comedy', 'Drama'], 'all').order_by(
+        *sort_order('newest')).limit(6),
+}
+
+FULL_SCAN = re.compile(r'^SCAN (TABLE )?(\w+)$')  # "SCAN t USING (COVERING) INDEX" is reported separately
+
+
+def query_plan(conn, statement):
+    sql = str(statement.compile(dialect=sqlite.dialect(), compile_kwargs={'literal_binds': True}))
+    return [row[3] for row in conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}')]
+
+
+def check_query_plans(db, queries=None):
+    # {query name: [plan details]} of the queries that do a full table scan, empty when all of them use an index
+    queries = HOT_QUERIES if queries is None else queries
+    failures = {}
+    with db.engine.connect() as conn:
+        for name, statement in queries.items():
+            plan = query_plan(conn, statement)
+            if any(FULL_SCAN.match(detail) for detail in plan):
+                failures[name] = plan
+    return failures
+
+
+def missing_indexes(conn, metadata):
+    existing = {name for name, in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    return [index for table in metadata.sorted_tables for index in table.indexes if index.name not in existing]
+
+
+def migrate(db):
+    # upgrades an existing database in place, every step is a no-op when it was done before
+    db.create_all()  # tables added since the database was created
+    ensure_rating_index(db)  # removes duplicate ratings before the unique index is created
+    ensure_tag_name_index(db)  # merges duplicate tag names before their index is made unique
+    ensure_change_log(db)
+    ensure_catalogue_version(db)
+    ensure_movie_stats(db)  # one pass over the ratings when the stats don't exist yet
+    db.session.remove()
+    with db.engine.connect() as conn:
+        mode = conn.exec_driver_sql('PRAGMA journal_mode = WAL').scalar()
+        print(f"journal_mode: {mode}")
+        for index in missing_indexes(conn, db.metadata):
+            index.create(bind=conn)
+            conn.commit()
+            print(f"created index {index.name} on {index.table.name}")
+        conn.exec_driver_sql('ANALYZE')  # statistics for the query planner
+        conn.commit()
+    db.engine.dispose()  # pooled connections would still plan with the schema they read before
+    failures = check_query_plans(db)
+    report_query_plans(failures)
+    return not failures
+
+
+def report_query_plans(failures):
+    for name, plan in failures.items():
+        print(f"full scan in '{name}': {' / '.join(plan)}")
+        logger.warning(f"full scan in '{name}': {' / '.join(plan)}")
+    if not failures:
+        print(f"all {len(HOT_QUERIES)} hot queries use an index")
@@ -0,0 +1,140 @@
+import csv
+import os
+import time
+
+import numpy as np
+
+# Synthetic MovieLens data in the format of data/*.csv, at any scale
+# - movie popularity and user activity follow power laws ( a few blockbusters and heavy raters, a long tail ),
+#   every user has at least MIN_RATINGS ratings like in the MovieLens dumps
+# - a rating is movie quality + user bias + noise, rounded to half stars, so models have something to learn
+# - movie ids have gaps, some titles have no year, contain commas or quotes, some links have no tmdb id
+
+SCALES = {
+    # movies, users, ratings, tags, roughly the sizes of the MovieLens dumps
+    '100k': (9742, 610, 100836, 3683),
+    '1m': (3900, 6040, 1000209, 20000),
+    '10m': (10681, 71567, 10000054, 95580),
+    '25m': (62423, 162541, 25000095, 1093360),
+}
+
+GENRES = ['Drama', 'Comedy', 'Thriller', 'Romance', 'Action', 'Crime', 'Horror', 'Documentary', 'Adventure',
+          'Sci-Fi', 'Mystery', 'Fantasy', 'War', 'Children', 'Musical', 'Animation', 'Western', 'Film-Noir', 'IMAX']
+MIN_RATINGS = 20
+START, END = 820454400, 1700000000  # 1996 - 2023
+WORDS = ['love', 'war', 'night', 'return', 'dark', 'story', 'king', 'city', 'last', 'girl', 'man', 'blood', 'time',
+         'dead', 'life', 'world', 'summer', 'secret', 'house', 'star', 'lost', 'day', 'american', 'little', 'big']
+
+
+def zipf_weights(n, exponent, rng):
+    # power law weights in random order
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    return rng.permutation(weights / weights.sum())
+
+
+def sample(weights, size, rng):
+    # indices drawn with the given weights, vectorized with the inverse cdf
+    cdf = np.cumsum(weights)
+    return np.minimum(np.searchsorted(cdf, rng.random(size) * cdf[-1]), len(weights) - 1)
+
+
+def user_activity(n_users, n_ratings, n_movies, exponent, rng):
+    # ratings per user: MIN_RATINGS plus a power law share of the rest, at most half the catalogue.
+    # What the capped users can't take is handed on to the others in proportion to their weights.
+    cap = max(n_movies // 2, 1)
+    weights = zipf_weights(n_users, exponent, rng)
+    counts = np.full(n_users, min(MIN_RATINGS, cap), dtype=np.float64)
+    for _ in range(10):
+        extra = n_ratings - counts.sum()
+        open_ = counts < cap
+        if extra < 1 or not open_.any():
+            break
+        counts[open_] = np.minimum(counts[open_] + weights[open_] / weights[open_].sum() * extra, cap)
+    return np.floor(counts).astype(np.int64)
+
+
+def rating_pairs(counts, movie_weights, rng, rounds=4):
+    # unique (user, movie) pairs, counts[u] per user ( slightly fewer for the heaviest users )
+    n_movies = len(movie_weights)
+    users = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+    keys = np.unique(users * n_movies + sample(movie_weights, len(users), rng))
+    for _ in range(rounds):
+        missing = counts - np.bincount(keys // n_movies, minlength=len(counts))
+        if not missing.any():
+            break
+        users = np.repeat(np.arange(len(counts), dtype=np.int64), np.maximum(missing, 0))
+        keys = np.union1d(keys, users * n_movies + sample(movie_weights, len(users), rng))
+    return keys // n_movies, keys % n_movies
+
+
+def write_rows(filename, header, rows):
+    with open(filename, 'w', newline='', encoding='utf8') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def write_ratings(filename, user_ids, movie_ids, ratings, timestamps, chunk_size=1_000_000):
+    # formatted with numpy in chunks, the csv module needs minutes for 25M rows
+    with open(filename, 'w', encoding='utf8') as f:
+        f.write('userId,movieId,rating,timestamp\n')
+        for lo in range(0, len(user_ids), chunk_size):
+            hi = lo + chunk_size
+            columns = np.column_stack([user_ids[lo:hi], movie_ids[lo:hi], ratings[lo:hi], timestamps[lo:hi]])
+            np.savetxt(f, columns, fmt=['%d', '%d', '%.1f', '%d'], delimiter=',')
+
+
+def generate(out_dir, n_movies, n_users, n_ratings, n_tags, seed=42, movie_exponent=0.9, user_exponent=0.8):
+    # writes movies.csv, ratings.csv, tags.csv and links.csv to out_dir, returns the row counts
+    started = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    movie_ids = np.sort(rng.choice(np.arange(1, 3 * n_movies + 1), n_movies, replace=False))
+    years = rng.integers(1920, 2024, n_movies)
+    genre_weights = 1 / np.arange(1, len(GENRES) + 1) ** 0.8
+    genre_weights /= genre_weights.sum()
+    movies = []
+    for i, movie_id in enumerate(movie_ids):
+        words = rng.choice(WORDS, rng.integers(1, 4))
+        title = ' '.join(words).title() + f' {i}'
+        if i % 97 == 0:
+            title = f'{title}, The'
+        if i % 211 == 0:
+            title = f'"{title}"'
+        if i % 499 != 0:  # a few movies without a year
+            title = f'{title} ({years[i]})'
+        n_genres = rng.integers(1, 5)
+        genres = '(no genres listed)' if i % 389 == 0 else \
+            '|'.join(rng.choice(GENRES, n_genres, replace=False, p=genre_weights))
+        movies.append((movie_id, title, genres))
+    write_rows(os.path.join(out_dir, 'movies.csv'), ['movieId', 'title', 'genres'], movies)
+
+    movie_weights = zipf_weights(n_movies, movie_exponent, rng)
+    counts = user_activity(n_users, n_ratings, n_movies, user_exponent, rng)
+    users, movies_of_ratings = rating_pairs(counts, movie_weights, rng)
+    quality = rng.normal(3.5, 0.5, n_movies)
+    bias = rng.normal(0, 0.4, n_users)
+    ratings = np.clip(np.round((quality[movies_of_ratings] + bias[users] + rng.normal(0, 0.8, len(users))) * 2) / 2,
+                      0.5, 5.0)
+    first = rng.integers(START, END, n_users)
+    timestamps = first[users] + rng.integers(0, 3 * 365 * 86400, len(users))
+    write_ratings(os.path.join(out_dir, 'ratings.csv'), users + 1, movie_ids[movies_of_ratings], ratings,
+                  np.minimum(timestamps, END))
+
+    tag_users = sample(np.bincount(users, minlength=n_users) / len(users), n_tags, rng)
+    tag_movies = sample(movie_weights, n_tags, rng)
+    vocabulary = [' '.join(rng.choice(WORDS, rng.integers(1, 3))) for _ in range(max(n_tags // 20, 10))]
+    vocabulary[::50] = [f'{word}, really' for word in vocabulary[::50]]
+    tag_names = sample(zipf_weights(len(vocabulary), 1.1, rng), n_tags, rng)
+    tag_times = rng.integers(START, END, n_tags)
+    write_rows(os.path.join(out_dir, 'tags.csv'), ['userId', 'movieId', 'tag', 'timestamp'],
+               ((u + 1, movie_ids[m], vocabulary[t], ts) for u, m, t, ts in zip(tag_users, tag_movies, tag_names, tag_times)))
+
+    links = ((movie_id, f'{rng.integers(1, 9999999):07d}', '' if i % 300 == 0 else rng.integers(1, 999999))
+             for i, movie_id in enumerate(movie_ids))
+    write_rows(os.path.join(out_dir, 'links.csv'), ['movieId', 'imdbId', 'tmdbId'], links)
+
+    counts = {'movies': n_movies, 'users': int(len(np.unique(users))), 'ratings': int(len(users)), 'tags': n_tags}
+    print(f"Generated {counts} in {out_dir} in {time.perf_counter() - started:.1f}s")
+    return counts
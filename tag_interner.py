@@ -0,0 +1,102 @@
+import logging
+from datetime import datetime
+from threading import Lock
+
+from sqlalchemy import select, text
+
+from models import TagNames, Tags
+
+logger = logging.getLogger('api_flask.tag_interner')  # goes to the api_flask log
+
+
+# maps tag names to their movie_tagnames id, so tags can be stored without a query per tag
+class TagInterner:
+    def __init__(self):
+        self.ids = {}
+        self.next_id = 1
+        self.pending = []  # (id, name) assigned in memory but not inserted yet
+        self.loaded = False
+        self.lock = Lock()
+
+    def load(self, executor):
+        # preload all existing tag names, executor is a session or a connection
+        with self.lock:
+            self.ids = {name: id for id, name in executor.execute(select(TagNames.id, TagNames.name))}
+            self.next_id = max(self.ids.values(), default=0) + 1
+            self.pending = []
+            self.loaded = True
+        return self
+
+    def intern(self, name):
+        # id for the name, new names get the next free id and are queued for flush()
+        # only for a single writer ( e.g. data loading ), at runtime use ids_for()
+        with self.lock:
+            id = self.ids.get(name)
+            if id is None:
+                id = self.ids[name] = self.next_id
+                self.next_id += 1
+                self.pending.append({'id': id, 'name': name})
+            return id
+
+    def flush(self, executor):
+        # insert all queued tag names with one executemany, returns the number of new names
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if pending:
+            executor.execute(TagNames.__table__.insert(), pending)
+        return len(pending)
+
+    def ids_for(self, session, names):
+        # runtime lookup, missing names are inserted and their database assigned ids read back
+        # this stays correct when several processes add tags at the same time: the name is unique, a name
+        # another process inserted first is ignored and its id read back
+        if not self.loaded:
+            self.load(session)
+        missing = {name for name in names if name not in self.ids}
+        if missing:
+            # another process may have added them since we loaded
+            found = dict(session.execute(select(TagNames.name, TagNames.id).where(TagNames.name.in_(missing))).all())
+            new = missing - found.keys()
+            if new:
+                session.execute(TagNames.__table__.insert().prefix_with('OR IGNORE'),
+                                [{'name': name} for name in new])
+                found.update(session.execute(select(TagNames.name, TagNames.id).where(TagNames.name.in_(new))).all())
+            with self.lock:
+                self.ids.update(found)
+                self.next_id = max(self.next_id, max(found.values(), default=0) + 1)
+        return {name: self.ids[name] for name in names}
+
+
+TAG_NAME_INDEX = 'ix_movie_tagnames_name'
+
+
+def ensure_tag_name_index(db):
+    # makes the name index unique on databases created before, duplicate names are merged into the first id
+    indexes = {row[1]: row[2] for row in db.session.execute(text('PRAGMA index_list(movie_tagnames)'))}
+    if indexes.get(TAG_NAME_INDEX):
+        return
+    first = 'SELECT min(id) FROM movie_tagnames AS first WHERE first.name = movie_tagnames.name'
+    db.session.execute(text(f'UPDATE movie_tags SET tag_name_id = (SELECT ({first}) FROM movie_tagnames '
+                            f'WHERE movie_tagnames.id = movie_tags.tag_name_id)'))
+    removed = db.session.execute(text(f'DELETE FROM movie_tagnames WHERE id != ({first})')).rowcount
+    db.session.execute(text(f'DROP INDEX IF EXISTS {TAG_NAME_INDEX}'))
+    db.session.execute(text(f'CREATE UNIQUE INDEX {TAG_NAME_INDEX} ON movie_tagnames (name)'))
+    db.session.commit()
+    tag_interner.loaded = False  # ids of merged names changed
+    logger.info(f"created unique {TAG_NAME_INDEX}, merged {removed} duplicate tag names")
+
+
+# shared instance for the web app, loaded on first use
+tag_interner = TagInterner()
+
+
+def add_tags(db, user_id, movie_id, names, timestamp=None):
+    # store several tags of a user for one movie in one batch, returns the tag name ids
+    timestamp = timestamp or datetime.now()
+    ids = tag_interner.ids_for(db.session, names)
+    db.session.execute(Tags.__table__.insert(), [
+        {'user_id': user_id, 'movie_id': movie_id, 'tag_name_id': ids[name], 'timestamp': timestamp}
+        for name in names
+    ])
+    db.session.commit()
+    return ids
@@ -0,0 +1,154 @@
+import bisect
+import re
+import time
+import unicodedata
+
+import numpy as np
+from sqlalchemy import func, select
+
+from models import Movie, Ratings
+from page_cache import catalogue_version
+
+# In memory title index for the search page and the autocomplete
+# the words of every title_stripped ( lower case, without accents ) are kept sorted with the movies they
+# occur in, a query word matches a title word exactly, as a prefix ( a binary search over the sorted words,
+# the movies of all words with that prefix are one contiguous slice ) or, from 3 letters on, anywhere
+# inside a word ( a trigram index over the distinct words ). Every word of the query has to match.
+# Results are ranked by how well the words matched, then by popularity ( number of ratings ).
+# Like the genre index it is loaded on first use and reloaded when the catalogue version changes.
+
+REFRESH_SECONDS = 5  # how often the index checks the database for changed titles
+POPULARITY_SECONDS = 600  # how often the rating counts are reloaded
+WORD = re.compile(r'\w+')
+EXACT, PREFIX, INFIX = 3, 2, 1  # match quality of a query word
+PHRASE = 3  # extra for a title that starts with the whole query
+
+
+def normalize(text):
+    # lower case without accents, "Amélie" finds "amelie" and the other way round
+    text = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+
+
+def words(text):
+    return WORD.findall(normalize(text))
+
+
+def trigrams(word):
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+class SearchResult:
+    def __init__(self, movie_id, title, year, score):
+        self.movie_id = movie_id
+        self.title = title
+        self.year = year
+        self.score = score
+
+
+class TitleIndex:
+    def __init__(self, movie_ids, titles, years, popularity, stamp=None):
+        self.movie_ids = movie_ids  # sorted, the position of a movie in every array below
+        self.titles = titles
+        self.years = years
+        self.keys = [' '.join(words(title)) for title in titles]  # normalized titles for the phrase match
+        self.key_order = np.array(sorted(range(len(self.keys)), key=self.keys.__getitem__), dtype=np.int64)
+        self.sorted_keys = [self.keys[p] for p in self.key_order]
+        self.stamp = stamp
+        self.checked = time.monotonic()
+        self.set_popularity(popularity)
+
+        postings = {}
+        for position, key in enumerate(self.keys):
+            for word in set(key.split()):
+                postings.setdefault(word, []).append(position)
+        self.words = sorted(postings)
+        # the positions of the movies of word i are positions[offsets[i]:offsets[i + 1]]
+        self.offsets = np.zeros(len(self.words) + 1, dtype=np.int64)
+        np.cumsum([len(postings[word]) for word in self.words], out=self.offsets[1:])
+        self.positions = np.array([p for word in self.words for p in postings[word]], dtype=np.int64)
+        self.trigram_words = {}  # trigram -> ids of the words that contain it
+        for i, word in enumerate(self.words):
+            for trigram in trigrams(word):
+                self.trigram_words.setdefault(trigram, []).append(i)
+
+    @classmethod
+    def load(cls, db):
+        rows = db.session.execute(select(Movie.id, Movie.title_stripped, Movie.year).order_by(Movie.id)).all()
+        movie_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        return cls(movie_ids, [row[1] for row in rows], [row[2] for row in rows],
+                   cls.load_popularity(db, movie_ids), catalogue_version(db))
+
+    @staticmethod
+    def load_popularity(db, movie_ids):
+        # ratings per movie in the order of movie_ids, one pass over the covering (movie_id, rating) index
+        counts = np.zeros(len(movie_ids), dtype=np.float64)
+        rows = db.session.execute(select(Ratings.movie_id, func.count()).group_by(Ratings.movie_id)).all()
+        if rows and len(movie_ids):
+            ids, n = np.array(rows, dtype=np.int64).T
+            positions = np.minimum(np.searchsorted(movie_ids, ids), len(movie_ids) - 1)
+            known = movie_ids[positions] == ids
+            counts[positions[known]] = n[known]
+        return counts
+
+    def set_popularity(self, counts):
+        # log scaled to [0, 1), it only orders movies that matched equally well
+        self.popularity = np.log1p(counts) / (np.log1p(counts.max()) + 1e-9) * 0.99 if len(counts) else counts
+        self.popularity_loaded = time.monotonic()
+
+    def refresh_if_changed(self, db):
+        # reloads the index when the catalogue changed, the popularity every POPULARITY_SECONDS
+        if time.monotonic() - self.checked < REFRESH_SECONDS:
+            return self
+        self.checked = time.monotonic()
+        if catalogue_version(db) != self.stamp:
+            return TitleIndex.load(db)
+        if time.monotonic() - self.popularity_loaded > POPULARITY_SECONDS:
+            self.set_popularity(self.load_popularity(db, self.movie_ids))
+        return self
+
+    def postings(self, word_ids):
+        if not len(word_ids):
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self.positions[self.offsets[i]:self.offsets[i + 1]] for i in word_ids])
+
+    def match(self, word):
+        # match quality of one query word for every movie, 0 where it doesn't match
+        quality = np.zeros(len(self.movie_ids), dtype=np.int32)
+        if len(word) >= 3:
+            candidates = set.intersection(*(set(self.trigram_words.get(t, ())) for t in trigrams(word)))
+            quality[self.postings([i for i in candidates if word in self.words[i]])] = INFIX
+        lo = bisect.bisect_left(self.words, word)
+        hi = bisect.bisect_left(self.words, word + '\U0010ffff', lo)
+        quality[self.positions[self.offsets[lo]:self.offsets[hi]]] = PREFIX
+        if lo < hi and self.words[lo] == word:
+            quality[self.postings([lo])] = EXACT
+        return quality
+
+    def phrase_matches(self, phrase):
+        # positions of the titles that start with the phrase, a prefix range of the sorted titles
+        lo = bisect.bisect_left(self.sorted_keys, phrase)
+        hi = bisect.bisect_left(self.sorted_keys, phrase + '\U0010ffff', lo)
+        return self.key_order[lo:hi]
+
+    def search(self, query, limit=10, movie_ids=None):
+        # the best [SearchResult] for the query, movie_ids ( sorted ): only search these, e.g. a genre filter
+        query_words = words(query)
+        if not query_words or not len(self.movie_ids) or limit < 1:
+            return []
+        quality = None
+        for word in query_words:
+            word_quality = self.match(word)
+            quality = word_quality if quality is None else \
+                np.where((quality > 0) & (word_quality > 0), quality + word_quality, 0)
+        matched = np.flatnonzero(quality)
+        if movie_ids is not None:
+            matched = matched[np.isin(self.movie_ids[matched], movie_ids, assume_unique=True)]
+        if not len(matched):
+            return []
+        score = quality[matched] + self.popularity[matched]
+        score[np.isin(matched, self.phrase_matches(' '.join(query_words)))] += PHRASE
+        top = np.argpartition(-score, limit - 1)[:limit] if len(matched) > limit else np.arange(len(matched))
+        top = top[np.lexsort((self.movie_ids[matched[top]], -score[top]))]
+        return [SearchResult(int(self.movie_ids[p]), self.titles[p], self.years[p], float(score[i]))
+                for i, p in zip(top, matched[top])]